@@ -0,0 +1,238 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app_metrics import register_metrics_provider
+
+
+# ログ設定の既定値
+DEFAULT_LOGGING_SETTINGS = {
+    "level": "INFO",
+    "format": "text",
+    "file": "",
+    "queue_size": 10000,
+    # httpxはリクエストごとにINFOログを出すため、既定では警告以上のみ出力する
+    "levels": {"httpx": "WARNING", "mcp": "WARNING"},
+    "sample_rates": {},
+}
+# LogRecordの標準属性（これ以外の属性はextraで渡された構造化フィールドとして出力する）
+_LOG_RECORD_ATTRIBUTES = set(
+    logging.LogRecord("", 0, "", 0, "", None, None).__dict__
+) | {"message", "asctime", "taskName"}
+_log_listener = None
+
+
+def _stop_log_listener() -> None:
+    # キューに残っているログを出力し終えてから停止する
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+atexit.register(_stop_log_listener)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    ログを1行1レコードのJSONとして出力するフォーマッター。
+    extraで渡したフィールド（server, llm_backendなど）もそのまま出力する。
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRIBUTES:
+                payload[key] = value
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class StructuredTextFormatter(logging.Formatter):
+    """
+    人が読むためのテキスト形式のフォーマッター。extraのフィールドは末尾に key=value で付加する。
+    """
+
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = " ".join(
+            f"{key}={value}"
+            for key, value in record.__dict__.items()
+            if key not in _LOG_RECORD_ATTRIBUTES
+        )
+        return f"{text} {fields}" if fields else text
+
+
+class LogSamplingFilter(logging.Filter):
+    """
+    レベルごとの割合でログを間引くフィルター。警告以上は間引かない。
+    """
+
+    def __init__(self, sample_rates: dict) -> None:
+        super().__init__()
+        self.rates = {
+            logging.getLevelName(level.upper()): float(rate)
+            for level, rate in sample_rates.items()
+        }
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    ログをキューに積むだけのハンドラー。書式化・出力はQueueListenerのスレッドで行う。
+    キューが一杯の場合は呼び出し元を待たせずにログを捨て、件数を数える。
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 引数は呼び出し時点の値で文字列にしておき、書式化（JSON化など）は出力スレッドに任せる
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(config: dict, debug: bool = False) -> None:
+    """
+    ログ出力を設定する関数。
+    ログはキュー経由でバックグラウンドスレッドから出力するため、リクエスト処理をコンソール出力で待たせない。
+    Args:
+        config (dict): server_params.jsonのloggingセクション
+            level: 全体のログレベル, format: "text" または "json", file: 出力先ファイル（空なら標準エラー出力）,
+            queue_size: キューの上限, levels: ロガー名ごとのレベル, sample_rates: レベルごとの出力割合
+        debug (bool): エージェントの詳細ログ（langchain_mcp_utils.agent）をDEBUGで出力する
+    """
+    global _log_listener
+    settings = {**DEFAULT_LOGGING_SETTINGS, **(config or {})}
+    levels = {**DEFAULT_LOGGING_SETTINGS["levels"], **settings["levels"]}
+    if debug:
+        levels.setdefault("langchain_mcp_utils.agent", "DEBUG")
+
+    _stop_log_listener()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+
+    output = (
+        logging.FileHandler(settings["file"], encoding="utf-8")
+        if settings["file"]
+        else logging.StreamHandler()
+    )
+    output.setFormatter(
+        JsonLogFormatter()
+        if settings["format"] == "json"
+        else StructuredTextFormatter()
+    )
+    log_queue = queue.Queue(int(settings["queue_size"]))
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(LogSamplingFilter(settings["sample_rates"]))
+    root.addHandler(handler)
+    root.setLevel(settings["level"].upper())
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper())
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, output, respect_handler_level=True
+    )
+    _log_listener.start()
+    register_metrics_provider("logging", lambda: {"dropped": handler.dropped})
+
+
+class AgentDebugLogger(BaseCallbackHandler):
+    """
+    エージェントのLLM呼び出し・ツール呼び出しをDEBUGログとして記録するコールバック。
+    LangGraphのdebug出力（状態全体を標準出力に同期的に書き出す）の代わりに使う。
+    """
+
+    # キューに積むだけなので、別スレッドに回さずその場で実行する
+    run_inline = True
+
+    def __init__(self, max_chars: int = 500) -> None:
+        self.logger = logging.getLogger("langchain_mcp_utils.agent")
+        self.max_chars = max_chars
+
+    def _clip(self, value) -> str:
+        text = str(value)
+        return text if len(text) <= self.max_chars else text[: self.max_chars] + "…"
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "LLM呼び出し開始",
+                extra={"run_id": str(run_id), "messages": len(messages[0])},
+            )
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        message = getattr(response.generations[0][0], "message", None)
+        self.logger.debug(
+            "LLM呼び出し終了",
+            extra={
+                "run_id": str(run_id),
+                "llm_backend": (response.llm_output or {}).get("llm_backend", ""),
+                "tool_calls": [
+                    call["name"] for call in getattr(message, "tool_calls", [])
+                ],
+                "usage": getattr(message, "usage_metadata", None),
+                "content": self._clip(getattr(message, "content", "")),
+            },
+        )
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "ツール呼び出し開始",
+                extra={
+                    "run_id": str(run_id),
+                    "tool": (serialized or {}).get("name", ""),
+                    "input": self._clip(input_str),
+                },
+            )
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            content = getattr(output, "content", output)
+            self.logger.debug(
+                "ツール呼び出し終了",
+                extra={
+                    "run_id": str(run_id),
+                    "chars": len(str(content)),
+                    "output": self._clip(content),
+                },
+            )
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self.logger.warning(
+            "ツール呼び出しに失敗しました: %s", error, extra={"run_id": str(run_id)}
+        )
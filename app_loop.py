@@ -0,0 +1,131 @@
+import asyncio
+import threading
+
+from app_metrics import register_metrics_provider
+
+
+# リクエストをまたいで使い続ける常駐イベントループ
+_app_loop = None
+_app_loop_lock = threading.Lock()
+
+
+def get_app_loop() -> asyncio.AbstractEventLoop:
+    """
+    アプリ共通の常駐イベントループを取得する関数（初回呼び出し時にスレッドで起動する）。
+    非同期HTTPクライアントの接続はイベントループに結び付くため、リクエストごとにasyncio.runで
+    ループを作り直すと接続プールが再利用されない。チャット処理とウォームアップはこのループで実行する。
+    Returns:
+        asyncio.AbstractEventLoop: 常駐イベントループ
+    """
+    global _app_loop
+    with _app_loop_lock:
+        if _app_loop is None:
+            _app_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_app_loop.run_forever, name="app-event-loop", daemon=True
+            ).start()
+        return _app_loop
+
+
+def submit_to_app_loop(coro):
+    """
+    コルーチンを常駐イベントループに投入する関数。
+    Args:
+        coro: 実行するコルーチン
+    Returns:
+        concurrent.futures.Future: 実行結果のFuture
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_app_loop())
+
+
+def run_on_app_loop(coro):
+    """
+    コルーチンを常駐イベントループで実行し、完了まで待つ関数（同期ハンドラ用）。
+    Args:
+        coro: 実行するコルーチン
+    Returns:
+        コルーチンの戻り値
+    """
+    return submit_to_app_loop(coro).result()
+
+
+async def await_on_app_loop(coro):
+    """
+    コルーチンを常駐イベントループで実行し、完了を待つ関数（非同期ハンドラ用）。
+    呼び出し元がキャンセルされた場合（停止ボタンなど）は、常駐ループ側のタスクもキャンセルする。
+    Args:
+        coro: 実行するコルーチン
+    Returns:
+        コルーチンの戻り値
+    """
+    return await asyncio.wrap_future(submit_to_app_loop(coro))
+
+
+# 停止した実行の代わりに表示するメッセージ
+RUN_CANCELLED_MESSAGE = "（停止しました）"
+
+
+class RunRegistry:
+    """
+    実行中のエージェントを(セッションID, ペイン名)ごとに管理し、停止ボタン・切断・再送信でキャンセルする。
+    キャンセルはタスク全体に伝わるため、待機中のLLMへのHTTPリクエストや実行中のMCPツール呼び出しも中断される。
+    """
+
+    def __init__(self) -> None:
+        self._runs = {}
+        self._lock = threading.Lock()
+        self.stats = {"started": 0, "cancelled": 0, "superseded": 0}
+
+    async def run(self, key: tuple, coro):
+        """
+        コルーチンを現在のタスクで実行し、keyでキャンセルできるよう登録する。
+        同じkeyで実行中のものがあれば、古い方は不要になるためキャンセルする。
+        Args:
+            key (tuple): (セッションID, ペイン名)
+            coro: 実行するコルーチン
+        Returns:
+            コルーチンの戻り値
+        """
+        task = asyncio.current_task()
+        with self._lock:
+            previous = self._runs.get(key)
+            self._runs[key] = task
+            self.stats["started"] += 1
+            if previous is not None and not previous.done():
+                self.stats["superseded"] += 1
+        if previous is not None and not previous.done():
+            previous.cancel()
+        try:
+            return await coro
+        finally:
+            with self._lock:
+                if self._runs.get(key) is task:
+                    del self._runs[key]
+
+    def cancel(self, session_id: str, pane: str | None = None) -> int:
+        """
+        セッションの実行中のエージェントをキャンセルする（どのスレッドからでも呼べる）
+        Args:
+            session_id (str): セッションID
+            pane (str | None): ペイン名（省略時はセッションのすべて）
+        Returns:
+            int: キャンセルした件数
+        """
+        with self._lock:
+            tasks = [
+                task
+                for (run_session, run_pane), task in self._runs.items()
+                if run_session == session_id and pane in (None, run_pane)
+            ]
+            self.stats["cancelled"] += len(tasks)
+        for task in tasks:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        return len(tasks)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"running": len(self._runs), **self.stats}
+
+
+active_runs = RunRegistry()
+register_metrics_provider("active_runs", active_runs.snapshot)
@@ -0,0 +1,73 @@
+import threading
+
+
+class ToolCallStats:
+    """
+    ツールごとの呼び出し回数・エラー数・所要時間を集計するクラス。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, tool_name: str, duration: float, failed: bool = False) -> None:
+        """
+        ツール呼び出し1回分の結果を記録する
+        Args:
+            tool_name (str): ツール名
+            duration (float): 所要時間（秒）
+            failed (bool): 失敗した場合はTrue
+        """
+        with self._lock:
+            stats = self._stats.setdefault(
+                tool_name,
+                {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            )
+            stats["calls"] += 1
+            stats["errors"] += 1 if failed else 0
+            stats["total_seconds"] += duration
+            stats["max_seconds"] = max(stats["max_seconds"], duration)
+
+    def snapshot(self) -> dict:
+        """
+        集計結果のコピーを返す
+        Returns:
+            dict: ツール名をキーとした集計結果
+        """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+# プロセス全体で共有するツール呼び出し統計
+tool_call_stats = ToolCallStats()
+
+# メトリクス名をキーとした、現在値を返す関数の登録先
+_metrics_providers = {}
+
+
+def register_metrics_provider(name: str, provider) -> None:
+    """
+    メトリクスの提供関数を登録する関数
+    Args:
+        name (str): メトリクス名
+        provider (callable): 引数なしで呼ばれ、JSONシリアライズ可能な値を返す関数
+    """
+    _metrics_providers[name] = provider
+
+
+def get_metrics_snapshot() -> dict:
+    """
+    登録済みのすべてのメトリクスの現在値を返す関数
+    Returns:
+        dict: メトリクス名をキーとした現在値
+    """
+    snapshot = {}
+    for name, provider in list(_metrics_providers.items()):
+        try:
+            snapshot[name] = provider()
+        except Exception as e:
+            snapshot[name] = {"error": f"{type(e).__name__}: {e}"}
+    return snapshot
+
+
+register_metrics_provider("tool_calls", tool_call_stats.snapshot)
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import main
+from langchain_mcp_utils import (
+    load_server_params,
+    get_llm_params,
+)
+from app_metrics import get_metrics_snapshot
+from app_logging import configure_logging
+from mcp_http import configure_mcp_http
+from mcp_resilience import configure_server_options
+from mcp_supervisor import resolve_servers
+from llm_inprocess import configure_litellm
+from llm_cassette import configure_cassette
+from llm_prompt import DEFAULT_SYSTEM_PROMPT
+from doc_store import configure_doc_store
+from tool_results import configure_tool_results
+from run_records import configure_pricing
+from tool_catalog import (
+    load_tool_catalog,
+    register_builtin_tools,
+)
+
+DEFAULT_PROMPTS = [
+    "こんにちは",
+    "利用できるツールを1つ使って、結果を要約してください。",
+]
+
+
+def _percentile(values: list, rate: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(rate * len(ordered)))]
+
+
+def _load_prompts(path: str | None) -> list:
+    if not path:
+        return DEFAULT_PROMPTS
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    """
+    カセットを使ってプロンプトを順に実行し、応答時間を集計する関数
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+    Returns:
+        dict: 応答時間の集計とカセットの統計
+    """
+    params = load_server_params(args.params)
+    configure_logging(params.get("logging", {}))
+    configure_server_options(params.get("server_options", {}))
+    configure_tool_results(params.get("tool_results", {}))
+    configure_doc_store(params.get("doc_store", {}))
+    configure_mcp_http(params.get("mcp_http", {}))
+    configure_pricing(params.get("pricing", {}))
+    litellm_config = params.get("litellm", {})
+    if args.llm_mode:
+        litellm_config = {**litellm_config, "mode": args.llm_mode}
+    configure_litellm(litellm_config)
+    cassette = configure_cassette(
+        {"mode": args.mode, "path": args.cassette, "latency": args.latency}
+    )
+    _, _, main.llm_options, default_llm, _ = get_llm_params(params)
+    main.agent_budget = params.get("agent_budget", {})
+    # 再生時はカセットに記録したツール定義を使うため、MCPサーバーは起動しない
+    main.tool_catalog, _ = await load_tool_catalog(resolve_servers(params))
+    register_builtin_tools(main.tool_catalog)
+    main.global_tools = main.tool_catalog.tools
+
+    durations = []
+    for _ in range(args.repeat):
+        for prompt in _load_prompts(args.prompts):
+            started = time.perf_counter()
+            await main.gradio_chat(
+                prompt, [], "有効", args.llm or default_llm, DEFAULT_SYSTEM_PROMPT
+            )
+            durations.append(time.perf_counter() - started)
+    cassette.save()
+    return {
+        "runs": len(durations),
+        "p50": round(statistics.median(durations), 4),
+        "p95": round(_percentile(durations, 0.95), 4),
+        "mean": round(statistics.fmean(durations), 4),
+        "litellm": get_metrics_snapshot().get("litellm", {}),
+        "cassette": get_metrics_snapshot().get("cassette", {}),
+    }
+
+
+def main_cli() -> None:
+    """
+    メイン関数。記録（--record）したカセットを再生（--replay）して、性能の変化を比較する。
+    """
+    parser = argparse.ArgumentParser(
+        description="LLM・MCPの通信を記録・再生して応答時間を測定する"
+    )
+    parser.add_argument("--cassette", default="cassettes/session.jsonl.gz")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--record", dest="mode", action="store_const", const="record")
+    mode.add_argument("--replay", dest="mode", action="store_const", const="replay")
+    parser.add_argument(
+        "--latency",
+        choices=["original", "none"],
+        default="original",
+        help="再生時の待ち時間（original: 記録時のまま, none: 待たない）",
+    )
+    parser.add_argument("--prompts", help="1行に1つのプロンプトを書いたファイル")
+    parser.add_argument("--llm", help="使用するLLM名（省略時は最初のLLM）")
+    parser.add_argument(
+        "--llm-mode",
+        choices=["proxy", "in_process"],
+        help="LiteLLMの呼び出し方法（省略時はserver_params.jsonのlitellm.mode）",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--params", default="server_params.json")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_benchmark(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,238 @@
+import collections
+import json
+import math
+import re
+import threading
+
+from app_metrics import register_metrics_provider
+from llm_routing import tokenize_terms
+
+
+# ローカル文書ストアの既定値（server_params.jsonのdoc_storeセクションで上書きする）
+DEFAULT_DOC_STORE_SETTINGS = {
+    "enabled": "false",
+    "servers": ["awslabs", "microsoft.docs.mcp"],
+    "chunk_chars": 1200,
+    "min_chars": 200,
+    "max_chars": 20000000,
+    "top_k": 4,
+}
+# BM25のパラメータ
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def _split_passages(text: str, chunk_chars: int) -> list:
+    # 段落の区切りでchunk_chars文字程度にまとめ、長すぎる段落はその長さで区切る
+    passages = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > chunk_chars:
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars:]
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+class LocalDocStore:
+    """
+    ドキュメント取得ツールの結果を段落単位に分割し、BM25の転置インデックスで検索できるようにするストア。
+    同じページを取得し直さずにローカルの抜粋から回答できるようにし、ツールの待ち時間とプロンプトを減らす。
+    保持する文字数がmax_charsを超えた場合は、最後に使われた時刻が古い文書から削除する。
+    """
+
+    def __init__(self, settings: dict | None = None) -> None:
+        self._lock = threading.Lock()
+        self.configure(settings or {})
+        self.documents = collections.OrderedDict()
+        self._passages = {}
+        self._postings = collections.defaultdict(dict)
+        self._next_id = 0
+        self._total_terms = 0
+        self.chars = 0
+        self.stats = {"added": 0, "hits": 0, "misses": 0, "evicted": 0}
+
+    def configure(self, settings: dict) -> None:
+        """
+        設定を反映する
+        Args:
+            settings (dict): server_params.jsonのdoc_storeセクション
+        """
+        settings = {**DEFAULT_DOC_STORE_SETTINGS, **settings}
+        self.enabled = str(settings["enabled"]).lower() == "true"
+        self.servers = set(settings["servers"])
+        self.chunk_chars = int(settings["chunk_chars"])
+        self.min_chars = int(settings["min_chars"])
+        self.max_chars = int(settings["max_chars"])
+        self.top_k = int(settings["top_k"])
+
+    def accepts(self, server_name: str, text: str) -> bool:
+        """
+        ツール結果を文書として保存する対象かどうかを返す
+        Args:
+            server_name (str): ツールを提供するサーバー名
+            text (str): ツール結果
+        Returns:
+            bool: 保存する場合はTrue
+        """
+        return (
+            self.enabled and server_name in self.servers and len(text) >= self.min_chars
+        )
+
+    def add(self, source: str, text: str) -> int:
+        """
+        文書を登録する（同じ出典の文書は置き換える）
+        Args:
+            source (str): 出典（取得したツールと引数など）
+            text (str): 文書の全文
+        Returns:
+            int: 登録した段落数
+        """
+        passages = _split_passages(text, self.chunk_chars)
+        with self._lock:
+            self._remove(source)
+            ids = []
+            for passage in passages:
+                passage_id = self._next_id
+                self._next_id += 1
+                terms = collections.Counter(tokenize_terms(passage))
+                for term, count in terms.items():
+                    self._postings[term][passage_id] = count
+                length = sum(terms.values())
+                self._passages[passage_id] = (source, passage, length)
+                self._total_terms += length
+                self.chars += len(passage)
+                ids.append(passage_id)
+            self.documents[source] = ids
+            self.stats["added"] += 1
+            while self.chars > self.max_chars and len(self.documents) > 1:
+                self._remove(next(iter(self.documents)))
+                self.stats["evicted"] += 1
+        return len(ids)
+
+    def _remove(self, source: str) -> None:
+        for passage_id in self.documents.pop(source, []):
+            _, passage, length = self._passages.pop(passage_id)
+            for term in set(tokenize_terms(passage)):
+                postings = self._postings[term]
+                postings.pop(passage_id, None)
+                if not postings:
+                    del self._postings[term]
+            self._total_terms -= length
+            self.chars -= len(passage)
+
+    def search(self, query: str, top_k: int | None = None) -> list:
+        """
+        BM25で段落を検索する
+        Args:
+            query (str): 検索語
+            top_k (int | None): 返す段落数の上限（Noneの場合は設定値）
+        Returns:
+            list: (スコア, 出典, 段落) のリスト（スコアの高い順）
+        """
+        with self._lock:
+            count = len(self._passages)
+            if not count:
+                self.stats["misses"] += 1
+                return []
+            average = self._total_terms / count
+            scores = collections.defaultdict(float)
+            for term in set(tokenize_terms(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(
+                    1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for passage_id, frequency in postings.items():
+                    length = self._passages[passage_id][2]
+                    scores[passage_id] += (
+                        idf
+                        * frequency
+                        * (_BM25_K1 + 1)
+                        / (
+                            frequency
+                            + _BM25_K1 * (1 - _BM25_B + _BM25_B * length / average)
+                        )
+                    )
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[
+                : top_k or self.top_k
+            ]
+            results = []
+            for passage_id, score in ranked:
+                source, passage, _ = self._passages[passage_id]
+                # 検索で使われた文書は削除の順番を後ろに回す
+                self.documents.move_to_end(source)
+                results.append((round(score, 3), source, passage))
+            self.stats["hits" if results else "misses"] += 1
+            return results
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "documents": len(self.documents),
+                "passages": len(self._passages),
+                "chars": self.chars,
+                **self.stats,
+            }
+
+
+local_doc_store = LocalDocStore()
+register_metrics_provider("doc_store", local_doc_store.snapshot)
+
+
+def configure_doc_store(config: dict) -> None:
+    """
+    server_params.jsonのdoc_storeセクションを反映する関数
+    Args:
+        config (dict): ローカル文書ストアの設定
+    """
+    local_doc_store.configure(config or {})
+
+
+def store_tool_document(server_name: str, tool_name: str, arguments: dict, content):
+    """
+    ドキュメント取得ツールの結果を、ローカル文書ストアに登録する関数（対象外のサーバーは何もしない）
+    Args:
+        server_name (str): ツールを提供するサーバー名
+        tool_name (str): ツール名
+        arguments (dict): ツールの引数
+        content (str | list): ツール結果（切り詰める前の全文）
+    """
+    text = content if isinstance(content, str) else "\n".join(map(str, content))
+    if not local_doc_store.accepts(server_name, text):
+        return
+    source = f"{server_name}/{tool_name} " + json.dumps(
+        arguments, ensure_ascii=False, sort_keys=True
+    )
+    local_doc_store.add(source, text)
+
+
+async def search_local_docs(query: str, top_k: int = 0) -> str:
+    """
+    以前に取得したドキュメントの段落をローカルで検索する組み込みツール
+    Args:
+        query (str): 検索語
+        top_k (int): 返す段落数の上限（0の場合は設定値）
+    Returns:
+        str: 出典つきの段落、または見つからなかった旨
+    """
+    results = local_doc_store.search(query, top_k or None)
+    if not results:
+        return "ローカルに該当する文書はありません。ドキュメント取得ツールで取得してください。"
+    return "\n\n".join(
+        f"[{rank}] 出典: {source} (score={score})\n{passage}"
+        for rank, (score, source, passage) in enumerate(results, 1)
+    )
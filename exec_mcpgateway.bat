@@ -0,0 +1 @@
+uv run .\mcp_gateway.py
@@ -0,0 +1,289 @@
+import atexit
+import contextlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+from app_metrics import register_metrics_provider
+from run_records import RunRecord
+
+logger = logging.getLogger(__name__)
+
+
+# 会話履歴の保存設定の既定値
+DEFAULT_HISTORY_SETTINGS = {
+    "enabled": "false",
+    "path": "chat_history.sqlite3",
+    # 再開時に読み込む直近のメッセージ数（ペインごと）
+    "resume_messages": 40,
+    # 1回の書き込み（トランザクション）にまとめる最大件数
+    "batch_size": 200,
+    # 保存期間（日）とペインごとの最大メッセージ数（0は無制限）
+    "retention_days": 30,
+    "max_messages_per_session": 2000,
+    # 保存期間を過ぎた履歴を削除する間隔（秒）
+    "compact_interval": 3600,
+}
+# この長さを超えるメッセージは圧縮して保存する
+_HISTORY_COMPRESS_THRESHOLD = 512
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    pane TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    compressed INTEGER NOT NULL,
+    payload BLOB NOT NULL,
+    run_record BLOB
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, pane, id);
+CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+"""
+_HISTORY_STOP = object()
+
+
+def _encode_history_payload(value) -> tuple:
+    data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) > _HISTORY_COMPRESS_THRESHOLD:
+        return 1, zlib.compress(data)
+    return 0, data
+
+
+def _decode_history_payload(compressed: int, data: bytes):
+    return json.loads(zlib.decompress(data) if compressed else data)
+
+
+class ConversationStore:
+    """
+    会話履歴を追記のみのSQLiteに保存するクラス。
+    書き込みは専用スレッドでまとめて1トランザクションで行うため、チャット処理を待たせない。
+    読み込みは再開に必要な直近のメッセージだけをインデックスで取得する。
+    """
+
+    def __init__(self, path: str, settings: dict | None = None) -> None:
+        self.path = path
+        self.settings = {**DEFAULT_HISTORY_SETTINGS, **(settings or {})}
+        self.stats = {"messages": 0, "batches": 0, "errors": 0, "compacted": 0}
+        self._queue = queue.Queue()
+        with contextlib.closing(self._connect()) as conn:
+            conn.executescript(_HISTORY_SCHEMA)
+        self._thread = threading.Thread(
+            target=self._write_loop, name="conversation-store", daemon=True
+        )
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        # 削除した領域を少しずつ解放できるよう、auto_vacuumを指定する。新しいファイルに最初の
+        # 書き込み（WALへの切り替えやテーブル作成）をする前でないと反映されない
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WALにすることで、書き込み中も読み込み（再開）を待たせない
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(
+        self,
+        session_id: str,
+        pane: str,
+        messages: list,
+        run_record: RunRecord | None = None,
+    ) -> None:
+        """
+        メッセージの保存を予約する（書き込みはバックグラウンドで行う）
+        Args:
+            session_id (str): 会話ID
+            pane (str): ペイン名（デュアルチャットの左右など）
+            messages (list): Gradioのmessages形式のメッセージ
+            run_record (RunRecord | None): このターンの実行記録（最後のメッセージに付ける）
+        """
+        now = time.time()
+        rows = []
+        for i, message in enumerate(messages):
+            compressed, payload = _encode_history_payload(
+                {"role": message["role"], "content": message["content"]}
+            )
+            record = None
+            if run_record is not None and i == len(messages) - 1:
+                record = zlib.compress(
+                    json.dumps(
+                        run_record.to_dict(),
+                        ensure_ascii=False,
+                        separators=(",", ":"),
+                        default=str,
+                    ).encode("utf-8")
+                )
+            rows.append((session_id, pane, now, compressed, payload, record))
+        self._queue.put(rows)
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        last_compacted = time.monotonic()
+        batch_size = int(self.settings["batch_size"])
+        while True:
+            # 待っている間に溜まった分はまとめて1トランザクションで書き込む
+            batch = [self._queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = _HISTORY_STOP in batch
+            rows = [row for item in batch if item is not _HISTORY_STOP for row in item]
+            try:
+                if rows:
+                    self._write(conn, rows)
+                interval = float(self.settings["compact_interval"])
+                if interval and time.monotonic() - last_compacted >= interval:
+                    last_compacted = time.monotonic()
+                    self._compact(conn)
+            except sqlite3.Error as e:
+                self.stats["errors"] += 1
+                logger.warning("会話履歴の保存に失敗しました: %s", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                conn.close()
+                return
+
+    def _write(self, conn: sqlite3.Connection, rows: list) -> None:
+        sessions = {}
+        for session_id, _, created_at, *_ in rows:
+            sessions[session_id] = created_at
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (session_id, pane, created_at, compressed, payload, run_record)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.executemany(
+                "INSERT INTO sessions (session_id, created_at, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at",
+                [(session_id, now, now) for session_id, now in sessions.items()],
+            )
+        self.stats["messages"] += len(rows)
+        self.stats["batches"] += 1
+
+    def _compact(self, conn: sqlite3.Connection) -> int:
+        deleted = 0
+        retention_days = float(self.settings["retention_days"])
+        max_messages = int(self.settings["max_messages_per_session"])
+        with conn:
+            if retention_days:
+                deleted += conn.execute(
+                    "DELETE FROM messages WHERE created_at < ?",
+                    (time.time() - retention_days * 86400,),
+                ).rowcount
+            if max_messages:
+                # ペインごとに新しいものからmax_messages件だけ残す
+                for session_id, pane in conn.execute(
+                    "SELECT session_id, pane FROM messages GROUP BY session_id, pane"
+                    " HAVING COUNT(*) > ?",
+                    (max_messages,),
+                ).fetchall():
+                    deleted += conn.execute(
+                        "DELETE FROM messages WHERE session_id = ? AND pane = ? AND id <="
+                        " (SELECT id FROM messages WHERE session_id = ? AND pane = ?"
+                        " ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (session_id, pane, session_id, pane, max_messages),
+                    ).rowcount
+            conn.execute(
+                "DELETE FROM sessions WHERE session_id NOT IN"
+                " (SELECT DISTINCT session_id FROM messages)"
+            )
+        if deleted:
+            # execute()では1ページずつしか解放されないため、executescript()で最後まで実行する
+            conn.executescript("PRAGMA incremental_vacuum;")
+        self.stats["compacted"] += deleted
+        return deleted
+
+    def flush(self) -> None:
+        """
+        予約済みのメッセージをすべて書き込み終えるまで待つ
+        """
+        self._queue.join()
+
+    def compact(self) -> int:
+        """
+        保存期間・件数の上限を超えた履歴を削除する（通常はcompact_intervalごとに自動で行う）
+        Returns:
+            int: 削除したメッセージ数
+        """
+        self.flush()
+        with contextlib.closing(self._connect()) as conn:
+            return self._compact(conn)
+
+    def load_recent(self, session_id: str, pane: str, limit: int | None = None) -> list:
+        """
+        会話の直近のメッセージを読み込む（再開用）
+        Args:
+            session_id (str): 会話ID
+            pane (str): ペイン名
+            limit (int | None): 読み込む件数（省略時はresume_messages）
+        Returns:
+            list: Gradioのmessages形式のメッセージ（古い順）
+        """
+        if limit is None:
+            limit = int(self.settings["resume_messages"])
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT compressed, payload FROM messages"
+                " WHERE session_id = ? AND pane = ? ORDER BY id DESC LIMIT ?",
+                (session_id, pane, limit),
+            ).fetchall()
+        messages = [_decode_history_payload(*row) for row in reversed(rows)]
+        # 途中から読み込んだ場合でも、ユーザーの発言から始まるようにする
+        while messages and messages[0]["role"] != "user":
+            messages.pop(0)
+        return messages
+
+    def close(self) -> None:
+        """
+        予約済みのメッセージを書き込んでから、書き込みスレッドを終了する
+        """
+        if self._thread.is_alive():
+            self._queue.put(_HISTORY_STOP)
+            self._thread.join()
+
+    def snapshot(self) -> dict:
+        return {"path": self.path, "pending": self._queue.qsize(), **self.stats}
+
+
+conversation_store = None
+
+
+def configure_conversation_store(config: dict) -> ConversationStore | None:
+    """
+    server_params.jsonのhistoryセクションを反映する関数（有効な場合のみ保存先を開く）
+    Args:
+        config (dict): 会話履歴の保存設定
+    Returns:
+        ConversationStore | None: 会話履歴の保存先（無効な場合はNone）
+    """
+    global conversation_store
+    settings = {**DEFAULT_HISTORY_SETTINGS, **(config or {})}
+    if conversation_store is not None:
+        conversation_store.close()
+        conversation_store = None
+    if settings["enabled"].lower() == "true":
+        conversation_store = ConversationStore(settings["path"], settings)
+        # 終了時に書き込み待ちのメッセージを失わないようにする
+        atexit.register(conversation_store.close)
+    return conversation_store
+
+
+register_metrics_provider(
+    "history",
+    lambda: conversation_store.snapshot() if conversation_store is not None else {},
+)
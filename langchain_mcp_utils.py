@@ -1,7 +1,53 @@
 import asyncio
 import json
+import logging
+import os
+import threading
+import time
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    ToolMessage,
+)
 from langchain_openai import ChatOpenAI
 
+from app_metrics import register_metrics_provider
+import mcp_http
+from mcp_http import (
+    HTTP_MCP_TRANSPORTS,
+    configure_mcp_http,
+    open_mcp_session,
+)
+from mcp_resilience import configure_server_options
+import mcp_supervisor
+from mcp_supervisor import (
+    resolve_servers,
+    configure_stdio_supervisor,
+)
+import llm_inprocess
+from llm_inprocess import configure_litellm
+import llm_cassette
+from llm_resilience import (
+    DEFAULT_LLM_RETRY,
+    llm_priority,
+    ResilientChatModel,
+)
+from doc_store import configure_doc_store
+from tool_results import configure_tool_results
+from run_records import (
+    ToolCallRecord,
+    StepRecord,
+    RunRecord,
+)
+from tool_catalog import (
+    compute_server_config_hash,
+    ToolCatalog,
+    register_builtin_tools,
+    apply_server_changes,
+)
+
+logger = logging.getLogger(__name__)
+
 
 def extract_answer(resp) -> str:
     """
@@ -83,16 +129,30 @@ def load_server_params(path: str) -> dict:
 
 
 # LLMを初期化する関数
-def initialize_llm(llm_name: str, base_url: str) -> ChatOpenAI:
+def initialize_llm(llm_name: str, base_url: str, **kwargs) -> ChatOpenAI:
     """
     LLMを初期化する関数
     Args:
         llm_name (str): LLMの名前
         base_url (str): LLMのベースURL
+        **kwargs: ChatOpenAIに渡す追加の引数（timeout, max_retriesなど）
     Returns:
         ChatOpenAI: 初期化されたChatOpenAIインスタンス
     """
-    return ChatOpenAI(model=llm_name, base_url=base_url)
+    # カセットの記録・再生中は、LLMへのHTTP通信をカセット経由にする
+    if llm_cassette.active_cassette is not None:
+        kwargs.setdefault("http_async_client", llm_cassette.active_cassette.http_client)
+    # in_processモードでは、LiteLLMプロキシを経由せずにプロセス内でLiteLLMを呼び出す
+    elif llm_inprocess.in_process_llm is not None:
+        kwargs.setdefault(
+            "http_async_client", llm_inprocess.in_process_llm.http_async_client
+        )
+        kwargs.setdefault("http_client", llm_inprocess.in_process_llm.http_client)
+    if llm_inprocess.in_process_llm is not None:
+        # プロキシに渡していたAPIキーは使わない（各モデルのキーはconfig.yamlで指定する）
+        kwargs.setdefault("api_key", "in-process")
+    return ChatOpenAI(model=llm_name, base_url=base_url, **kwargs)
+
 
 def get_llm_params(params: dict) -> tuple:
     """
@@ -179,6 +239,12 @@ def sync_get_available_tools(available_tools: list) -> str:
         return f"ツール一覧の取得中にエラーが発生しました: {type(e).__name__}: {str(e)}"
 
 
+def _get_tool_call_id(tool_call):
+    if isinstance(tool_call, dict):
+        return tool_call.get("id")
+    return getattr(tool_call, "id", None)
+
+
 def extract_tool_history(agent_response) -> list:
     """
     ツール履歴を抽出するヘルパー関数。
@@ -192,6 +258,15 @@ def extract_tool_history(agent_response) -> list:
         if "messages" in agent_response:
             messages_resp = agent_response["messages"]
             if isinstance(messages_resp, list):
+                # ToolMessageのartifactから、tool_call_idごとの実行時刻を集める
+                timings = {}
+                for msg in messages_resp:
+                    artifact = getattr(msg, "artifact", None)
+                    if isinstance(artifact, dict) and "started_at" in artifact:
+                        timings[getattr(msg, "tool_call_id", None)] = artifact
+                base_time = min(
+                    (timing["started_at"] for timing in timings.values()), default=0.0
+                )
                 for msg in messages_resp:
                     if hasattr(msg, "tool_calls") and msg.tool_calls:
                         for tool_call in msg.tool_calls:
@@ -211,9 +286,15 @@ def extract_tool_history(agent_response) -> list:
                                 # オブジェクト型のtool_call
                                 tool_name = getattr(tool_call, "name", str(tool_call))
                                 tool_args = getattr(tool_call, "args", {})
-                            tool_history.append(
-                                f"ツール名: {tool_name}, 引数: {tool_args}"
-                            )
+                            entry = f"ツール名: {tool_name}, 引数: {tool_args}"
+                            timing = timings.get(_get_tool_call_id(tool_call))
+                            if timing:
+                                # 最初のツール開始からの相対時刻で表示し、並行実行を見えるようにする
+                                entry += (
+                                    f", 開始: +{timing['started_at'] - base_time:.3f}秒"
+                                    f", 終了: +{timing['ended_at'] - base_time:.3f}秒"
+                                )
+                            tool_history.append(entry)
         if "tool_calls" in agent_response:
             calls = agent_response["tool_calls"]
             if calls:
@@ -223,3 +304,401 @@ def extract_tool_history(agent_response) -> list:
                     )
 
     return tool_history
+
+
+# 設定ファイル監視の既定の確認間隔（秒）
+DEFAULT_RELOAD_INTERVAL = 2.0
+
+
+def _diff_named_configs(old: dict, new: dict) -> tuple:
+    added = [name for name in new if name not in old]
+    removed = [name for name in old if name not in new]
+    changed = [
+        name
+        for name in new
+        if name in old
+        and compute_server_config_hash(old[name])
+        != compute_server_config_hash(new[name])
+    ]
+    return added, removed, changed
+
+
+def diff_server_params(old: dict, new: dict) -> dict:
+    """
+    2つのserver_params.jsonの内容を比較し、差分を返す関数
+    Args:
+        old (dict): 変更前の設定
+        new (dict): 変更後の設定
+    Returns:
+        dict: サーバー・LLMごとの追加/削除/変更と、その他に変更された設定キー
+    """
+    servers_added, servers_removed, servers_changed = _diff_named_configs(
+        old.get("servers", {}), new.get("servers", {})
+    )
+    llm_added, llm_removed, llm_changed = _diff_named_configs(
+        old.get("llm", {}), new.get("llm", {})
+    )
+    settings_changed = sorted(
+        key
+        for key in set(old) | set(new)
+        if key not in ("servers", "llm") and old.get(key) != new.get(key)
+    )
+    return {
+        "servers_added": servers_added,
+        "servers_removed": servers_removed,
+        "servers_changed": servers_changed,
+        "llm_added": llm_added,
+        "llm_removed": llm_removed,
+        "llm_changed": llm_changed,
+        "settings_changed": settings_changed,
+    }
+
+
+def has_server_params_changes(diff: dict) -> bool:
+    """
+    diff_server_paramsの結果に変更が含まれるかを判定する関数
+    Args:
+        diff (dict): diff_server_paramsの結果
+    Returns:
+        bool: 変更があればTrue
+    """
+    return any(diff.values())
+
+
+class ServerParamsWatcher:
+    """
+    server_params.jsonの変更を監視し、差分のみをアプリに反映するクラス。
+    変更のあったMCPサーバーだけツール一覧を取得し直し、ツールカタログを差し替える。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        params: dict,
+        catalog: ToolCatalog,
+        cache_path: str | None = None,
+        on_reload=None,
+        interval: float = DEFAULT_RELOAD_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.params = params
+        self.catalog = catalog
+        self.cache_path = cache_path
+        self.on_reload = on_reload
+        self.interval = interval
+        self._signature = self._stat()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self) -> dict | None:
+        """
+        設定ファイルを1回確認し、変更があれば反映する
+        Returns:
+            dict | None: 反映した差分（変更がなければNone）
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return None
+        self._signature = signature
+        # 書き込み途中などで読み込めない場合は、次の変更まで現在の設定を使い続ける
+        new_params = load_server_params(self.path)
+        if not new_params:
+            logger.warning(
+                "設定ファイル(%s)を読み込めないため、再読み込みをスキップします",
+                self.path,
+            )
+            return None
+        # ゲートウェイの設定も反映した、実際に接続するサーバー設定どうしで比較する
+        diff = diff_server_params(
+            {**self.params, "servers": resolve_servers(self.params)},
+            {**new_params, "servers": resolve_servers(new_params)},
+        )
+        if not has_server_params_changes(diff):
+            return None
+
+        if "server_options" in diff["settings_changed"]:
+            configure_server_options(new_params.get("server_options", {}))
+        if "tool_results" in diff["settings_changed"]:
+            configure_tool_results(new_params.get("tool_results", {}))
+        if "doc_store" in diff["settings_changed"]:
+            configure_doc_store(new_params.get("doc_store", {}))
+            register_builtin_tools(self.catalog)
+        if "litellm" in diff["settings_changed"]:
+            configure_litellm(new_params.get("litellm", {}))
+        if "mcp_http" in diff["settings_changed"]:
+            configure_mcp_http(new_params.get("mcp_http", {}))
+        configure_stdio_supervisor(
+            new_params.get("supervisor", {}),
+            resolve_servers(new_params),
+            new_params.get("server_options", {}),
+        )
+        asyncio.run(
+            apply_server_changes(
+                self.catalog, resolve_servers(new_params), diff, self.cache_path
+            )
+        )
+        self.params = new_params
+        logger.info("設定ファイルを再読み込みしました: %s", diff)
+        if self.on_reload is not None:
+            self.on_reload(new_params, diff)
+        return diff
+
+    def start(self) -> "ServerParamsWatcher":
+        """
+        バックグラウンドスレッドで監視を開始する
+        Returns:
+            ServerParamsWatcher: 自身
+        """
+
+        def run() -> None:
+            while not self._stop.wait(self.interval):
+                try:
+                    self.check()
+                except Exception as e:
+                    logger.exception(
+                        "設定ファイルの再読み込み中にエラーが発生しました: %s", e
+                    )
+
+        self._thread = threading.Thread(
+            target=run, name="server-params-watcher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        監視を停止する
+        """
+        self._stop.set()
+
+
+def build_chat_model(llm_name: str, llm_options: dict) -> ResilientChatModel:
+    """
+    llm_optionsのエントリから、リトライとフォールバックを備えたチャットモデルを構築する関数。
+    フォールバック先は各エントリの"fallbacks"に、llm_optionsのキーを順に指定する。
+    Args:
+        llm_name (str): 選択されたLLM名（llm_optionsのキー）
+        llm_options (dict): server_params.jsonのllmセクション
+    Returns:
+        ResilientChatModel: チャットモデル
+    """
+    llm_config = llm_options.get(llm_name, {})
+    if not isinstance(llm_config, dict):
+        # 古い形式: 文字列のbase_url
+        llm_config = {"base_url": llm_config}
+    names = [llm_name] + [
+        name
+        for name in llm_config.get("fallbacks", [])
+        if name != llm_name and name in llm_options
+    ]
+    backends = []
+    rate_limits = {}
+    for name in names:
+        config = llm_options.get(name, {})
+        if not isinstance(config, dict):
+            config = {"base_url": config}
+        if config.get("rate_limit"):
+            rate_limits[name] = config["rate_limit"]
+        kwargs = {"max_retries": 0}
+        if config.get("timeout"):
+            kwargs["timeout"] = float(config["timeout"])
+        backends.append(
+            (
+                name,
+                initialize_llm(
+                    config.get("model", "gpt-4o"), config.get("base_url", ""), **kwargs
+                ),
+            )
+        )
+    return ResilientChatModel(
+        backends=backends,
+        retry={**DEFAULT_LLM_RETRY, **llm_config.get("retry", {})},
+        rate_limits=rate_limits,
+    )
+
+
+def build_run_record(agent_response, budget_outcome: dict | None = None) -> RunRecord:
+    """
+    エージェント応答のメッセージを1回走査して、実行記録を作成する関数。
+    messagesを含まない応答は、extract_answerで回答のみを取り出す。
+    Args:
+        agent_response: エージェントから返された応答オブジェクト
+        budget_outcome (dict | None): run_agent_with_budgetが返した予算の結果
+    Returns:
+        RunRecord: 実行記録
+    """
+    record = RunRecord()
+    record.budget = budget_outcome
+    messages = (
+        agent_response.get("messages") if isinstance(agent_response, dict) else None
+    )
+    if not isinstance(messages, list):
+        record.answer = extract_answer(agent_response)
+        return record
+
+    # 以前のターンのメッセージを数えないよう、最後のユーザーの発言より後だけを走査する
+    start = 0
+    for i, msg in enumerate(messages):
+        if isinstance(msg, HumanMessage) or (
+            isinstance(msg, dict) and msg.get("type") == "human"
+        ):
+            start = i + 1
+
+    calls_by_id = {}
+    answer = None
+    for msg in messages[start:]:
+        if isinstance(msg, AIMessage):
+            answer = msg.content
+            metadata = msg.response_metadata or {}
+            step = StepRecord(
+                metadata.get("llm_backend", ""),
+                metadata.get("model_name", ""),
+                msg.usage_metadata,
+                metadata.get("llm_latency"),
+            )
+            step.tool_calls = len(msg.tool_calls)
+            record.steps.append(step)
+            for tool_call in msg.tool_calls:
+                call = ToolCallRecord(
+                    tool_call.get("id"),
+                    tool_call.get("name", "Unknown"),
+                    tool_call.get("args", {}),
+                )
+                call.llm_backend = step.llm_backend
+                record.tool_calls.append(call)
+                calls_by_id[call.call_id] = call
+        elif isinstance(msg, ToolMessage):
+            call = calls_by_id.get(msg.tool_call_id)
+            if call is None:
+                continue
+            call.result_chars = len(
+                msg.content if isinstance(msg.content, str) else str(msg.content)
+            )
+            call.is_error = msg.status == "error"
+            artifact = msg.artifact
+            if isinstance(artifact, dict) and "started_at" in artifact:
+                call.server = artifact.get("server", "")
+                call.started_at = artifact["started_at"]
+                call.ended_at = artifact["ended_at"]
+        elif isinstance(msg, dict) and msg.get("type") == "ai":
+            answer = msg.get("content", "")
+    record.answer = answer if answer is not None else extract_answer(agent_response)
+    return record
+
+
+# ウォームアップ1件あたりのタイムアウト（秒）
+DEFAULT_WARMUP_TIMEOUT = 60.0
+warmup_report = {}
+register_metrics_provider("warmup", lambda: warmup_report)
+
+
+async def _ping_llm(llm_name: str, llm_options: dict) -> None:
+    # リクエスト時と同じ設定でクライアントを作り、1トークンだけの補完で接続とプロキシを温める
+    _, backend = build_chat_model(llm_name, llm_options).backends[0]
+    await backend.ainvoke("ping", max_tokens=1)
+
+
+def _is_warmable(server_name: str, connection: dict) -> bool:
+    # 呼び出しごとに起動するstdioサーバーは、温めても以降のリクエストで使われないため対象外にする
+    if mcp_supervisor.stdio_supervisor.get(server_name) is not None:
+        return True
+    return (
+        connection.get("transport") in HTTP_MCP_TRANSPORTS
+        and mcp_http.mcp_http_pool.enabled
+    )
+
+
+async def _warm_mcp_server(server_name: str, connection: dict) -> None:
+    # リクエストが実際に使う接続を温める。常駐プロセスは共有セッションを開き、
+    # HTTPのサーバー（ゲートウェイ経由を含む）は共有プールの接続を確立してツール一覧の取得まで行う
+    server = mcp_supervisor.stdio_supervisor.get(server_name)
+    if server is not None:
+        await server.list_tools()
+        return
+    async with open_mcp_session(connection) as session:
+        await session.initialize()
+        await session.list_tools()
+
+
+async def _timed_warmup(coro, timeout: float) -> dict:
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(coro, timeout)
+        return {"ok": True, "seconds": round(time.perf_counter() - started, 3)}
+    except Exception as e:
+        return {
+            "ok": False,
+            "seconds": round(time.perf_counter() - started, 3),
+            "error": f"{type(e).__name__}: {e}",
+        }
+
+
+async def warm_up(
+    llm_options: dict, servers: dict, config: dict, prompt_runner=None
+) -> dict:
+    """
+    起動時のウォームアップを行う関数。
+    各LLMへのping補完とMCPセッションの初期化を並行して行い、その後ウォームアップ用プロンプトを順に実行する。
+    MCPは常駐プロセスの共有セッションと、共有プールを使うHTTPのサーバーのみを温める。
+    失敗しても起動は継続し、結果をメトリクスの"warmup"に記録する。
+    Args:
+        llm_options (dict): server_params.jsonのllmセクション
+        servers (dict): server_params.jsonのserversセクション
+        config (dict): server_params.jsonのwarmupセクション
+        prompt_runner: ウォームアップ用プロンプトを実行する非同期関数（引数はプロンプト文字列）
+    Returns:
+        dict: LLM・MCPサーバー・プロンプトごとの結果（ok, seconds, error）
+    """
+    timeout = float(config.get("timeout", DEFAULT_WARMUP_TIMEOUT))
+    jobs = []
+    if config.get("llm", "true").lower() == "true":
+        jobs += [("llm", name, _ping_llm(name, llm_options)) for name in llm_options]
+    if config.get("mcp", "true").lower() == "true":
+        jobs += [
+            ("mcp", name, _warm_mcp_server(name, conn))
+            for name, conn in servers.items()
+            if _is_warmable(name, conn)
+        ]
+    # ウォームアップのLLM呼び出しは、画面からのリクエストより後回しにする
+    with llm_priority("batch"):
+        results = await asyncio.gather(
+            *(_timed_warmup(job[2], timeout) for job in jobs)
+        )
+        report = {"llm": {}, "mcp": {}, "prompts": []}
+        for (kind, name, _), result in zip(jobs, results):
+            report[kind][name] = result
+        if prompt_runner is not None:
+            for prompt in config.get("prompts", []):
+                result = await _timed_warmup(prompt_runner(prompt), timeout)
+                report["prompts"].append({"prompt": prompt, **result})
+    warmup_report.clear()
+    warmup_report.update(report)
+    return report
+
+
+def summarize_warmup(report: dict) -> str:
+    """
+    ウォームアップ結果を起動ログ用の文字列にまとめる関数。
+    Args:
+        report (dict): warm_upの戻り値
+    Returns:
+        str: 表示用の文字列
+    """
+    lines = []
+    for kind, label in (("llm", "LLM"), ("mcp", "MCPサーバー")):
+        for name, result in report.get(kind, {}).items():
+            status = "OK" if result["ok"] else f"失敗 ({result['error']})"
+            lines.append(f"  {label} {name}: {status} {result['seconds']:.2f}秒")
+    for result in report.get("prompts", []):
+        status = "OK" if result["ok"] else f"失敗 ({result['error']})"
+        lines.append(
+            f"  プロンプト {result['prompt']!r}: {status} {result['seconds']:.2f}秒"
+        )
+    return "\n".join(lines)
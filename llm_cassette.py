@@ -0,0 +1,335 @@
+import asyncio
+import atexit
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import httpx
+from langchain_core.tools import ToolException
+from mcp.types import CallToolResult
+
+from app_metrics import register_metrics_provider
+import llm_inprocess
+
+
+# 記録・再生中のカセット（記録・再生していない場合はNone）
+active_cassette = None
+
+
+class CassetteMiss(LookupError):
+    """
+    再生中のカセットに、対応する記録がない場合の例外
+    """
+
+
+def _cassette_key(*parts) -> str:
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str).encode(
+            "utf-8"
+        )
+    ).hexdigest()[:32]
+
+
+def _canonical_body(body: bytes):
+    # JSONはキーの順序に依存しないよう、解釈してから照合に使う
+    try:
+        return json.loads(body)
+    except ValueError:
+        return base64.b64encode(body).decode("ascii")
+
+
+def _encode_chunk(offset: float, chunk: bytes) -> list:
+    try:
+        return [round(offset, 4), chunk.decode("utf-8")]
+    except UnicodeDecodeError:
+        return [round(offset, 4), base64.b64encode(chunk).decode("ascii"), "b64"]
+
+
+def _decode_chunk(entry: list) -> tuple:
+    offset, data, *encoding = entry
+    if encoding:
+        return offset, base64.b64decode(data)
+    return offset, data.encode("utf-8")
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    # 応答本体をそのまま中継しながら、チャンクとリクエスト開始からの経過時間を記録する
+    def __init__(self, stream, started: float, on_complete) -> None:
+        self.stream = stream
+        self.started = started
+        self.on_complete = on_complete
+        self.chunks = []
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.chunks.append(_encode_chunk(time.perf_counter() - self.started, chunk))
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+        if self.on_complete is not None:
+            self.on_complete(self.chunks)
+            self.on_complete = None
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    # 記録したチャンクを、記録時の経過時間（speed倍）に合わせて返す
+    def __init__(self, chunks: list, speed: float) -> None:
+        self.chunks = chunks
+        self.speed = speed
+
+    async def __aiter__(self):
+        started = time.perf_counter()
+        for entry in self.chunks:
+            offset, chunk = _decode_chunk(entry)
+            if self.speed:
+                delay = offset * self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    LLMへのHTTP通信をカセットに記録する（またはカセットから再生する）httpxのトランスポート。
+    """
+
+    def __init__(self, cassette, transport: httpx.AsyncBaseTransport | None = None):
+        self.cassette = cassette
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = _cassette_key(
+            "llm", request.method, request.url.path, _canonical_body(body)
+        )
+        if self.cassette.mode == "replay":
+            entry = self.cassette.take(key)
+            return httpx.Response(
+                entry["status"],
+                headers=entry["headers"],
+                stream=_ReplayStream(entry["chunks"], self.cassette.speed),
+                request=request,
+            )
+
+        if self.transport is None:
+            self.transport = httpx.AsyncHTTPTransport()
+        started = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+
+        def on_complete(chunks):
+            self.cassette.add(
+                {
+                    "kind": "llm",
+                    "key": key,
+                    "url": str(request.url.copy_with(query=None)),
+                    "status": response.status_code,
+                    "headers": [
+                        [name, value]
+                        for name, value in response.headers.multi_items()
+                        if name.lower() not in ("set-cookie", "date")
+                    ],
+                    "chunks": chunks,
+                }
+            )
+
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(response.stream, started, on_complete),
+            request=request,
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        if self.transport is not None:
+            await self.transport.aclose()
+
+
+class Cassette:
+    """
+    LLMとMCPツールの通信を1つのファイル（JSON Lines、.gzの場合はgzip圧縮）に記録・再生するクラス。
+    再生時は同じリクエストに記録順で応答し、記録時の待ち時間を再現する（speed=0の場合は待たない）。
+    同じ通信で処理の変更前後を比べることで、ネットワークに左右されずに性能を測定できる。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str,
+        speed: float = 1.0,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"カセットのモードが不正です: {mode}")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.tools = {}
+        self.entries = []
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0}
+        self._by_key = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._http_client = None
+        # 記録時に実際の通信に使うトランスポート（Noneの場合はhttpxの既定）
+        self._transport = transport
+        if mode == "replay":
+            self._load()
+
+    def _open(self, mode: str):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _load(self) -> None:
+        with self._open("r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["kind"] == "tools":
+                    self.tools[entry["server"]] = entry["definitions"]
+                else:
+                    self._by_key.setdefault(entry["key"], []).append(entry)
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """
+        LLMのクライアントに渡すhttpxクライアント（カセット経由で通信する）
+        """
+        if self._http_client is None:
+            # in_processモードの場合は、記録時もプロセス内のLiteLLMを呼び出す
+            transport = self._transport
+            if transport is None and llm_inprocess.in_process_llm is not None:
+                transport = llm_inprocess.in_process_llm.transport
+            self._http_client = httpx.AsyncClient(
+                transport=CassetteTransport(self, transport)
+            )
+        return self._http_client
+
+    def add(self, entry: dict) -> None:
+        with self._lock:
+            self.entries.append(entry)
+            self.stats["recorded"] += 1
+
+    def add_tools(self, definitions_by_server: dict) -> None:
+        """
+        再生時にMCPサーバーなしでツールを登録できるよう、ツール定義を記録する
+        Args:
+            definitions_by_server (dict): サーバー名とツール定義のリストの辞書
+        """
+        if self.mode == "record":
+            self.tools.update(definitions_by_server)
+
+    def take(self, key: str) -> dict:
+        """
+        再生する記録を取り出す（同じリクエストには記録順に応答し、使い切ったら最初から繰り返す）
+        Args:
+            key (str): リクエストのキー
+        Returns:
+            dict: 記録
+        """
+        with self._lock:
+            entries = self._by_key.get(key)
+            if not entries:
+                self.stats["misses"] += 1
+                raise CassetteMiss(f"カセットに記録がないリクエストです: {key}")
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            self.stats["replayed"] += 1
+            return entries[position % len(entries)]
+
+    async def call_tool(self, server_name: str, name: str, arguments, call):
+        """
+        ツール呼び出しを記録する（または記録から返す）
+        Args:
+            server_name (str): サーバー名
+            name (str): ツール名
+            arguments (dict | None): ツールの引数
+            call: 実際にツールを呼び出すコルーチン関数
+        Returns:
+            CallToolResult: ツールの実行結果
+        """
+        key = _cassette_key("mcp", server_name, name, arguments or {})
+        if self.mode == "replay":
+            entry = self.take(key)
+            if self.speed:
+                await asyncio.sleep(entry["latency"] * self.speed)
+            if "error" in entry:
+                raise ToolException(entry["error"])
+            return CallToolResult.model_validate(entry["result"])
+
+        started = time.perf_counter()
+        entry = {"kind": "mcp", "key": key, "server": server_name, "tool": name}
+        try:
+            result = await call(name, arguments)
+        except Exception as e:
+            entry.update(latency=round(time.perf_counter() - started, 4), error=str(e))
+            self.add(entry)
+            raise
+        entry.update(
+            latency=round(time.perf_counter() - started, 4),
+            result=result.model_dump(mode="json", by_alias=True, exclude_none=True),
+        )
+        self.add(entry)
+        return result
+
+    def save(self) -> None:
+        """
+        記録したツール定義と通信をファイルに書き出す（記録モードのみ）
+        """
+        if self.mode != "record":
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            entries = [
+                {"kind": "tools", "server": server, "definitions": definitions}
+                for server, definitions in self.tools.items()
+            ] + self.entries
+        with self._open("w") as f:
+            for entry in entries:
+                f.write(
+                    json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+                )
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"mode": self.mode, "path": self.path, **self.stats}
+
+
+def configure_cassette(config: dict) -> Cassette | None:
+    """
+    server_params.jsonのcassetteセクションを反映する関数
+    Args:
+        config (dict): カセットの設定
+            mode: "off", "record", "replay", path: カセットのファイル,
+            latency: 再生時の待ち時間（"original": 記録時のまま, "none": 待たない）
+    Returns:
+        Cassette | None: 記録・再生中のカセット（"off"の場合はNone）
+    """
+    global active_cassette
+    config = config or {}
+    mode = config.get("mode", "off")
+    if mode == "off":
+        active_cassette = None
+        return None
+    active_cassette = Cassette(
+        config.get("path", "cassettes/session.jsonl.gz"),
+        mode,
+        speed=0.0 if config.get("latency", "original") == "none" else 1.0,
+    )
+    # 記録したカセットは終了時に書き出す
+    atexit.register(active_cassette.save)
+    return active_cassette
+
+
+register_metrics_provider(
+    "cassette",
+    lambda: active_cassette.snapshot() if active_cassette is not None else {},
+)
@@ -0,0 +1,183 @@
+import json
+import logging
+import httpx
+
+try:
+    import litellm
+except ImportError:  # litellmがない場合は、LiteLLMプロキシ経由でのみLLMを呼び出せる
+    litellm = None
+import yaml
+
+from app_metrics import register_metrics_provider
+
+logger = logging.getLogger(__name__)
+
+
+# LiteLLMの呼び出し方法の既定値（server_params.jsonのlitellmセクションで上書きする）
+DEFAULT_LITELLM_SETTINGS = {"mode": "proxy", "config": "config.yaml"}
+
+# in_processモードでLLMを呼び出すゲートウェイ（proxyモードの場合はNone）
+in_process_llm = None
+
+
+def _litellm_error_response(error: Exception) -> httpx.Response:
+    # LiteLLMの例外を、OpenAIのクライアントがリトライ・フォールバックを判断できるHTTPエラーに変換する
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int) or status < 400:
+        status = 500
+    return httpx.Response(
+        status,
+        json={"error": {"message": str(error), "type": type(error).__name__}},
+    )
+
+
+def _dump_litellm_chunk(chunk) -> bytes:
+    data = chunk.model_dump_json() if hasattr(chunk, "model_dump_json") else chunk
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"data: {data}\n\n".encode("utf-8")
+
+
+class _LiteLLMStream(httpx.AsyncByteStream):
+    # LiteLLMのストリーミング応答を、OpenAI互換のServer-Sent Eventsとして返す
+    def __init__(self, response) -> None:
+        self.response = response
+
+    async def __aiter__(self):
+        async for chunk in self.response:
+            yield _dump_litellm_chunk(chunk)
+        yield b"data: [DONE]\n\n"
+
+
+class _LiteLLMSyncStream(httpx.SyncByteStream):
+    def __init__(self, response) -> None:
+        self.response = response
+
+    def __iter__(self):
+        for chunk in self.response:
+            yield _dump_litellm_chunk(chunk)
+        yield b"data: [DONE]\n\n"
+
+
+class LiteLLMTransport(httpx.AsyncBaseTransport, httpx.BaseTransport):
+    """
+    OpenAI互換のchat/completionsリクエストを、プロセス内のLiteLLM Routerで処理するhttpxのトランスポート。
+    ChatOpenAIからはLiteLLMプロキシと同じように見えるため、ローカルのHTTP通信と別プロセスが不要になる。
+    """
+
+    def __init__(self, router) -> None:
+        self.router = router
+
+    @staticmethod
+    def _parse(request: httpx.Request) -> dict | None:
+        if not request.url.path.endswith("/chat/completions"):
+            return None
+        return json.loads(request.content)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        body = self._parse(request)
+        if body is None:
+            return httpx.Response(404, json={"error": {"message": "not found"}})
+        try:
+            response = await self.router.acompletion(**body)
+        except Exception as e:
+            return _litellm_error_response(e)
+        if body.get("stream"):
+            return httpx.Response(
+                200,
+                headers={"content-type": "text/event-stream"},
+                stream=_LiteLLMStream(response),
+            )
+        return httpx.Response(
+            200,
+            content=response.model_dump_json(),
+            headers={"content-type": "application/json"},
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        body = self._parse(request)
+        if body is None:
+            return httpx.Response(404, json={"error": {"message": "not found"}})
+        try:
+            response = self.router.completion(**body)
+        except Exception as e:
+            return _litellm_error_response(e)
+        if body.get("stream"):
+            return httpx.Response(
+                200,
+                headers={"content-type": "text/event-stream"},
+                stream=_LiteLLMSyncStream(response),
+            )
+        return httpx.Response(
+            200,
+            content=response.model_dump_json(),
+            headers={"content-type": "application/json"},
+        )
+
+
+class InProcessLLM:
+    """
+    config.yamlのmodel_listをプロセス内のLiteLLM Routerに読み込み、
+    すべてのLLMで共有するhttpxクライアントを提供するクラス。
+    model_nameによるモデルの別名（エイリアス）はLiteLLMプロキシと同じように解決される。
+    """
+
+    def __init__(self, model_list: list, router=None) -> None:
+        if router is None:
+            if litellm is None:
+                raise RuntimeError(
+                    "litellmがインストールされていないため、in_processモードは使えません"
+                )
+            router = litellm.Router(model_list=model_list)
+        self.model_names = [entry["model_name"] for entry in model_list]
+        self.transport = LiteLLMTransport(router)
+        # base_urlはChatOpenAIの設定のまま使う（リクエストはトランスポートで処理し、送信しない）
+        self.http_async_client = httpx.AsyncClient(transport=self.transport)
+        self.http_client = httpx.Client(transport=self.transport)
+
+    def snapshot(self) -> dict:
+        return {"mode": "in_process", "models": self.model_names}
+
+
+def load_litellm_model_list(path: str) -> list:
+    """
+    LiteLLMプロキシの設定ファイル（config.yaml）からmodel_listを読み込む関数
+    Args:
+        path (str): 設定ファイルのパス
+    Returns:
+        list: model_list
+    """
+    with open(path, encoding="utf-8") as f:
+        return (yaml.safe_load(f) or {}).get("model_list", [])
+
+
+def configure_litellm(config: dict) -> InProcessLLM | None:
+    """
+    server_params.jsonのlitellmセクションを反映する関数
+    Args:
+        config (dict): LiteLLMの呼び出し方法の設定
+            mode: "proxy"（LiteLLMプロキシ経由） または "in_process"（プロセス内で呼び出す）,
+            config: in_processモードで読み込むLiteLLMの設定ファイル
+    Returns:
+        InProcessLLM | None: in_processモードの場合はゲートウェイ、proxyモードの場合はNone
+    """
+    global in_process_llm
+    settings = {**DEFAULT_LITELLM_SETTINGS, **(config or {})}
+    if settings["mode"] != "in_process":
+        in_process_llm = None
+        return None
+    in_process_llm = InProcessLLM(load_litellm_model_list(settings["config"]))
+    logger.info(
+        "LiteLLMをプロセス内で呼び出します: %s", ", ".join(in_process_llm.model_names)
+    )
+    return in_process_llm
+
+
+register_metrics_provider(
+    "litellm",
+    lambda: (
+        in_process_llm.snapshot() if in_process_llm is not None else {"mode": "proxy"}
+    ),
+)
@@ -0,0 +1,73 @@
+import textwrap
+
+
+# 既定のシステムプロンプト。プロバイダーのプロンプトキャッシュはプロンプトの先頭が完全に一致する場合のみ
+# 効くため、すべての画面・LLMで同じ文字列を使う
+DEFAULT_SYSTEM_PROMPT = """あなたは親切で知識豊富なAIアシスタントです。ユーザーの質問に対して、正確で分かりやすい回答を提供してください。
+なお、回答にあたり、以下のルールを守ってください。
+1. 回答は日本語で行ってください。
+2. 回答は簡潔で明確にしてください。
+3. ツール呼び出しが有効な場合は、ツールを利用してください。
+4. ユーザーの意図を理解しかねる場合は、追加の情報を求めてください。"""
+
+
+def normalize_system_prompt(text: str) -> str:
+    """
+    システムプロンプトのインデント・行末の空白・改行コード・前後の空行を取り除く関数
+    Args:
+        text (str): システムプロンプト
+    Returns:
+        str: 正規化したシステムプロンプト
+    """
+    lines = textwrap.dedent(text.replace("\r\n", "\n")).split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def build_prompt_messages(system_prompt: str, history: list, user_input: str) -> list:
+    """
+    エージェントに渡すメッセージを組み立てる関数。
+    正規化したシステムプロンプトを先頭に置き、その後に会話履歴と今回の入力を続けることで、
+    ターンをまたいでプロンプトの先頭が変わらず、プロバイダーのプロンプトキャッシュが効くようにする。
+    Args:
+        system_prompt (str): システムプロンプト（空の場合は付けない）
+        history (list): Gradioの履歴（messages形式）
+        user_input (str): ユーザーの入力テキスト
+    Returns:
+        list: LangChainのメッセージ（type, contentの辞書）のリスト
+    """
+    messages = []
+    system_prompt = normalize_system_prompt(system_prompt)
+    if system_prompt:
+        messages.append({"type": "system", "content": system_prompt})
+    for msg in history or []:
+        if msg.get("role") == "user":
+            messages.append({"type": "human", "content": msg["content"]})
+        elif msg.get("role") == "assistant":
+            messages.append({"type": "ai", "content": msg["content"]})
+    messages.append({"type": "human", "content": user_input})
+    return messages
+
+
+def _sort_schema_keys(value):
+    if isinstance(value, dict):
+        return {key: _sort_schema_keys(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [_sort_schema_keys(item) for item in value]
+    return value
+
+
+def canonical_tool_specs(tool_specs: list) -> list:
+    """
+    OpenAI形式のツール定義を名前順に並べ、スキーマのキーも並べ替える関数。
+    サーバーの起動順や設定の再読み込みに関係なく、毎回同じ内容でLLMに送るために使う。
+    Args:
+        tool_specs (list): OpenAI形式のツール定義のリスト
+    Returns:
+        list: 並べ替えたツール定義のリスト
+    """
+    return sorted(
+        (_sort_schema_keys(spec) for spec in tool_specs),
+        key=lambda spec: (
+            (spec.get("function") or {}).get("name") or spec.get("name", "")
+        ),
+    )
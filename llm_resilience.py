@@ -0,0 +1,530 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+import httpx
+import openai
+from langchain_core.language_models import BaseChatModel
+from pydantic import (
+    ConfigDict,
+    Field,
+)
+
+from app_metrics import register_metrics_provider
+from llm_prompt import canonical_tool_specs
+
+logger = logging.getLogger(__name__)
+
+
+# LLM呼び出しのリトライ設定の既定値
+DEFAULT_LLM_RETRY = {
+    "max_attempts": 2,
+    "initial_delay": 0.5,
+    "max_delay": 8.0,
+    "jitter": 0.5,
+}
+# 連続失敗がこの回数に達したバックエンドは、cooldown_seconds秒間は後回しにする
+DEFAULT_LLM_DEGRADE_AFTER = 3
+DEFAULT_LLM_COOLDOWN_SECONDS = 60.0
+
+# リトライしても安全な（リクエストが処理されていない、または一時的な）失敗の種類
+RETRYABLE_LLM_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+    httpx.TransportError,
+)
+
+
+class BackendHealth:
+    """
+    LLMバックエンドごとの直近の成功・失敗と応答時間を記録するクラス。
+    連続して失敗したバックエンドを一定時間「劣化」とみなし、フォールバック先を先に使う。
+    """
+
+    def __init__(
+        self,
+        degrade_after: int = DEFAULT_LLM_DEGRADE_AFTER,
+        cooldown_seconds: float = DEFAULT_LLM_COOLDOWN_SECONDS,
+    ) -> None:
+        self.degrade_after = degrade_after
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._backends = {}
+
+    def _entry(self, name: str) -> dict:
+        return self._backends.setdefault(
+            name,
+            {
+                "successes": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "degraded_until": 0.0,
+                "latency_ewma": None,
+            },
+        )
+
+    def record_success(self, name: str, latency: float) -> None:
+        """
+        成功した呼び出しを記録する
+        Args:
+            name (str): バックエンド名（llm_optionsのキー）
+            latency (float): 応答時間（秒）
+        """
+        with self._lock:
+            entry = self._entry(name)
+            entry["successes"] += 1
+            entry["consecutive_failures"] = 0
+            entry["degraded_until"] = 0.0
+            previous = entry["latency_ewma"]
+            entry["latency_ewma"] = (
+                latency if previous is None else previous * 0.8 + latency * 0.2
+            )
+
+    def record_failure(self, name: str) -> None:
+        """
+        失敗した呼び出しを記録する
+        Args:
+            name (str): バックエンド名
+        """
+        with self._lock:
+            entry = self._entry(name)
+            entry["failures"] += 1
+            entry["consecutive_failures"] += 1
+            if entry["consecutive_failures"] >= self.degrade_after:
+                entry["degraded_until"] = time.monotonic() + self.cooldown_seconds
+
+    def is_degraded(self, name: str) -> bool:
+        """
+        バックエンドが劣化中かを判定する
+        Args:
+            name (str): バックエンド名
+        Returns:
+            bool: 劣化中の場合はTrue
+        """
+        with self._lock:
+            entry = self._backends.get(name)
+            return bool(entry) and entry["degraded_until"] > time.monotonic()
+
+    def snapshot(self) -> dict:
+        """
+        全バックエンドの状態を返す
+        Returns:
+            dict: バックエンド名をキーとした状態
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                name: {
+                    "successes": entry["successes"],
+                    "failures": entry["failures"],
+                    "consecutive_failures": entry["consecutive_failures"],
+                    "degraded": entry["degraded_until"] > now,
+                    "latency_ewma": entry["latency_ewma"],
+                }
+                for name, entry in self._backends.items()
+            }
+
+
+# プロセス全体で共有するLLMバックエンドの状態
+llm_health = BackendHealth()
+register_metrics_provider("llm_backends", llm_health.snapshot)
+
+
+def compute_retry_delay(attempt: int, retry: dict) -> float:
+    """
+    リトライ前の待ち時間を計算する関数（上限付き指数バックオフ＋ジッター）
+    Args:
+        attempt (int): 失敗した試行の回数（1始まり）
+        retry (dict): リトライ設定
+    Returns:
+        float: 待ち時間（秒）
+    """
+    delay = min(
+        float(retry["max_delay"]), float(retry["initial_delay"]) * 2 ** (attempt - 1)
+    )
+    jitter = float(retry["jitter"])
+    return delay * random.uniform(1.0 - jitter, 1.0)
+
+
+# LLM呼び出しの優先度（値が小さいほど先に送る）。画面からの対話的なリクエストを、
+# ウォームアップなどのバッチ的なリクエストより先に送る
+LLM_PRIORITIES = {"interactive": 0, "batch": 1}
+_llm_priority = contextvars.ContextVar("llm_priority", default="interactive")
+# レート制限の既定値（llm_optionsの各エントリのrate_limitで上書きする）
+DEFAULT_LLM_RATE_LIMIT = {
+    "requests_per_minute": 0,
+    "tokens_per_minute": 0,
+    # 応答のトークン数の見積もり（実際の使用量が分かった時点で差分を精算する）
+    "estimated_output_tokens": 512,
+}
+# 待機中のリクエストが順番を確認する間隔（秒）
+_RATE_LIMIT_POLL_INTERVAL = 0.05
+
+
+@contextlib.contextmanager
+def llm_priority(priority: str):
+    """
+    ブロック内（およびそこから作成したタスク）のLLM呼び出しの優先度を設定するコンテキストマネージャ
+    Args:
+        priority (str): "interactive" または "batch"
+    """
+    if priority not in LLM_PRIORITIES:
+        raise ValueError(f"LLMの優先度が不正です: {priority}")
+    token = _llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        _llm_priority.reset(token)
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    """
+    メッセージのトークン数を文字数から見積もる関数（日本語を考慮して多めに見積もる）
+    Args:
+        messages (list): LangChainのメッセージのリスト
+    Returns:
+        int: 見積もったトークン数
+    """
+    chars = 0
+    for message in messages:
+        content = message.content
+        chars += len(content if isinstance(content, str) else json.dumps(content))
+        chars += len(json.dumps(getattr(message, "tool_calls", None) or []))
+    return chars // 2 + 4 * len(messages)
+
+
+class TokenBucket:
+    """
+    1分あたりの上限（rate_per_minute）まで貯まり、その速度で回復するトークンバケット。
+    使用量の精算で一時的にマイナスになった場合は、回復するまで次の取得を待たせる。
+    """
+
+    def __init__(self, rate_per_minute: float) -> None:
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        amountを取得できるまでの待ち時間（秒）を返す（上限のないバケットは常に0）
+        """
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float) -> None:
+        if self.capacity > 0:
+            self._refill()
+            self.level -= amount
+
+    def headroom(self) -> float | None:
+        if self.capacity <= 0:
+            return None
+        self._refill()
+        return round(self.level, 1)
+
+
+class LLMRateLimiter:
+    """
+    1つのLLMバックエンドのリクエスト数・トークン数のレート制限。
+    上限に達した場合は、優先度順（同じ優先度は到着順）に空きができるまで待たせてから送る。
+    """
+
+    def __init__(self, config: dict) -> None:
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._sequence = 0
+        self.stats = {"acquired": 0, "throttled": 0, "waited_seconds": 0.0}
+        self.configure(config)
+
+    def configure(self, config: dict) -> None:
+        config = {**DEFAULT_LLM_RATE_LIMIT, **(config or {})}
+        with self._lock:
+            self.config = config
+            self.requests = TokenBucket(float(config["requests_per_minute"]))
+            self.tokens = TokenBucket(float(config["tokens_per_minute"]))
+
+    def _try_acquire(self, ticket: tuple, tokens: int) -> float:
+        # 先頭の待機者のみ取得でき、それ以外は先頭が取得するまで待つ
+        with self._lock:
+            if self._waiters[0] != ticket:
+                return _RATE_LIMIT_POLL_INTERVAL
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                return wait
+            heapq.heappop(self._waiters)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            self.stats["acquired"] += 1
+            return 0.0
+
+    def _enqueue(self) -> tuple:
+        with self._lock:
+            self._sequence += 1
+            ticket = (LLM_PRIORITIES[_llm_priority.get()], self._sequence)
+            heapq.heappush(self._waiters, ticket)
+            return ticket
+
+    def _dequeue(self, ticket: tuple) -> None:
+        with self._lock:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+
+    def _record_wait(self, waited: float) -> None:
+        if waited > 0:
+            with self._lock:
+                self.stats["throttled"] += 1
+                self.stats["waited_seconds"] += waited
+
+    async def acquire(self, tokens: int) -> float:
+        """
+        リクエスト1件とtokensトークン分の空きができるまで待つ
+        Args:
+            tokens (int): 見積もったトークン数
+        Returns:
+            float: 待った時間（秒）
+        """
+        started = time.perf_counter()
+        ticket = self._enqueue()
+        try:
+            while wait := self._try_acquire(ticket, tokens):
+                await asyncio.sleep(min(wait, 1.0))
+        except BaseException:
+            self._dequeue(ticket)
+            raise
+        waited = time.perf_counter() - started
+        self._record_wait(waited)
+        return waited
+
+    def acquire_sync(self, tokens: int) -> float:
+        """
+        acquireの同期版
+        """
+        started = time.perf_counter()
+        ticket = self._enqueue()
+        try:
+            while wait := self._try_acquire(ticket, tokens):
+                time.sleep(min(wait, 1.0))
+        except BaseException:
+            self._dequeue(ticket)
+            raise
+        waited = time.perf_counter() - started
+        self._record_wait(waited)
+        return waited
+
+    def settle(self, estimated: int, actual: int | None) -> None:
+        """
+        見積もったトークン数と実際の使用量の差分を精算する
+        Args:
+            estimated (int): acquireで見積もったトークン数
+            actual (int | None): 実際の使用量（不明な場合は精算しない）
+        """
+        if actual is None:
+            return
+        with self._lock:
+            self.tokens.consume(actual - estimated)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests_per_minute": self.requests.capacity,
+                "tokens_per_minute": self.tokens.capacity,
+                "requests_headroom": self.requests.headroom(),
+                "tokens_headroom": self.tokens.headroom(),
+                "waiting": len(self._waiters),
+                **self.stats,
+                "waited_seconds": round(self.stats["waited_seconds"], 3),
+            }
+
+
+class LLMRateLimits:
+    """
+    LLMバックエンドごとのレート制限（rate_limitを設定したバックエンドのみ）を保持するクラス
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def get(self, name: str, config: dict | None) -> LLMRateLimiter | None:
+        """
+        バックエンドのレート制限を返す（設定が変わった場合は作り直す）
+        Args:
+            name (str): バックエンド名
+            config (dict | None): llm_optionsのエントリのrate_limit
+        Returns:
+            LLMRateLimiter | None: レート制限（設定がない場合はNone）
+        """
+        if not config:
+            return None
+        with self._lock:
+            limiter = self._limiters.get(name)
+            if limiter is None:
+                limiter = self._limiters[name] = LLMRateLimiter(config)
+            elif limiter.config != {**DEFAULT_LLM_RATE_LIMIT, **config}:
+                limiter.configure(config)
+            return limiter
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {name: limiter.snapshot() for name, limiter in limiters.items()}
+
+
+# プロセス全体で共有するLLMバックエンドごとのレート制限
+llm_rate_limits = LLMRateLimits()
+register_metrics_provider("rate_limits", llm_rate_limits.snapshot)
+
+
+def _reserve_tokens(limiter: LLMRateLimiter, messages: list) -> int:
+    return estimate_prompt_tokens(messages) + int(
+        limiter.config["estimated_output_tokens"]
+    )
+
+
+def _used_tokens(result) -> int | None:
+    usage = getattr(result.generations[0].message, "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+
+def _tag_llm_backend(result, name: str, latency: float | None = None):
+    # 実際に応答したバックエンド名と所要時間（リトライを含む）を、実行記録から参照できるようメッセージにも残す
+    result.llm_output = {**(result.llm_output or {}), "llm_backend": name}
+    for generation in result.generations:
+        generation.message.response_metadata["llm_backend"] = name
+        if latency is not None:
+            generation.message.response_metadata["llm_latency"] = latency
+    return result
+
+
+class ResilientChatModel(BaseChatModel):
+    """
+    llm_optionsの1エントリと、そのフォールバック先のLLMをまとめたチャットモデル。
+    エージェントの各LLMステップで、一時的な失敗はバックオフ付きでリトライし、
+    それでも失敗した場合や劣化中のバックエンドは、次のフォールバック先に切り替える。
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    backends: list = Field(default_factory=list)
+    """(バックエンド名, ChatOpenAI) のリスト（先頭が優先）"""
+    retry: dict = Field(default_factory=lambda: dict(DEFAULT_LLM_RETRY))
+    rate_limits: dict = Field(default_factory=dict)
+    """バックエンド名とrate_limitの設定の辞書（設定がないバックエンドは制限しない）"""
+
+    @property
+    def _llm_type(self) -> str:
+        return "resilient-chat"
+
+    @property
+    def model_name(self) -> str:
+        return self.backends[0][1].model_name if self.backends else ""
+
+    def bind_tools(self, tools, **kwargs):
+        """
+        ツールをOpenAI形式に変換してバインドする（変換は先頭のバックエンドに委ねる）。
+        プロンプトキャッシュが効くよう、ツールは名前順・スキーマはキー順に並べ、毎回同じ内容で送る。
+        """
+        bound = self.backends[0][1].bind_tools(tools, **kwargs)
+        bound_kwargs = dict(bound.kwargs)
+        if bound_kwargs.get("tools"):
+            bound_kwargs["tools"] = canonical_tool_specs(bound_kwargs["tools"])
+        return self.bind(**bound_kwargs)
+
+    def _ordered_backends(self) -> list:
+        healthy = [b for b in self.backends if not llm_health.is_degraded(b[0])]
+        degraded = [b for b in self.backends if llm_health.is_degraded(b[0])]
+        # 劣化中のバックエンドは、他がすべて失敗した場合の最後の手段として使う
+        return healthy + degraded
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        last_error = None
+        step_started = time.perf_counter()
+        for name, backend in self._ordered_backends():
+            limiter = llm_rate_limits.get(name, self.rate_limits.get(name))
+            for attempt in range(1, int(self.retry["max_attempts"]) + 1):
+                # 上限を超えて429で失敗しないよう、空きができるまで優先度順に待ってから送る
+                if limiter is not None:
+                    reserved = _reserve_tokens(limiter, messages)
+                    await limiter.acquire(reserved)
+                started = time.perf_counter()
+                used = 0
+                try:
+                    result = await backend._agenerate(messages, stop=stop, **kwargs)
+                    used = _used_tokens(result)
+                except Exception as e:
+                    # 400などのリクエスト自体の誤りはバックエンドの不調ではないため、劣化の判定に数えない
+                    if isinstance(e, RETRYABLE_LLM_ERRORS):
+                        llm_health.record_failure(name)
+                    last_error = e
+                    logger.warning(
+                        "LLM呼び出しに失敗しました (%s, %d回目): %s",
+                        name,
+                        attempt,
+                        e,
+                        extra={"llm_backend": name, "attempt": attempt},
+                    )
+                    # 一時的な失敗のみ同じバックエンドでリトライし、それ以外は次へ切り替える
+                    if not isinstance(e, RETRYABLE_LLM_ERRORS):
+                        break
+                    if attempt < int(self.retry["max_attempts"]):
+                        await asyncio.sleep(compute_retry_delay(attempt, self.retry))
+                    continue
+                finally:
+                    # 失敗した試行の見積もり分は返却し、成功した場合は実際の使用量で精算する
+                    if limiter is not None:
+                        limiter.settle(reserved, used)
+                llm_health.record_success(name, time.perf_counter() - started)
+                return _tag_llm_backend(
+                    result, name, time.perf_counter() - step_started
+                )
+        raise last_error
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        last_error = None
+        step_started = time.perf_counter()
+        for name, backend in self._ordered_backends():
+            limiter = llm_rate_limits.get(name, self.rate_limits.get(name))
+            for attempt in range(1, int(self.retry["max_attempts"]) + 1):
+                if limiter is not None:
+                    reserved = _reserve_tokens(limiter, messages)
+                    limiter.acquire_sync(reserved)
+                started = time.perf_counter()
+                used = 0
+                try:
+                    result = backend._generate(messages, stop=stop, **kwargs)
+                    used = _used_tokens(result)
+                except Exception as e:
+                    if isinstance(e, RETRYABLE_LLM_ERRORS):
+                        llm_health.record_failure(name)
+                    last_error = e
+                    if not isinstance(e, RETRYABLE_LLM_ERRORS):
+                        break
+                    if attempt < int(self.retry["max_attempts"]):
+                        time.sleep(compute_retry_delay(attempt, self.retry))
+                    continue
+                finally:
+                    if limiter is not None:
+                        limiter.settle(reserved, used)
+                llm_health.record_success(name, time.perf_counter() - started)
+                return _tag_llm_backend(
+                    result, name, time.perf_counter() - step_started
+                )
+        raise last_error
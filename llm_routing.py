@@ -0,0 +1,216 @@
+import collections
+import math
+import re
+import threading
+
+from app_metrics import register_metrics_provider
+import llm_resilience
+
+
+# LLM選択プルダウンで自動選択を表す項目
+AUTO_LLM_OPTION = "自動"
+# 自動選択の既定値
+DEFAULT_ROUTER_SETTINGS = {
+    "enabled": "false",
+    # 簡単なターンを任せる軽量・高速なLLMと、それ以外を任せるLLM（llm_optionsのキー、先頭ほど優先）
+    "light": [],
+    "heavy": [],
+    # この文字数以下・この会話の深さ（これまでのユーザー発言数）以下なら軽量LLMの候補にする
+    "max_light_chars": 200,
+    "max_light_turns": 4,
+    # ツールとの関連度がこの値以上ならツールが必要とみなし、軽量LLMを使わない
+    "tool_score_threshold": 0.35,
+    # 直近の失敗率がこの値を超えるLLMは、他に候補がある限り選ばない
+    "max_error_rate": 0.5,
+}
+# 読点や括弧などは語として扱わない
+_TERM_PATTERN = re.compile(r"[a-z0-9]+|[^\x00-\x7f\s、。，．・！？「」『』（）【】：]+")
+
+
+def tokenize_terms(text: str) -> list:
+    """
+    検索・関連度計算用に文字列を語に分割する関数。
+    英数字は単語ごと、日本語などの区切りのない文字列は2文字ずつ（bigram）に分割する。
+    Args:
+        text (str): 対象の文字列
+    Returns:
+        list: 語のリスト（重複を含む）
+    """
+    terms = []
+    for chunk in _TERM_PATTERN.findall(
+        text.lower().replace("_", " ").replace("-", " ")
+    ):
+        if chunk.isascii():
+            terms.append(chunk)
+        elif len(chunk) == 1:
+            terms.append(chunk)
+        else:
+            terms.extend(chunk[i : i + 2] for i in range(len(chunk) - 1))
+    return terms
+
+
+class ToolRelevanceIndex:
+    """
+    ユーザー入力とツールの名前・説明の関連度を計算する索引。
+    入力の語のうち、1つのツールで説明できる割合（idfで重み付け）を関連度とする。
+    """
+
+    def __init__(self, tools: list) -> None:
+        self.tools = tools
+        self.tool_terms = [
+            set(tokenize_terms(f"{tool.name} {getattr(tool, 'description', '')}"))
+            for tool in tools
+        ]
+        self.document_frequency = collections.Counter(
+            term for terms in self.tool_terms for term in terms
+        )
+
+    def score(self, text: str) -> float:
+        """
+        入力と最も関連するツールの関連度（0〜1）を返す
+        Args:
+            text (str): ユーザー入力
+        Returns:
+            float: 関連度（ツールがない場合は0）
+        """
+        query_terms = set(tokenize_terms(text))
+        if not query_terms or not self.tool_terms:
+            return 0.0
+        count = len(self.tool_terms)
+        weights = {
+            term: math.log(1 + count / (self.document_frequency.get(term, 0) + 1))
+            for term in query_terms
+        }
+        total = sum(weights.values())
+        return max(
+            sum(weights[term] for term in query_terms & terms) / total
+            for terms in self.tool_terms
+        )
+
+
+class LLMRouter:
+    """
+    LLM選択が「自動」の場合に、ターンごとに使うLLMを選ぶクラス。
+    入力の長さ・会話の深さ・ツールとの関連度で軽量/通常を判定し、
+    候補の中から劣化・失敗の多いものを避けて、直近の応答時間が最も短いものを選ぶ。
+    """
+
+    def __init__(self) -> None:
+        self.settings = dict(DEFAULT_ROUTER_SETTINGS)
+        self.stats = {"routed": 0, "light": 0, "heavy": 0, "by_llm": {}}
+        self._index = None
+        self._lock = threading.Lock()
+
+    def configure(self, config: dict) -> None:
+        """
+        server_params.jsonのrouterセクションを反映する
+        Args:
+            config (dict): 自動選択の設定
+        """
+        self.settings = {**DEFAULT_ROUTER_SETTINGS, **(config or {})}
+
+    @property
+    def enabled(self) -> bool:
+        return str(self.settings["enabled"]).lower() == "true"
+
+    def tool_score(self, text: str, tools: list) -> float:
+        # 索引はツール一覧が差し替えられたときだけ作り直す
+        index = self._index
+        if index is None or index.tools is not tools:
+            index = self._index = ToolRelevanceIndex(tools)
+        return index.score(text)
+
+    def _pick(self, candidates: list) -> str:
+        snapshot = llm_resilience.llm_health.snapshot()
+        max_error_rate = float(self.settings["max_error_rate"])
+
+        def is_unhealthy(name):
+            entry = snapshot.get(name)
+            if not entry:
+                return False
+            calls = entry["successes"] + entry["failures"]
+            return entry["degraded"] or (
+                calls >= 3 and entry["failures"] / calls > max_error_rate
+            )
+
+        healthy = [name for name in candidates if not is_unhealthy(name)] or candidates
+        # 応答時間が未計測のLLMは、計測のため優先して使う
+        return min(
+            healthy,
+            key=lambda name: (snapshot.get(name) or {}).get("latency_ewma") or 0.0,
+        )
+
+    def route(
+        self,
+        user_input: str,
+        history: list,
+        tools: list,
+        llm_options: dict,
+        default_llm: str = "Default",
+    ) -> tuple:
+        """
+        このターンで使うLLMを選ぶ
+        Args:
+            user_input (str): ユーザー入力
+            history (list): チャット履歴（Gradioのmessages形式）
+            tools (list): このターンで使えるツール
+            llm_options (dict): server_params.jsonのllmセクション
+            default_llm (str): 候補となるLLMがない場合に使うLLM名（get_llm_paramsの既定と同じ）
+        Returns:
+            tuple: (LLM名, 判定理由の辞書)
+        """
+        settings = self.settings
+        depth = sum(1 for msg in history or [] if msg.get("role") == "user")
+        tool_score = self.tool_score(user_input, tools) if tools else 0.0
+        is_light = (
+            len(user_input) <= int(settings["max_light_chars"])
+            and depth <= int(settings["max_light_turns"])
+            and tool_score < float(settings["tool_score_threshold"])
+        )
+        tier = "light" if is_light else "heavy"
+        other = "heavy" if is_light else "light"
+        candidates = (
+            [name for name in settings[tier] if name in llm_options]
+            or [name for name in settings[other] if name in llm_options]
+            or list(llm_options)
+        )
+        # llmセクションが空の場合は選べないため、既定のLLMを使う
+        llm_name = self._pick(candidates) if candidates else default_llm
+        with self._lock:
+            self.stats["routed"] += 1
+            self.stats[tier] += 1
+            self.stats["by_llm"][llm_name] = self.stats["by_llm"].get(llm_name, 0) + 1
+        return llm_name, {
+            "tier": tier,
+            "chars": len(user_input),
+            "depth": depth,
+            "tool_score": round(tool_score, 3),
+        }
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                **self.stats,
+                "by_llm": dict(self.stats["by_llm"]),
+            }
+
+
+llm_router = LLMRouter()
+register_metrics_provider("router", llm_router.snapshot)
+
+
+def format_route(llm_name: str, reason: dict) -> str:
+    """
+    自動選択の結果を表示用の文字列にする関数
+    Args:
+        llm_name (str): 選んだLLM名
+        reason (dict): LLMRouter.routeが返した判定理由
+    Returns:
+        str: 表示用文字列
+    """
+    tier = "軽量" if reason["tier"] == "light" else "通常"
+    return (
+        f"自動選択: {llm_name} ({tier}, {reason['chars']}文字"
+        f", 会話{reason['depth'] + 1}往復目, ツール関連度 {reason['tool_score']:.2f})"
+    )
@@ -1,28 +1,128 @@
+import logging
 import os
 import gradio as gr
 import asyncio
-from langchain_openai import ChatOpenAI
-from langchain_mcp_adapters.client import MultiServerMCPClient
+import uuid
 from langgraph.prebuilt import create_react_agent
 
 from langchain_mcp_utils import (
-    extract_answer,
     get_llm_params,
     initialize_llm,
+    build_chat_model,
     load_server_params,
-    sync_get_available_tools,
-    extract_tool_history,
+    build_run_record,
+    ServerParamsWatcher,
+    DEFAULT_RELOAD_INTERVAL,
+    warm_up,
+    summarize_warmup,
+)
+from app_metrics import get_metrics_snapshot
+from app_loop import (
+    run_on_app_loop,
+    submit_to_app_loop,
+    await_on_app_loop,
+    active_runs,
+    RUN_CANCELLED_MESSAGE,
+)
+from app_logging import (
+    configure_logging,
+    AgentDebugLogger,
+)
+from mcp_http import configure_mcp_http
+from mcp_resilience import configure_server_options
+from mcp_supervisor import (
+    resolve_servers,
+    configure_stdio_supervisor,
+)
+from llm_inprocess import configure_litellm
+from llm_cassette import configure_cassette
+from llm_prompt import (
+    DEFAULT_SYSTEM_PROMPT,
+    build_prompt_messages,
+)
+from llm_routing import (
+    AUTO_LLM_OPTION,
+    llm_router,
+    format_route,
+)
+from doc_store import configure_doc_store
+from tool_results import configure_tool_results
+from run_budget import run_agent_with_budget
+from run_records import (
+    configure_pricing,
+    record_usage,
+    UsageTotals,
+)
+from history_store import configure_conversation_store
+from profiling import request_profiler
+from tool_catalog import (
+    render_tool_catalog_page,
+    TOOL_CATALOG_ALL_SERVERS,
+    load_tool_catalog,
+    register_builtin_tools,
+    start_background_tool_refresh,
+    DEFAULT_TOOL_CACHE_PATH,
 )
 
-global_client = None
+logger = logging.getLogger("main")
+
 global_tools = []
+tool_catalog = None
 llm_options = {}
 is_debug = False
+agent_budget = {}
+history_store = None
+
+
+def _on_tool_catalog_update(changed_servers: list) -> None:
+    """
+    ツールカタログが更新されたときに、グローバルツールを差し替えるコールバック。
+    Args:
+        changed_servers (list): ツール定義が更新されたサーバー名のリスト
+    """
+    global global_tools
+    global_tools = tool_catalog.tools
+
+
+def _on_server_params_reload(new_params: dict, diff: dict) -> None:
+    """
+    server_params.jsonが再読み込みされたときに、LLM設定とグローバルツールを差し替えるコールバック。
+    実行中のリクエストは開始時点の設定・ツールのまま完了する。
+    Args:
+        new_params (dict): 再読み込みした設定
+        diff (dict): 変更前との差分
+    """
+    global llm_options, is_debug, agent_budget, global_tools
+    llm_options = new_params.get("llm", {})
+    is_debug = new_params.get("debug", "false").lower() == "true"
+    agent_budget = new_params.get("agent_budget", {})
+    request_profiler.configure(new_params.get("profile", {}))
+    llm_router.configure(new_params.get("router", {}))
+    configure_pricing(new_params.get("pricing", {}))
+    if {"logging", "debug"} & set(diff["settings_changed"]):
+        configure_logging(new_params.get("logging", {}), debug=is_debug)
+    global_tools = tool_catalog.tools
+
+
+def _llm_choices() -> list:
+    """
+    LLM選択プルダウンの選択肢を返す関数（自動選択が有効な場合は先頭に「自動」を加える）
+    Returns:
+        list: 選択肢のリスト
+    """
+    choices = list(llm_options) or ["Default"]
+    return [AUTO_LLM_OPTION] + choices if llm_router.enabled else choices
 
 
 # Gradio用の非同期チャット関数
 async def gradio_chat(
-    user_input, history, function_calling, selected_llm, system_prompt=""
+    user_input,
+    history,
+    function_calling,
+    selected_llm,
+    system_prompt="",
+    usage=None,
+    conversation=None,
 ) -> str:
     """
     GradioのチャットUIから呼ばれる非同期チャット関数。
@@ -30,48 +130,76 @@ async def gradio_chat(
         user_input (str): ユーザーの入力テキスト
         history (list): チャット履歴
         function_calling (str): ツール呼び出し有効/無効
-        selected_llm (str): 選択されたLLM名
+        selected_llm (str): 選択されたLLM名（AUTO_LLM_OPTIONの場合はターンごとに自動選択）
         system_prompt (str): システムプロンプト
+        usage (UsageTotals | None): セッションの使用量の累計（このターンの使用量を加算する）
+        conversation (tuple | None): 履歴を保存する場合は (会話ID, ペイン名)
     Returns:
         str: チャット応答
     """
+    # グローバルツールを使用
+    agent_tools = global_tools if function_calling == "有効" else []
+    # 自動選択の場合は、入力の長さ・会話の深さ・ツールとの関連度と各LLMの応答時間から選ぶ
+    route_note = ""
+    if selected_llm == AUTO_LLM_OPTION:
+        selected_llm, route_reason = llm_router.route(
+            user_input, history, agent_tools, llm_options
+        )
+        route_note = format_route(selected_llm, route_reason)
+        logger.info("%s", route_note, extra={"llm": selected_llm, **route_reason})
     # 選択されたLLMでエージェントを初期化
-    print("selected_llm:", selected_llm)
     # llm_optionsから、selected_llmに対応する設定を取得
     llm_config = llm_options.get(selected_llm, {})
     model_name = llm_config.get("model", "gpt-4o")
-    base_url = llm_config.get("base_url", "")
-    print("model_name:", model_name)
-
-    current_llm = initialize_llm(model_name, base_url)
-    # Gradioの履歴(messages形式)をLangChainの履歴に変換
-    messages = []
-
-    # システムプロンプトがある場合、最初に追加
-    if system_prompt.strip():
-        messages.append({"type": "system", "content": system_prompt.strip()})
-
-    if history:
-        for msg in history:
-            if msg.get("role") == "user":
-                messages.append({"type": "human", "content": msg["content"]})
-            elif msg.get("role") == "assistant":
-                messages.append({"type": "ai", "content": msg["content"]})
-    messages.append({"type": "human", "content": user_input})
-    # グローバルツールを使用
-    agent_tools = global_tools if function_calling == "有効" else []
-    agent = create_react_agent(current_llm, agent_tools, debug=is_debug)
-    agent_response = await agent.ainvoke({"messages": messages})
-    answer = extract_answer(agent_response)
-    # ツール履歴抽出
-    tool_history = extract_tool_history(agent_response)
-    if tool_history:
-        answer += "\n\n[呼び出されたツール履歴]\n" + "\n".join(tool_history)
-    return answer
+    logger.debug(
+        "チャットリクエスト: %s (%s)",
+        selected_llm,
+        model_name,
+        extra={"llm": selected_llm, "model": model_name},
+    )
+
+    # 一時的な失敗はリトライし、失敗が続く場合はfallbacksに指定したLLMに切り替える
+    current_llm = build_chat_model(selected_llm, llm_options)
+    # Gradioの履歴(messages形式)をLangChainの履歴に変換する。
+    # プロンプトキャッシュが効くよう、正規化したシステムプロンプトを先頭に置き、履歴はその後に続ける
+    messages = build_prompt_messages(system_prompt, history, user_input)
+    # LangGraphのdebug出力は状態全体を標準出力に同期的に書き出すため使わず、
+    # debugが有効な場合はコールバックで要点をログキューに記録する
+    agent = create_react_agent(current_llm, agent_tools, debug=False)
+    if is_debug:
+        agent = agent.with_config(callbacks=[AgentDebugLogger()])
+    # ステップ数・ツール呼び出し数・制限時間の上限を超えた場合は、得られた情報から回答させる
+    agent_response, budget_outcome = await run_agent_with_budget(
+        agent, current_llm, {"messages": messages}, agent_budget
+    )
+    # 回答・ツール呼び出し・トークン使用量を1回の走査で実行記録にまとめる
+    run_record = build_run_record(agent_response, budget_outcome)
+    # トークン数・LLM/ツールの所要時間・推定コストをセッションとプロセス全体に累計する
+    record_usage(run_record, usage)
+    rendered = run_record.render()
+    if route_note:
+        rendered = f"{rendered}\n\n({route_note})"
+    # 会話履歴はバックグラウンドでまとめて保存する
+    if history_store is not None and conversation is not None:
+        history_store.append(
+            *conversation,
+            [
+                {"role": "user", "content": user_input},
+                {"role": "assistant", "content": rendered},
+            ],
+            run_record,
+        )
+    return rendered
 
 
 def sync_gradio_chat(
-    user_input, history, function_calling, selected_llm, system_prompt=""
+    user_input,
+    history,
+    function_calling,
+    selected_llm,
+    system_prompt="",
+    profile=False,
+    usage=None,
 ) -> str:
     """
     非同期gradio_chat関数を同期的に呼び出すラッパー。
@@ -81,13 +209,29 @@ def sync_gradio_chat(
         function_calling (str): ツール呼び出し有効/無効
         selected_llm (str): 選択されたLLM名
         system_prompt (str): システムプロンプト
+        profile (bool): このリクエストのプロファイルを取得するか
+        usage (UsageTotals | None): セッションの使用量の累計
     Returns:
         str: エージェントの回答
     """
 
-    return asyncio.run(
-        gradio_chat(user_input, history, function_calling, selected_llm, system_prompt)
+    # 常駐イベントループで実行し、LLM・MCPへの接続プールをリクエスト間で再利用する
+    # profileの設定に応じて、一部のリクエストはプロファイルを取得する
+    response, _ = run_on_app_loop(
+        request_profiler.run(
+            "gradio_chat",
+            gradio_chat(
+                user_input,
+                history,
+                function_calling,
+                selected_llm,
+                system_prompt,
+                usage,
+            ),
+            force=profile,
+        )
     )
+    return response
 
 
 async def main() -> None:
@@ -101,39 +245,112 @@ async def main() -> None:
 
     # paramsが空の辞書の場合(＝設定ファイルが存在しない場合)、エラーで終了
     if not params:
-        print("設定ファイル({})が見つからないか、無効です。".format(params_file_name))
+        logger.error("設定ファイル(%s)が見つからないか、無効です。", params_file_name)
         return
 
     # paramsから必要な情報を取得
-    global llm_options, is_debug
+    global llm_options, is_debug, agent_budget, history_store
     model_name, base_url, llm_options, default_llm, available_llms = get_llm_params(
         params
     )
     is_debug = params.get("debug", "false").lower() == "true"
+    # ログはキュー経由でバックグラウンド出力し、リクエスト処理をコンソール出力で待たせない
+    configure_logging(params.get("logging", {}), debug=is_debug)
+    agent_budget = params.get("agent_budget", {})
+    request_profiler.configure(params.get("profile", {}))
+    llm_router.configure(params.get("router", {}))
+    configure_server_options(params.get("server_options", {}))
+    configure_tool_results(params.get("tool_results", {}))
+    # doc_storeが有効な場合、取得したドキュメントをローカルで検索できるようにする
+    configure_doc_store(params.get("doc_store", {}))
+    # HTTPのMCPサーバーへの接続は、すべてのセッションで共有のコネクションプールを使う
+    configure_mcp_http(params.get("mcp_http", {}))
+    configure_pricing(params.get("pricing", {}))
+    # 会話履歴をSQLiteに保存し、ページの再読み込みやアプリの再起動後も続きから再開できるようにする
+    history_store = configure_conversation_store(params.get("history", {}))
+    # litellm.modeが"in_process"の場合、LiteLLMプロキシを経由せずにプロセス内でLLMを呼び出す
+    configure_litellm(params.get("litellm", {}))
+    # cassetteが有効な場合、LLM・MCPの通信を記録する（または記録から再生する）
+    configure_cassette(params.get("cassette", {}))
 
     # 初期LLMの設定
     llm = initialize_llm(llm_name=model_name, base_url=base_url)
 
-    # アプリ起動時にclientとtoolsを一度取得して使い回す
-    print("=== MCPクライアントとツールを初期化中... ===")
+    # アプリ起動時にtoolsを一度取得して使い回す
+    logger.info("=== MCPクライアントとツールを初期化中... ===")
 
-    # グローバルクライアントとツールを初期化
+    # グローバルツールを初期化
     try:
-        global global_client
-        global_client = MultiServerMCPClient(params.get("servers", {}))
-        global global_tools
-        global_tools = await global_client.get_tools()
-        print(f"初期化完了: {len(global_tools)} 個のツールが利用可能です")
+        # gatewayが有効な場合、stdioのサーバーはMCPゲートウェイ経由で共有する
+        servers = resolve_servers(params)
+        # supervisorが有効な場合、stdioのサーバーは常駐させてヘルスチェック・自動再起動を行う
+        configure_stdio_supervisor(
+            params.get("supervisor", {}), servers, params.get("server_options", {})
+        )
+        # キャッシュ済みのサーバーはキャッシュからツールを登録し、未キャッシュのサーバーのみ起動する
+        tool_cache_config = params.get("tool_cache", {})
+        cache_path = (
+            tool_cache_config.get("path", DEFAULT_TOOL_CACHE_PATH)
+            if tool_cache_config.get("enabled", "true").lower() == "true"
+            else None
+        )
+        global tool_catalog, global_tools
+        tool_catalog, cached_servers = await load_tool_catalog(servers, cache_path)
+        register_builtin_tools(tool_catalog)
+        global_tools = tool_catalog.tools
+        logger.info("初期化完了: %d 個のツールが利用可能です", len(global_tools))
+        if cached_servers:
+            logger.info("キャッシュから登録したサーバー: %s", ", ".join(cached_servers))
+            # キャッシュの内容はバックグラウンドで実サーバーと照合する
+            start_background_tool_refresh(
+                tool_catalog,
+                servers,
+                cached_servers,
+                cache_path,
+                on_update=_on_tool_catalog_update,
+            )
 
         # ツール一覧を表示
         for i, tool in enumerate(global_tools, 1):
             tool_name = getattr(tool, "name", "Unknown")
-            print(f"  {i}. {tool_name}")
+            logger.info("  %d. %s", i, tool_name)
     except Exception as e:
-        print(f"ツール取得エラー: {e}")
-        print("プロセスを終了します...")
+        logger.critical("ツール取得エラー: %s", e)
+        logger.critical("プロセスを終了します...")
+        logging.shutdown()
         os._exit(1)  # 即座にプロセスを強制終了
 
+    # 設定ファイルの変更を監視し、変更のあったサーバー・LLMのみ反映する
+    hot_reload_config = params.get("hot_reload", {})
+    if hot_reload_config.get("enabled", "false").lower() == "true":
+        ServerParamsWatcher(
+            params_file_name,
+            params,
+            tool_catalog,
+            cache_path,
+            on_reload=_on_server_params_reload,
+            interval=float(hot_reload_config.get("interval", DEFAULT_RELOAD_INTERVAL)),
+        ).start()
+
+    # 初回リクエストが定常時と同じ応答時間になるよう、起動前にLLM接続とMCPセッションを温めておく
+    warmup_config = params.get("warmup", {})
+    if warmup_config.get("enabled", "false").lower() == "true":
+        logger.info("=== ウォームアップ中... ===")
+        report = await asyncio.wrap_future(
+            submit_to_app_loop(
+                warm_up(
+                    llm_options,
+                    resolve_servers(params),
+                    warmup_config,
+                    prompt_runner=lambda prompt: gradio_chat(
+                        prompt, [], "有効", default_llm
+                    ),
+                )
+            )
+        )
+        logger.info("ウォームアップ結果:\n%s", summarize_warmup(report))
+        logger.info("=== ウォームアップ完了 ===")
+
     with gr.Blocks(
         theme=gr.themes.Soft(),
         css="""
@@ -247,12 +464,26 @@ async def main() -> None:
                     with gr.Column(scale=1):
                         gr.Markdown("**使用するLLM:**")
                         llm_dropdown = gr.Dropdown(
-                            choices=available_llms,
+                            choices=_llm_choices(),
                             value=default_llm,
                             label=None,
                             container=False,
                             elem_classes=["dropdown"],
                         )
+                    with gr.Column(scale=1, visible=request_profiler.enabled):
+                        gr.Markdown("**プロファイル:**")
+                        profile_checkbox = gr.Checkbox(
+                            label="このリクエストを計測",
+                            value=False,
+                            container=False,
+                        )
+                    with gr.Column(scale=1, visible=history_store is not None):
+                        gr.Markdown("**会話:**")
+                        new_chat_btn = gr.Button("🆕 新しい会話", size="sm")
+                # 会話IDはブラウザに保存し、再読み込み時に同じ会話を再開する
+                conversation_state = gr.BrowserState(
+                    "", storage_key="langchain_mcp_conversation"
+                )
 
                 # 入力フォーム
                 with gr.Row(elem_classes=["input-container"]):
@@ -265,8 +496,31 @@ async def main() -> None:
                         submit_btn=True,
                     )
                     send_btn = gr.Button("📤", size="sm", variant="primary", scale=1)
+                    stop_btn = gr.Button("⏹", size="sm", variant="stop", scale=1)
+
+                # トークン数・所要時間・推定コスト（直近のターンとセッション累計）
+                usage_state = gr.State(UsageTotals())
+                usage_display = gr.Markdown()
 
             with gr.TabItem("利用可能なツール"):
+                # 検索・サーバー絞り込み・ページ指定
+                with gr.Row():
+                    tools_query = gr.Textbox(
+                        label="検索",
+                        placeholder="ツール名・説明・サーバー名で検索...",
+                        scale=3,
+                    )
+                    tools_server = gr.Dropdown(
+                        choices=[TOOL_CATALOG_ALL_SERVERS]
+                        + list(tool_catalog.tools_by_server),
+                        value=TOOL_CATALOG_ALL_SERVERS,
+                        label="サーバー",
+                        scale=2,
+                    )
+                    tools_page = gr.Number(
+                        value=1, minimum=1, precision=0, label="ページ", scale=1
+                    )
+
                 # ツール一覧表示エリア
                 tools_display = gr.Markdown(
                     "「ツール一覧を更新」ボタンをクリックして、利用可能なツールを表示してください。",
@@ -276,17 +530,61 @@ async def main() -> None:
                 # ツール一覧更新ボタン
                 refresh_tools_btn = gr.Button("🔄 ツール一覧を更新", variant="primary")
 
-                def update_tools_display() -> str:
+                def update_tools_display(query, server_name, page) -> tuple:
                     """ツール一覧を更新する関数"""
                     try:
-                        tools_info = sync_get_available_tools(global_tools)
-                        return tools_info
+                        tools_info, page = render_tool_catalog_page(
+                            tool_catalog, query, server_name, page
+                        )
+                        server_choices = [TOOL_CATALOG_ALL_SERVERS] + list(
+                            tool_catalog.tools_by_server
+                        )
+                        return tools_info, gr.update(choices=server_choices), page
                     except Exception as e:
-                        return f"ツール一覧の取得中にエラーが発生しました:\n{str(e)}"
+                        return (
+                            f"ツール一覧の取得中にエラーが発生しました:\n{str(e)}",
+                            gr.update(),
+                            page,
+                        )
 
-                refresh_tools_btn.click(update_tools_display, outputs=tools_display)
+                tools_inputs = [tools_query, tools_server, tools_page]
+                tools_outputs = [tools_display, tools_server, tools_page]
+                refresh_tools_btn.click(
+                    update_tools_display, inputs=tools_inputs, outputs=tools_outputs
+                )
+                tools_query.submit(
+                    lambda query, server_name, _: update_tools_display(
+                        query, server_name, 1
+                    ),
+                    inputs=tools_inputs,
+                    outputs=tools_outputs,
+                )
+                tools_server.change(
+                    lambda query, server_name, _: update_tools_display(
+                        query, server_name, 1
+                    ),
+                    inputs=tools_inputs,
+                    outputs=tools_outputs,
+                )
+                tools_page.submit(
+                    update_tools_display, inputs=tools_inputs, outputs=tools_outputs
+                )
 
-        def user_submit(user_input, history, function_calling, selected_llm) -> tuple:
+                # サーキットブレーカーの状態などのメトリクス
+                with gr.Accordion("メトリクス", open=False):
+                    metrics_display = gr.JSON()
+                refresh_tools_btn.click(get_metrics_snapshot, outputs=metrics_display)
+
+        async def user_submit(
+            user_input,
+            history,
+            function_calling,
+            selected_llm,
+            profile,
+            usage,
+            conversation_id,
+            request: gr.Request,
+        ) -> tuple:
             """
             Gradioの送信イベントから呼ばれるコールバック関数。
             ユーザー入力・履歴・functionCalling有無・選択されたLLMを受け取り、チャット履歴を更新する。
@@ -295,35 +593,101 @@ async def main() -> None:
                 history (list): チャット履歴
                 function_calling (str): ツール呼び出し有効/無効
                 selected_llm (str): 選択されたLLM名
+                profile (bool): このリクエストのプロファイルを取得するか
+                usage (UsageTotals): セッションの使用量の累計
+                conversation_id (str): 会話ID（会話履歴の保存先）
+                request (gr.Request): リクエスト情報（停止・切断時のキャンセルにセッションIDを使う）
             Returns:
-                tuple: (空文字, 更新後履歴)
+                tuple: (空文字, 更新後履歴, 使用量の累計, 使用量の表示)
             """
             if not user_input.strip():
-                return "", history
-            # 内部でシステムプロンプトを設定
-            system_prompt = """
-            あなたは親切で知識豊富なAIアシスタントです。ユーザーの質問に対して、正確で分かりやすい回答を提供してください。
-            なお、回答にあたり、以下のルールを守ってください。
-            1. 回答は日本語で行ってください。
-            2. 回答は簡潔で明確にしてください。
-            3. ツール呼び出しが有効な場合は、ツールを利用してください。
-            4. ユーザーの意図を理解しかねる場合は、追加の情報を求めてください。
-            """
-            response = sync_gradio_chat(
-                user_input, history, function_calling, selected_llm, system_prompt
-            )
+                return "", history, usage, usage.render()
+            # 常駐イベントループで実行し、停止ボタン・ページを閉じた場合・再送信時はLLM呼び出しや
+            # ツール呼び出しの途中でもキャンセルする
+            try:
+                response, _ = await await_on_app_loop(
+                    request_profiler.run(
+                        "gradio_chat",
+                        active_runs.run(
+                            (request.session_hash, "chat"),
+                            gradio_chat(
+                                user_input,
+                                history,
+                                function_calling,
+                                selected_llm,
+                                DEFAULT_SYSTEM_PROMPT,
+                                usage,
+                                (conversation_id, "chat") if conversation_id else None,
+                            ),
+                        ),
+                        force=profile,
+                    )
+                )
+            except asyncio.CancelledError:
+                # このハンドラ自体がキャンセルされた場合はそのまま伝える
+                if asyncio.current_task().cancelling():
+                    raise
+                response = RUN_CANCELLED_MESSAGE
             # messages形式に変換
             new_history = history + [
                 {"role": "user", "content": user_input},
                 {"role": "assistant", "content": response},
             ]
-            return "", new_history
-
-        txt.submit(
-            user_submit, [txt, chatbot, function_radio, llm_dropdown], [txt, chatbot]
+            return "", new_history, usage, usage.render()
+
+        chat_inputs = [
+            txt,
+            chatbot,
+            function_radio,
+            llm_dropdown,
+            profile_checkbox,
+            usage_state,
+            conversation_state,
+        ]
+        chat_outputs = [txt, chatbot, usage_state, usage_display]
+        # 実行は常駐イベントループで行うため同時実行数は制限せず、同じセッションの再送信は前の実行を置き換える
+        txt.submit(user_submit, chat_inputs, chat_outputs, concurrency_limit=None)
+        send_btn.click(user_submit, chat_inputs, chat_outputs, concurrency_limit=None)
+
+        def cancel_session_runs(request: gr.Request) -> None:
+            """このセッションで実行中のエージェントをキャンセルする関数"""
+            active_runs.cancel(request.session_hash)
+
+        stop_btn.click(cancel_session_runs, queue=False)
+        # ページを閉じた（切断した）場合も、誰も見ない回答の生成を止める
+        demo.unload(cancel_session_runs)
+
+        def restore_conversation(conversation_id) -> tuple:
+            """
+            ページ読み込み時に、保存済みの会話の直近のメッセージを読み込む関数
+            Args:
+                conversation_id (str): ブラウザに保存された会話ID
+            Returns:
+                tuple: (会話ID, チャット履歴)
+            """
+            if history_store is None:
+                return conversation_id, gr.update()
+            conversation_id = conversation_id or uuid.uuid4().hex
+            return conversation_id, history_store.load_recent(conversation_id, "chat")
+
+        def start_new_conversation() -> tuple:
+            """新しい会話IDを発行し、チャット欄と使用量の表示を空にする関数"""
+            return uuid.uuid4().hex, [], UsageTotals(), ""
+
+        demo.load(
+            restore_conversation,
+            inputs=conversation_state,
+            outputs=[conversation_state, chatbot],
         )
-        send_btn.click(
-            user_submit, [txt, chatbot, function_radio, llm_dropdown], [txt, chatbot]
+        new_chat_btn.click(
+            start_new_conversation,
+            outputs=[conversation_state, chatbot, usage_state, usage_display],
+        )
+
+        # ページ読み込み時に、再読み込み後のLLM一覧をプルダウンに反映する
+        demo.load(
+            lambda: gr.update(choices=_llm_choices()),
+            outputs=llm_dropdown,
         )
 
     demo.launch(share=False, server_name="127.0.0.1", server_port=7860)
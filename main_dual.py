@@ -1,54 +1,132 @@
+import logging
 import os
 import gradio as gr
 import asyncio
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_openai import ChatOpenAI
+import uuid
 from langgraph.prebuilt import create_react_agent
 from langchain_mcp_utils import (
-    extract_answer,
     load_server_params,
-    initialize_llm,
+    build_chat_model,
     get_llm_params,
-    sync_get_available_tools,
-    extract_tool_history,
+    build_run_record,
+    ServerParamsWatcher,
+    DEFAULT_RELOAD_INTERVAL,
+    warm_up,
+    summarize_warmup,
 )
+from app_metrics import get_metrics_snapshot
+from app_loop import (
+    run_on_app_loop,
+    submit_to_app_loop,
+    await_on_app_loop,
+    active_runs,
+    RUN_CANCELLED_MESSAGE,
+)
+from app_logging import (
+    configure_logging,
+    AgentDebugLogger,
+)
+from mcp_http import configure_mcp_http
+from mcp_resilience import configure_server_options
+from mcp_supervisor import (
+    resolve_servers,
+    configure_stdio_supervisor,
+)
+from llm_inprocess import configure_litellm
+from llm_cassette import configure_cassette
+from llm_prompt import (
+    DEFAULT_SYSTEM_PROMPT,
+    build_prompt_messages,
+)
+from llm_resilience import ResilientChatModel
+from doc_store import configure_doc_store
+from tool_results import configure_tool_results
+from run_budget import run_agent_with_budget
+from run_records import (
+    configure_pricing,
+    record_usage,
+    UsageTotals,
+)
+from history_store import configure_conversation_store
+from profiling import request_profiler
+from tool_catalog import (
+    render_tool_catalog_page,
+    TOOL_CATALOG_ALL_SERVERS,
+    load_tool_catalog,
+    register_builtin_tools,
+    start_background_tool_refresh,
+    DEFAULT_TOOL_CACHE_PATH,
+)
+
+logger = logging.getLogger("main_dual")
 
-global_client = None
 global_tools = []
+tool_catalog = None
 llm1_name = None
 llm2_name = None
 llm_options = {}
 is_debug = False
+agent_budget = {}
+history_store = None
+
+
+def _on_tool_catalog_update(changed_servers: list) -> None:
+    """
+    ツールカタログが更新されたときに、グローバルツールを差し替えるコールバック。
+    Args:
+        changed_servers (list): ツール定義が更新されたサーバー名のリスト
+    """
+    global global_tools
+    global_tools = tool_catalog.tools
+
+
+def _on_server_params_reload(new_params: dict, diff: dict) -> None:
+    """
+    server_params.jsonが再読み込みされたときに、LLM設定とグローバルツールを差し替えるコールバック。
+    実行中のリクエストは開始時点の設定・ツールのまま完了する。
+    Args:
+        new_params (dict): 再読み込みした設定
+        diff (dict): 変更前との差分
+    """
+    global llm_options, is_debug, agent_budget, global_tools, llm1_name, llm2_name
+    llm_options = new_params.get("llm", {})
+    is_debug = new_params.get("debug", "false").lower() == "true"
+    agent_budget = new_params.get("agent_budget", {})
+    request_profiler.configure(new_params.get("profile", {}))
+    configure_pricing(new_params.get("pricing", {}))
+    if {"logging", "debug"} & set(diff["settings_changed"]):
+        configure_logging(new_params.get("logging", {}), debug=is_debug)
+    global_tools = tool_catalog.tools
+    # 削除されたLLMを表示中のペインは、残っているLLMに切り替える
+    available_llms = list(llm_options) or ["Default"]
+    if llm1_name not in llm_options:
+        llm1_name = available_llms[0]
+    if llm2_name not in llm_options:
+        llm2_name = available_llms[1] if len(available_llms) >= 2 else available_llms[0]
 
 
 # LLMを初期化する関数（ローカル版）
-def initialize_llm_local(llm_name: str) -> ChatOpenAI:
+def initialize_llm_local(llm_name: str) -> ResilientChatModel:
     """
-    選択されたLLMに基づいてChatOpenAIインスタンスを初期化（main_dual専用）
+    選択されたLLMに基づいてチャットモデルを初期化（main_dual専用）
+    一時的な失敗はリトライし、失敗が続く場合はfallbacksに指定したLLMに切り替える。
     Args:
         llm_name (str): LLMの名前
     Returns:
-        ChatOpenAI: 初期化されたChatOpenAIインスタンス
+        ResilientChatModel: 初期化されたチャットモデル
     """
-    if llm_name in llm_options:
-        llm_config = llm_options[llm_name]
-        if isinstance(llm_config, dict):
-            # 新しい形式: {"model": "...", "base_url": "..."}
-            model = llm_config.get("model", "gpt-4o")
-            base_url = llm_config.get("base_url", "")
-            return initialize_llm(model, base_url)
-        else:
-            # 古い形式: 文字列のbase_url
-            return initialize_llm("gpt-4o", llm_config)
-    else:
-        # デフォルトまたは不明なLLMの場合
-        base_url = ""
-        return initialize_llm("gpt-4o", base_url)
+    return build_chat_model(llm_name, llm_options)
 
 
 # 単一LLM用の非同期チャット関数
 async def single_llm_chat(
-    user_input, history, function_calling, llm_name, system_prompt=""
+    user_input,
+    history,
+    function_calling,
+    llm_name,
+    system_prompt="",
+    usage=None,
+    conversation=None,
 ) -> str:
     """
     単一のLLMに対してチャットを実行する関数
@@ -58,44 +136,59 @@ async def single_llm_chat(
         function_calling (str): ツール呼び出しの有効/無効
         llm_name (str): LLMの名前
         system_prompt (str): システムプロンプト
+        usage (UsageTotals | None): このペインの使用量の累計（このターンの使用量を加算する）
+        conversation (tuple | None): 履歴を保存する場合は (会話ID, ペイン名)
     Returns:
         str: LLMからの応答
     """
     try:
         # 選択されたLLMでエージェントを初期化
         current_llm = initialize_llm_local(llm_name)
-        # Gradioの履歴(messages形式)をLangChainの履歴に変換
-        messages = []
-
-        # システムプロンプトがある場合、最初に追加
-        if system_prompt.strip():
-            messages.append({"type": "system", "content": system_prompt.strip()})
-
-        if history:
-            for msg in history:
-                if msg.get("role") == "user":
-                    messages.append({"type": "human", "content": msg["content"]})
-                elif msg.get("role") == "assistant":
-                    messages.append({"type": "ai", "content": msg["content"]})
-        messages.append({"type": "human", "content": user_input})
+        # Gradioの履歴(messages形式)をLangChainの履歴に変換する。
+        # プロンプトキャッシュが効くよう、正規化したシステムプロンプトを先頭に置き、履歴はその後に続ける
+        messages = build_prompt_messages(system_prompt, history, user_input)
         # グローバルツールを使用
         agent_tools = global_tools if function_calling == "有効" else []
-        agent = create_react_agent(current_llm, agent_tools, debug=is_debug)
-        agent_response = await agent.ainvoke({"messages": messages})
-        answer = extract_answer(agent_response)
-        # ツール履歴抽出（langchain_mcp_utils.pyの関数を使用）
-        tool_history = extract_tool_history(agent_response)
-        if tool_history:
-            answer += f"\n\n[{llm_name} - 呼び出されたツール履歴]\n" + "\n".join(
-                tool_history
+        # LangGraphのdebug出力は状態全体を標準出力に同期的に書き出すため使わず、
+        # debugが有効な場合はコールバックで要点をログキューに記録する
+        agent = create_react_agent(current_llm, agent_tools, debug=False)
+        if is_debug:
+            agent = agent.with_config(callbacks=[AgentDebugLogger()])
+        # ステップ数・ツール呼び出し数・制限時間の上限を超えた場合は、得られた情報から回答させる
+        agent_response, budget_outcome = await run_agent_with_budget(
+            agent, current_llm, {"messages": messages}, agent_budget
+        )
+        # 回答・ツール呼び出し・トークン使用量を1回の走査で実行記録にまとめる
+        run_record = build_run_record(agent_response, budget_outcome)
+        # トークン数・LLM/ツールの所要時間・推定コストをペインとプロセス全体に累計する
+        record_usage(run_record, usage)
+        rendered = run_record.render(f"{llm_name} - 呼び出されたツール履歴")
+        # 会話履歴はバックグラウンドでまとめて保存する
+        if history_store is not None and conversation is not None:
+            history_store.append(
+                *conversation,
+                [
+                    {"role": "user", "content": user_input},
+                    {"role": "assistant", "content": rendered},
+                ],
+                run_record,
             )
-        return answer
+        return rendered
     except Exception as e:
         return f"エラーが発生しました ({llm_name}): {str(e)}"
 
 
 # 両方のLLMに同時にプロンプトを送信する関数
-async def dual_llm_chat(user_input, history1, history2, function_calling) -> tuple:
+async def dual_llm_chat(
+    user_input,
+    history1,
+    history2,
+    function_calling,
+    usage1=None,
+    usage2=None,
+    session_id=None,
+    conversation_id=None,
+) -> tuple:
     """
     2つのLLMに同時にプロンプトを送信し、結果を返す
     Args:
@@ -103,41 +196,58 @@ async def dual_llm_chat(user_input, history1, history2, function_calling) -> tup
         history1 (list): LLM1のチャット履歴
         history2 (list): LLM2のチャット履歴
         function_calling (str): ツール呼び出しの有効/無効
+        usage1 (UsageTotals | None): LLM1のペインの使用量の累計
+        usage2 (UsageTotals | None): LLM2のペインの使用量の累計
+        session_id (str | None): セッションID（指定した場合、ペインごとに停止できるよう登録する）
+        conversation_id (str | None): 会話ID（指定した場合、ペインごとに会話履歴を保存する）
     Returns:
         tuple: 各LLMの応答と更新された履歴
     """
     if not user_input.strip():
         return "", history1, "", history2
 
-    # 内部でシステムプロンプトを設定
-    system_prompt = """
-            あなたは親切で知識豊富なAIアシスタントです。ユーザーの質問に対して、正確で分かりやすい回答を提供してください。
-            なお、回答にあたり、以下のルールを守ってください。
-            1. 回答は日本語で行ってください。
-            2. 回答は簡潔で明確にしてください。
-            3. ツール呼び出しが有効な場合は、ツールを利用してください。
-            4. ユーザーの意図を理解しかねる場合は、追加の情報を求めてください。
-            """
+    def pane_run(pane, coro):
+        # ペインごとに登録し、片方だけ停止・再送信で置き換えられるようにする
+        if session_id is None:
+            return coro
+        return active_runs.run((session_id, pane), coro)
 
     # 両方のLLMに同時にリクエストを送信
     tasks = [
-        single_llm_chat(
-            user_input, history1, function_calling, llm1_name, system_prompt
+        pane_run(
+            "llm1",
+            single_llm_chat(
+                user_input,
+                history1,
+                function_calling,
+                llm1_name,
+                DEFAULT_SYSTEM_PROMPT,
+                usage1,
+                (conversation_id, "llm1") if conversation_id else None,
+            ),
         ),
-        single_llm_chat(
-            user_input, history2, function_calling, llm2_name, system_prompt
+        pane_run(
+            "llm2",
+            single_llm_chat(
+                user_input,
+                history2,
+                function_calling,
+                llm2_name,
+                DEFAULT_SYSTEM_PROMPT,
+                usage2,
+                (conversation_id, "llm2") if conversation_id else None,
+            ),
         ),
     ]
     responses = await asyncio.gather(*tasks, return_exceptions=True)
-    response1 = (
-        responses[0]
-        if not isinstance(responses[0], Exception)
-        else f"エラー: {responses[0]}"
-    )
-    response2 = (
-        responses[1]
-        if not isinstance(responses[1], Exception)
-        else f"エラー: {responses[1]}"
+    # 停止したペインはその旨を表示し、もう一方の回答はそのまま表示する
+    response1, response2 = (
+        RUN_CANCELLED_MESSAGE
+        if isinstance(response, asyncio.CancelledError)
+        else f"エラー: {response}"
+        if isinstance(response, Exception)
+        else response
+        for response in responses
     )
     # 履歴を更新
     new_history1 = history1 + [
@@ -151,7 +261,15 @@ async def dual_llm_chat(user_input, history1, history2, function_calling) -> tup
     return "", new_history1, "", new_history2
 
 
-def sync_dual_llm_chat(user_input, history1, history2, function_calling) -> tuple:
+def sync_dual_llm_chat(
+    user_input,
+    history1,
+    history2,
+    function_calling,
+    profile=False,
+    usage1=None,
+    usage2=None,
+) -> tuple:
     """
     非同期dual_llm_chat関数を同期的に呼び出すラッパー
     Args:
@@ -159,20 +277,24 @@ def sync_dual_llm_chat(user_input, history1, history2, function_calling) -> tupl
         history1 (list): LLM1のチャット履歴
         history2 (list): LLM2のチャット履歴
         function_calling (str): ツール呼び出しの有効/無効
+        profile (bool): このリクエストのプロファイルを取得するか
+        usage1 (UsageTotals | None): LLM1のペインの使用量の累計
+        usage2 (UsageTotals | None): LLM2のペインの使用量の累計
     Returns:
         tuple: 各LLMの応答と更新された履歴
     """
-    return asyncio.run(dual_llm_chat(user_input, history1, history2, function_calling))
-
-
-# 利用可能なツール一覧を取得する関数（ローカル版）
-def sync_get_available_tools_local() -> str:
-    """
-    利用可能なツール取得の同期ラッパー（main_dual専用）
-    Returns:
-        str: 利用可能なツールのリスト
-    """
-    return sync_get_available_tools(global_tools)
+    # 常駐イベントループで実行し、LLM・MCPへの接続プールをリクエスト間で再利用する
+    # profileの設定に応じて、一部のリクエストはプロファイルを取得する
+    result, _ = run_on_app_loop(
+        request_profiler.run(
+            "dual_llm_chat",
+            dual_llm_chat(
+                user_input, history1, history2, function_calling, usage1, usage2
+            ),
+            force=profile,
+        )
+    )
+    return result
 
 
 async def main() -> None:
@@ -181,40 +303,112 @@ async def main() -> None:
 
     # paramsが空の辞書の場合(＝設定ファイルが存在しない場合)、エラーで終了
     if not params:
-        print("設定ファイル(server_params.json)が見つからないか、無効です。")
+        logger.error("設定ファイル(server_params.json)が見つからないか、無効です。")
         return
 
     # paramsから必要な情報を取得
-    global llm_options, is_debug
+    global llm_options, is_debug, agent_budget, history_store
     _, _, llm_options, _, available_llms = get_llm_params(params)
     is_debug = params.get("debug", "false").lower() == "true"
+    # ログはキュー経由でバックグラウンド出力し、リクエスト処理をコンソール出力で待たせない
+    configure_logging(params.get("logging", {}), debug=is_debug)
+    agent_budget = params.get("agent_budget", {})
+    request_profiler.configure(params.get("profile", {}))
+    configure_server_options(params.get("server_options", {}))
+    configure_tool_results(params.get("tool_results", {}))
+    # doc_storeが有効な場合、取得したドキュメントをローカルで検索できるようにする
+    configure_doc_store(params.get("doc_store", {}))
+    # HTTPのMCPサーバーへの接続は、すべてのセッションで共有のコネクションプールを使う
+    configure_mcp_http(params.get("mcp_http", {}))
+    configure_pricing(params.get("pricing", {}))
+    # 会話履歴をSQLiteに保存し、ページの再読み込みやアプリの再起動後も続きから再開できるようにする
+    history_store = configure_conversation_store(params.get("history", {}))
+    # litellm.modeが"in_process"の場合、LiteLLMプロキシを経由せずにプロセス内でLLMを呼び出す
+    configure_litellm(params.get("litellm", {}))
+    # cassetteが有効な場合、LLM・MCPの通信を記録する（または記録から再生する）
+    configure_cassette(params.get("cassette", {}))
 
     # 2つのLLMを取得（最初の2つ、または同じものを2回）
     global llm1_name, llm2_name
     llm1_name = available_llms[0] if len(available_llms) >= 1 else "Default"
     llm2_name = available_llms[1] if len(available_llms) >= 2 else available_llms[0]
 
-    # アプリ起動時にclientとtoolsを一度取得して使い回す
-    print("=== MCPクライアントとツールを初期化中... ===")
+    # アプリ起動時にtoolsを一度取得して使い回す
+    logger.info("=== MCPクライアントとツールを初期化中... ===")
 
-    # グローバルクライアントとツールを初期化
+    # グローバルツールを初期化
     try:
-        global global_client
-        global_client = MultiServerMCPClient(params.get("servers", {}))
-        global global_tools
-        global_tools = await global_client.get_tools()
-        print(f"初期化完了: {len(global_tools)} 個のツールが利用可能です")
+        # gatewayが有効な場合、stdioのサーバーはMCPゲートウェイ経由で共有する
+        servers = resolve_servers(params)
+        # supervisorが有効な場合、stdioのサーバーは常駐させてヘルスチェック・自動再起動を行う
+        configure_stdio_supervisor(
+            params.get("supervisor", {}), servers, params.get("server_options", {})
+        )
+        # キャッシュ済みのサーバーはキャッシュからツールを登録し、未キャッシュのサーバーのみ起動する
+        tool_cache_config = params.get("tool_cache", {})
+        cache_path = (
+            tool_cache_config.get("path", DEFAULT_TOOL_CACHE_PATH)
+            if tool_cache_config.get("enabled", "true").lower() == "true"
+            else None
+        )
+        global tool_catalog, global_tools
+        tool_catalog, cached_servers = await load_tool_catalog(servers, cache_path)
+        register_builtin_tools(tool_catalog)
+        global_tools = tool_catalog.tools
+        logger.info("初期化完了: %d 個のツールが利用可能です", len(global_tools))
+        if cached_servers:
+            logger.info("キャッシュから登録したサーバー: %s", ", ".join(cached_servers))
+            # キャッシュの内容はバックグラウンドで実サーバーと照合する
+            start_background_tool_refresh(
+                tool_catalog,
+                servers,
+                cached_servers,
+                cache_path,
+                on_update=_on_tool_catalog_update,
+            )
 
         # ツール一覧を表示
         for i, tool in enumerate(global_tools, 1):
             tool_name = getattr(tool, "name", "Unknown")
-            print(f"  {i}. {tool_name}")
+            logger.info("  %d. %s", i, tool_name)
     except Exception as e:
-        print(f"ツール取得エラー: {e}")
-        print("プロセスを終了します...")
+        logger.critical("ツール取得エラー: %s", e)
+        logger.critical("プロセスを終了します...")
+        logging.shutdown()
         os._exit(1)  # 即座にプロセスを強制終了
 
+    # 設定ファイルの変更を監視し、変更のあったサーバー・LLMのみ反映する
+    hot_reload_config = params.get("hot_reload", {})
+    if hot_reload_config.get("enabled", "false").lower() == "true":
+        ServerParamsWatcher(
+            "server_params.json",
+            params,
+            tool_catalog,
+            cache_path,
+            on_reload=_on_server_params_reload,
+            interval=float(hot_reload_config.get("interval", DEFAULT_RELOAD_INTERVAL)),
+        ).start()
+
     # Gradio UIの構築
+    # 初回リクエストが定常時と同じ応答時間になるよう、起動前にLLM接続とMCPセッションを温めておく
+    warmup_config = params.get("warmup", {})
+    if warmup_config.get("enabled", "false").lower() == "true":
+        logger.info("=== ウォームアップ中... ===")
+        report = await asyncio.wrap_future(
+            submit_to_app_loop(
+                warm_up(
+                    llm_options,
+                    resolve_servers(params),
+                    warmup_config,
+                    prompt_runner=lambda prompt: single_llm_chat(
+                        prompt, [], "有効", llm1_name
+                    ),
+                )
+            )
+        )
+        logger.info("ウォームアップ結果:\n%s", summarize_warmup(report))
+        logger.info("=== ウォームアップ完了 ===")
+
     with gr.Blocks(
         theme=gr.themes.Soft(),
         css="""
@@ -274,6 +468,19 @@ async def main() -> None:
                     function_radio = gr.Radio(
                         ["有効", "無効"], value="有効", label=None, container=False
                     )
+                    profile_checkbox = gr.Checkbox(
+                        label="このリクエストを計測（プロファイル）",
+                        value=False,
+                        container=False,
+                        visible=request_profiler.enabled,
+                    )
+                    new_chat_btn = gr.Button(
+                        "🆕 新しい会話", size="sm", visible=history_store is not None
+                    )
+                # 会話IDはブラウザに保存し、再読み込み時に同じ会話を再開する
+                conversation_state = gr.BrowserState(
+                    "", storage_key="langchain_mcp_dual_conversation"
+                )
 
                 # 2つのチャットボットを横並びで表示
                 with gr.Row(elem_classes=["dual-chat-container"]):
@@ -290,6 +497,11 @@ async def main() -> None:
                             resizable=True,
                             elem_classes=["chatbot"],
                         )
+                        stop_btn1 = gr.Button(
+                            f"⏹ {llm1_name}を停止", size="sm", variant="stop"
+                        )
+                        # トークン数・所要時間・推定コスト（直近のターンとセッション累計）
+                        usage_display1 = gr.Markdown()
 
                     # 右側のチャットボット
                     with gr.Column(elem_classes=["chat-pane"]):
@@ -304,6 +516,14 @@ async def main() -> None:
                             resizable=True,
                             elem_classes=["chatbot"],
                         )
+                        stop_btn2 = gr.Button(
+                            f"⏹ {llm2_name}を停止", size="sm", variant="stop"
+                        )
+                        # トークン数・所要時間・推定コスト（直近のターンとセッション累計）
+                        usage_display2 = gr.Markdown()
+
+                usage_state1 = gr.State(UsageTotals())
+                usage_state2 = gr.State(UsageTotals())
 
                 # 共通の入力フォーム
                 with gr.Row(elem_classes=["input-container"]):
@@ -317,6 +537,24 @@ async def main() -> None:
                     )
 
             with gr.TabItem("利用可能なツール"):
+                # 検索・サーバー絞り込み・ページ指定
+                with gr.Row():
+                    tools_query = gr.Textbox(
+                        label="検索",
+                        placeholder="ツール名・説明・サーバー名で検索...",
+                        scale=3,
+                    )
+                    tools_server = gr.Dropdown(
+                        choices=[TOOL_CATALOG_ALL_SERVERS]
+                        + list(tool_catalog.tools_by_server),
+                        value=TOOL_CATALOG_ALL_SERVERS,
+                        label="サーバー",
+                        scale=2,
+                    )
+                    tools_page = gr.Number(
+                        value=1, minimum=1, precision=0, label="ページ", scale=1
+                    )
+
                 # ツール一覧表示エリア
                 tools_display = gr.Markdown(
                     "「ツール一覧を更新」ボタンをクリックして、利用可能なツールを表示してください。",
@@ -326,30 +564,160 @@ async def main() -> None:
                 # ツール一覧更新ボタン
                 refresh_tools_btn = gr.Button("🔄 ツール一覧を更新", variant="primary")
 
-                def update_tools_display() -> str:
+                def update_tools_display(query, server_name, page) -> tuple:
                     """ツール一覧を更新する関数"""
                     try:
-                        tools_info = sync_get_available_tools_local()
-                        return tools_info
+                        tools_info, page = render_tool_catalog_page(
+                            tool_catalog, query, server_name, page
+                        )
+                        server_choices = [TOOL_CATALOG_ALL_SERVERS] + list(
+                            tool_catalog.tools_by_server
+                        )
+                        return tools_info, gr.update(choices=server_choices), page
                     except Exception as e:
-                        return f"ツール一覧の取得中にエラーが発生しました:\n{str(e)}"
+                        return (
+                            f"ツール一覧の取得中にエラーが発生しました:\n{str(e)}",
+                            gr.update(),
+                            page,
+                        )
 
-                refresh_tools_btn.click(update_tools_display, outputs=tools_display)
+                tools_inputs = [tools_query, tools_server, tools_page]
+                tools_outputs = [tools_display, tools_server, tools_page]
+                refresh_tools_btn.click(
+                    update_tools_display, inputs=tools_inputs, outputs=tools_outputs
+                )
+                tools_query.submit(
+                    lambda query, server_name, _: update_tools_display(
+                        query, server_name, 1
+                    ),
+                    inputs=tools_inputs,
+                    outputs=tools_outputs,
+                )
+                tools_server.change(
+                    lambda query, server_name, _: update_tools_display(
+                        query, server_name, 1
+                    ),
+                    inputs=tools_inputs,
+                    outputs=tools_outputs,
+                )
+                tools_page.submit(
+                    update_tools_display, inputs=tools_inputs, outputs=tools_outputs
+                )
 
-        def user_submit(user_input, history1, history2, function_calling) -> tuple:
+                # サーキットブレーカーの状態などのメトリクス
+                with gr.Accordion("メトリクス", open=False):
+                    metrics_display = gr.JSON()
+                refresh_tools_btn.click(get_metrics_snapshot, outputs=metrics_display)
+
+        async def user_submit(
+            user_input,
+            history1,
+            history2,
+            function_calling,
+            profile,
+            usage1,
+            usage2,
+            conversation_id,
+            request: gr.Request,
+        ) -> tuple:
             """
-            ユーザー入力を両方のLLMに送信し、履歴を更新する
+            ユーザー入力を両方のLLMに送信し、履歴と各ペインの使用量を更新する。
+            常駐イベントループで実行し、停止ボタン・ページを閉じた場合・再送信時はキャンセルする。
             """
-            result = sync_dual_llm_chat(
-                user_input, history1, history2, function_calling
+            result, _ = await await_on_app_loop(
+                request_profiler.run(
+                    "dual_llm_chat",
+                    dual_llm_chat(
+                        user_input,
+                        history1,
+                        history2,
+                        function_calling,
+                        usage1,
+                        usage2,
+                        session_id=request.session_hash,
+                        conversation_id=conversation_id or None,
+                    ),
+                    force=profile,
+                )
             )
-            return result
+            return result + (usage1, usage1.render(), usage2, usage2.render())
 
         # イベントハンドラーを設定
         txt.submit(
             user_submit,
-            [txt, chatbot1, chatbot2, function_radio],
-            [txt, chatbot1, txt, chatbot2],
+            [
+                txt,
+                chatbot1,
+                chatbot2,
+                function_radio,
+                profile_checkbox,
+                usage_state1,
+                usage_state2,
+                conversation_state,
+            ],
+            [
+                txt,
+                chatbot1,
+                txt,
+                chatbot2,
+                usage_state1,
+                usage_display1,
+                usage_state2,
+                usage_display2,
+            ],
+            # 実行は常駐イベントループで行うため同時実行数は制限せず、同じセッションの再送信は前の実行を置き換える
+            concurrency_limit=None,
+        )
+
+        # 各ペインは個別に停止できる
+        def stop_llm1(request: gr.Request) -> None:
+            active_runs.cancel(request.session_hash, "llm1")
+
+        def stop_llm2(request: gr.Request) -> None:
+            active_runs.cancel(request.session_hash, "llm2")
+
+        def cancel_session_runs(request: gr.Request) -> None:
+            """このセッションで実行中のエージェントをキャンセルする関数"""
+            active_runs.cancel(request.session_hash)
+
+        stop_btn1.click(stop_llm1, queue=False)
+        stop_btn2.click(stop_llm2, queue=False)
+        # ページを閉じた（切断した）場合も、誰も見ない回答の生成を止める
+        demo.unload(cancel_session_runs)
+
+        def restore_conversation(conversation_id) -> tuple:
+            """
+            ページ読み込み時に、保存済みの会話の直近のメッセージを各ペインに読み込む関数
+            """
+            if history_store is None:
+                return conversation_id, gr.update(), gr.update()
+            conversation_id = conversation_id or uuid.uuid4().hex
+            return (
+                conversation_id,
+                history_store.load_recent(conversation_id, "llm1"),
+                history_store.load_recent(conversation_id, "llm2"),
+            )
+
+        def start_new_conversation() -> tuple:
+            """新しい会話IDを発行し、両方のペインと使用量の表示を空にする関数"""
+            return uuid.uuid4().hex, [], [], UsageTotals(), "", UsageTotals(), ""
+
+        demo.load(
+            restore_conversation,
+            inputs=conversation_state,
+            outputs=[conversation_state, chatbot1, chatbot2],
+        )
+        new_chat_btn.click(
+            start_new_conversation,
+            outputs=[
+                conversation_state,
+                chatbot1,
+                chatbot2,
+                usage_state1,
+                usage_display1,
+                usage_state2,
+                usage_display2,
+            ],
         )
 
     demo.launch(share=False, server_name="127.0.0.1", server_port=7861)
@@ -0,0 +1,167 @@
+import asyncio
+import contextlib
+import logging
+
+import uvicorn
+from mcp import types
+from mcp.server.lowlevel import Server
+from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from langchain_mcp_utils import load_server_params
+from app_logging import configure_logging
+from mcp_supervisor import (
+    PersistentMCPSession,
+    GATEWAY_SERVER_PATH,
+    DEFAULT_GATEWAY_HOST,
+    DEFAULT_GATEWAY_PORT,
+    get_gateway_server_url,
+    StdioSupervisor,
+)
+
+logger = logging.getLogger("mcp_gateway")
+
+
+class _SessionManagerApp:
+    # StreamableHTTPSessionManagerをStarletteのRouteにASGIアプリとして登録するためのラッパー
+    def __init__(self, session_manager: StreamableHTTPSessionManager) -> None:
+        self.session_manager = session_manager
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.session_manager.handle_request(scope, receive, send)
+
+
+def build_gateway_server(backend: PersistentMCPSession) -> Server:
+    """
+    1つのMCPサーバーへの呼び出しを、共有セッションへそのまま中継するMCPサーバーを作成する関数。
+    Args:
+        backend (PersistentMCPSession): 中継先のセッション
+    Returns:
+        Server: 中継用のMCPサーバー
+    """
+    server = Server(f"gateway-{backend.name}")
+
+    async def list_tools(request: types.ListToolsRequest) -> types.ServerResult:
+        cursor = request.params.cursor if request.params else None
+        return types.ServerResult(await backend.list_tools(cursor))
+
+    async def call_tool(request: types.CallToolRequest) -> types.ServerResult:
+        # isErrorや構造化結果も含め、サーバーの応答をそのまま返す
+        return types.ServerResult(
+            await backend.call_tool(request.params.name, request.params.arguments)
+        )
+
+    server.request_handlers[types.ListToolsRequest] = list_tools
+    server.request_handlers[types.CallToolRequest] = call_tool
+    return server
+
+
+def build_gateway_app(
+    backends: dict, supervisor: StdioSupervisor | None = None
+) -> Starlette:
+    """
+    MCPゲートウェイのASGIアプリを作成する関数。
+    各サーバーを GATEWAY_SERVER_PATH のstreamable_httpエンドポイントとして公開し、
+    すべてのアプリプロセスからの呼び出しを1つの共有セッション（1プロセス）に集約する。
+    Args:
+        backends (dict): サーバー名とPersistentMCPSessionの辞書
+        supervisor (StdioSupervisor | None): ヘルスチェック・自動再起動を行う監視（backendsの管理元）
+    Returns:
+        Starlette: ASGIアプリ
+    """
+    # ステートレスにすることで、HTTPリクエストごとにゲートウェイ側のセッション状態を持たない
+    managers = {
+        name: StreamableHTTPSessionManager(
+            app=build_gateway_server(backend), stateless=True, json_response=True
+        )
+        for name, backend in backends.items()
+    }
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        async with contextlib.AsyncExitStack() as stack:
+            for manager in managers.values():
+                await stack.enter_async_context(manager.run())
+            # 起動時にすべてのサーバーを立ち上げておく（失敗したサーバーは初回呼び出し時に再試行）
+            results = await asyncio.gather(
+                *(backend.get_session() for backend in backends.values()),
+                return_exceptions=True,
+            )
+            for name, result in zip(backends, results):
+                if isinstance(result, Exception):
+                    logger.warning(
+                        "MCPサーバー(%s)の起動に失敗しました: %s", name, result
+                    )
+                else:
+                    logger.info("MCPサーバー(%s)を起動しました", name)
+            monitor = (
+                asyncio.create_task(supervisor.monitor())
+                if supervisor is not None
+                else None
+            )
+            try:
+                yield
+            finally:
+                if monitor is not None:
+                    monitor.cancel()
+                await asyncio.gather(
+                    *(backend.close() for backend in backends.values())
+                )
+
+    async def status(request):
+        if supervisor is not None:
+            return JSONResponse(supervisor.snapshot())
+        return JSONResponse(
+            {
+                name: {"open": backend.is_open, "opened_count": backend.opened_count}
+                for name, backend in backends.items()
+            }
+        )
+
+    routes = [
+        Route(
+            GATEWAY_SERVER_PATH.format(name=name), endpoint=_SessionManagerApp(manager)
+        )
+        for name, manager in managers.items()
+    ]
+    routes.append(Route("/status", endpoint=status))
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+def main() -> None:
+    """
+    メイン関数。server_params.jsonのstdioサーバーを起動し、ゲートウェイとして公開する。
+    """
+    params_file_name = "server_params.json"
+    params = load_server_params(params_file_name)
+    if not params:
+        logger.error("設定ファイル(%s)が見つからないか、無効です。", params_file_name)
+        return
+
+    configure_logging(params.get("logging", {}))
+    gateway_config = params.get("gateway", {})
+    host = gateway_config.get("host", DEFAULT_GATEWAY_HOST)
+    port = int(gateway_config.get("port", DEFAULT_GATEWAY_PORT))
+    # HTTPのサーバーは各アプリから直接接続するため、stdioのサーバーのみゲートウェイで常駐・監視する
+    supervisor = StdioSupervisor()
+    supervisor.configure(
+        {**params.get("supervisor", {}), "enabled": "true"},
+        params.get("servers", {}),
+        params.get("server_options", {}),
+    )
+    backends = supervisor.servers
+    logger.info("=== MCPゲートウェイを起動します: http://%s:%s ===", host, port)
+    for name in backends:
+        logger.info("  %s: %s", name, get_gateway_server_url(gateway_config, name))
+    uvicorn.run(
+        build_gateway_app(backends, supervisor),
+        host=host,
+        port=port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import threading
+import weakref
+import httpx
+from langchain_mcp_adapters.sessions import create_session
+
+from app_metrics import register_metrics_provider
+
+logger = logging.getLogger(__name__)
+
+
+# HTTP（streamable_http・sse）のMCPサーバーへの接続設定の既定値（server_params.jsonのmcp_httpセクションで上書きする）
+DEFAULT_MCP_HTTP_SETTINGS = {
+    "enabled": "false",
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": "false",
+    # 0の場合は各サーバー設定（timeout, sse_read_timeout）の値を使う
+    "connect_timeout": 10.0,
+    "read_timeout": 0,
+    "decompression": "true",
+}
+HTTP_MCP_TRANSPORTS = ("streamable_http", "sse")
+# 設定の再読み込みで入れ替えたプールは、実行中のリクエストが終わるまでこの秒数待ってから閉じる
+_RETIRED_POOL_GRACE_SECONDS = 30.0
+
+
+async def _close_retired_transport(transport: httpx.AsyncHTTPTransport) -> None:
+    await asyncio.sleep(_RETIRED_POOL_GRACE_SECONDS)
+    await transport.aclose()
+
+
+class MCPHttpPool:
+    """
+    HTTPのMCPサーバーへのリクエストで共有するコネクションプール。
+    セッションごとにhttpxクライアントを作り直しても、TCP・TLSの接続はプールから再利用する。
+    接続はイベントループに結び付くため、プールはイベントループごとに1つ作る。
+    """
+
+    def __init__(self, settings: dict | None = None) -> None:
+        self._lock = threading.Lock()
+        self._transports = weakref.WeakKeyDictionary()
+        self.stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "tls_handshakes": 0,
+            "http2_requests": 0,
+            "errors": 0,
+        }
+        self.configure(settings or {})
+
+    def configure(self, settings: dict) -> None:
+        """
+        設定を反映する（作成済みのプールは、次のリクエストから新しい設定で作り直す）
+        Args:
+            settings (dict): server_params.jsonのmcp_httpセクション
+        """
+        settings = {**DEFAULT_MCP_HTTP_SETTINGS, **settings}
+        http2 = str(settings["http2"]).lower() == "true"
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning(
+                    "h2がインストールされていないため、MCPサーバーへの接続はHTTP/1.1を使います"
+                )
+                http2 = False
+        with self._lock:
+            retired = list(self._transports.items())
+            self.settings = settings
+            self.enabled = str(settings["enabled"]).lower() == "true"
+            self.http2 = http2
+            self._transports = weakref.WeakKeyDictionary()
+        # 入れ替え前のプールの接続は、作成したイベントループ上で閉じる
+        # （終了したイベントループの接続は、ループとともに破棄されている）
+        for loop, transport in retired:
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(
+                    _close_retired_transport(transport), loop
+                )
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = httpx.AsyncHTTPTransport(
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=int(self.settings["max_connections"]),
+                        max_keepalive_connections=int(
+                            self.settings["max_keepalive_connections"]
+                        ),
+                        keepalive_expiry=float(self.settings["keepalive_expiry"]),
+                    ),
+                )
+                self._transports[loop] = transport
+            return transport
+
+    async def _trace(self, event: str, info: dict) -> None:
+        # 新しい接続・TLSハンドシェイクの回数を数え、再利用できた割合を求める
+        if event == "connection.connect_tcp.complete":
+            self._count("connections_opened")
+        elif event == "connection.start_tls.complete":
+            self._count("tls_handshakes")
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if "trace" not in request.extensions:
+            request.extensions["trace"] = self._trace
+        if str(self.settings["decompression"]).lower() != "true":
+            request.headers["Accept-Encoding"] = "identity"
+        self._count("requests")
+        try:
+            response = await self._transport().handle_async_request(request)
+        except Exception:
+            self._count("errors")
+            raise
+        if response.extensions.get("http_version") == b"HTTP/2":
+            self._count("http2_requests")
+        return response
+
+    def timeout(self, timeout: httpx.Timeout | None) -> httpx.Timeout:
+        """
+        サーバー設定のタイムアウトに、mcp_httpセクションのconnect_timeout・read_timeoutを反映する
+        Args:
+            timeout (httpx.Timeout | None): MCPクライアントが指定したタイムアウト
+        Returns:
+            httpx.Timeout: 適用するタイムアウト
+        """
+        timeout = timeout or httpx.Timeout(30.0)
+        connect = float(self.settings["connect_timeout"]) or timeout.connect
+        read = float(self.settings["read_timeout"]) or timeout.read
+        return httpx.Timeout(
+            connect=connect, read=read, write=timeout.write, pool=timeout.pool
+        )
+
+    def client_factory(self, headers=None, timeout=None, auth=None):
+        """
+        MCPクライアントに渡すhttpx_client_factory。
+        クライアントはセッションごとに作られて閉じられるが、接続は共有のプールに残る。
+        """
+        return httpx.AsyncClient(
+            transport=_SharedPoolTransport(self),
+            headers=headers,
+            timeout=self.timeout(timeout),
+            auth=auth,
+            follow_redirects=True,
+        )
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            pools = len(self._transports)
+        return {
+            "enabled": self.enabled,
+            "http2": self.http2,
+            "pools": pools,
+            **stats,
+            "reused": max(stats["requests"] - stats["connections_opened"], 0),
+        }
+
+
+class _SharedPoolTransport(httpx.AsyncBaseTransport):
+    # クライアントを閉じても共有のプールは閉じないよう、プールへの委譲だけを行う
+    def __init__(self, pool: MCPHttpPool) -> None:
+        self.pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.pool.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        pass
+
+
+# プロセス全体で共有するHTTPのMCPサーバーへのコネクションプール
+mcp_http_pool = MCPHttpPool()
+register_metrics_provider("mcp_http", mcp_http_pool.snapshot)
+
+
+def configure_mcp_http(config: dict) -> None:
+    """
+    server_params.jsonのmcp_httpセクションを反映する関数
+    Args:
+        config (dict): HTTPのMCPサーバーへの接続設定
+    """
+    mcp_http_pool.configure(config or {})
+
+
+def open_mcp_session(connection: dict):
+    """
+    MCPサーバーとのセッションを開く関数（create_sessionと同じく、async withで使う）。
+    mcp_httpが有効な場合、HTTPのサーバーへの接続は共有のコネクションプールを使う。
+    Args:
+        connection (dict): サーバー接続設定
+    Returns:
+        セッションを返す非同期コンテキストマネージャ
+    """
+    if (
+        mcp_http_pool.enabled
+        and connection.get("transport") in HTTP_MCP_TRANSPORTS
+        and not connection.get("httpx_client_factory")
+    ):
+        connection = {
+            **connection,
+            "httpx_client_factory": mcp_http_pool.client_factory,
+        }
+    return create_session(connection)
@@ -0,0 +1,309 @@
+import asyncio
+import collections
+import threading
+import time
+
+from app_metrics import register_metrics_provider
+
+
+# 1サーバーあたりの同時ツール呼び出し数の既定値
+DEFAULT_SERVER_MAX_CONCURRENCY = 4
+
+# server_params.jsonのserver_optionsセクション（サーバー名ごとの追加設定）
+server_options = {}
+_server_limiters = {}
+
+
+class ConcurrencyLimiter:
+    """
+    同時実行数を制限する非同期セマフォ。
+    Gradioのリクエストごとに異なるイベントループ（スレッド）から使われるため、
+    待機者の管理はスレッドロックで行い、各ループへはcall_soon_threadsafeで通知する。
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+
+    async def acquire(self) -> None:
+        """
+        実行枠を1つ確保する（空きがなければ先着順で待機する）
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # 枠を受け取った直後にキャンセルされた場合は枠を返す
+            if not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """
+        実行枠を1つ返し、待機者がいれば引き継ぐ
+        """
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    # 待機者のイベントループが既に閉じている
+                    continue
+            self.active -= 1
+
+    def _grant(self, future) -> None:
+        if future.cancelled():
+            # 引き継ぎ前にキャンセルされていた場合は次の待機者へ回す
+            self.release()
+        else:
+            future.set_result(None)
+
+    async def __aenter__(self) -> "ConcurrencyLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+def configure_server_options(options: dict) -> None:
+    """
+    server_params.jsonのserver_optionsセクションを反映する関数
+    Args:
+        options (dict): サーバー名をキーとした追加設定
+    """
+    global server_options
+    server_options = dict(options or {})
+    # 上限が変わったサーバーのリミッターは作り直す
+    for server_name in list(_server_limiters):
+        if _server_limiters[server_name].limit != _get_server_max_concurrency(
+            server_name
+        ):
+            del _server_limiters[server_name]
+    # 設定が変わったサーバーのサーキットブレーカーは作り直す
+    for server_name in list(_server_breakers):
+        if _server_breakers[server_name].settings != _get_breaker_settings(server_name):
+            del _server_breakers[server_name]
+
+
+def _get_server_max_concurrency(server_name: str) -> int:
+    return int(
+        server_options.get(server_name, {}).get(
+            "max_concurrency", DEFAULT_SERVER_MAX_CONCURRENCY
+        )
+    )
+
+
+def get_server_limiter(server_name: str) -> ConcurrencyLimiter:
+    """
+    サーバーごとの同時ツール呼び出し数リミッターを取得する関数
+    Args:
+        server_name (str): サーバー名
+    Returns:
+        ConcurrencyLimiter: サーバーのリミッター
+    """
+    limiter = _server_limiters.get(server_name)
+    if limiter is None:
+        limiter = _server_limiters.setdefault(
+            server_name, ConcurrencyLimiter(_get_server_max_concurrency(server_name))
+        )
+    return limiter
+
+
+# ツール呼び出しのタイムアウト（秒）とサーキットブレーカーの既定値
+DEFAULT_TOOL_TIMEOUT = 120.0
+DEFAULT_BREAKER_SETTINGS = {
+    "failure_threshold": 5,
+    "slow_call_seconds": 60.0,
+    "reset_seconds": 30.0,
+}
+
+_server_breakers = {}
+
+
+class CircuitBreaker:
+    """
+    サーバー単位のサーキットブレーカー。
+    失敗（タイムアウト・接続エラー・低速な呼び出し）が連続して閾値に達するとopenになり、
+    reset_seconds経過後に1回だけ試行（half_open）を許可して、成功すればclosedに戻る。
+    """
+
+    def __init__(self, settings: dict) -> None:
+        self.settings = settings
+        self.failure_threshold = int(settings["failure_threshold"])
+        self.slow_call_seconds = float(settings["slow_call_seconds"])
+        self.reset_seconds = float(settings["reset_seconds"])
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_count = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        呼び出しを許可するかを判定する
+        Returns:
+            bool: 許可する場合はTrue
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = "half_open"
+            # half_openでは同時に1件だけ試行する
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def retry_after(self) -> float:
+        """
+        openの場合に、試行が再開されるまでの残り秒数を返す
+        Returns:
+            float: 残り秒数
+        """
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def record_success(self, duration: float) -> None:
+        """
+        呼び出しの成功を記録する（slow_call_seconds以上かかった呼び出しは失敗とみなす）
+        Args:
+            duration (float): 所要時間（秒）
+        """
+        if duration >= self.slow_call_seconds:
+            self.record_failure()
+            return
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        """
+        呼び出しの失敗を記録する
+        """
+        with self._lock:
+            self.consecutive_failures += 1
+            if (
+                self.state == "half_open"
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != "open":
+                    self.open_count += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """
+        呼び出しがキャンセルされた場合に、成否を記録せずhalf_openの試行枠を返す
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self) -> dict:
+        """
+        現在の状態を返す
+        Returns:
+            dict: 状態・連続失敗数・open回数・再開までの秒数
+        """
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "open_count": self.open_count,
+                "retry_after": round(self.retry_after(), 1)
+                if self.state == "open"
+                else 0.0,
+            }
+
+
+def _get_breaker_settings(server_name: str) -> dict:
+    return {
+        **DEFAULT_BREAKER_SETTINGS,
+        **server_options.get(server_name, {}).get("breaker", {}),
+    }
+
+
+def get_server_breaker(server_name: str) -> CircuitBreaker:
+    """
+    サーバーごとのサーキットブレーカーを取得する関数
+    Args:
+        server_name (str): サーバー名
+    Returns:
+        CircuitBreaker: サーバーのサーキットブレーカー
+    """
+    breaker = _server_breakers.get(server_name)
+    if breaker is None:
+        breaker = _server_breakers.setdefault(
+            server_name, CircuitBreaker(_get_breaker_settings(server_name))
+        )
+    return breaker
+
+
+register_metrics_provider(
+    "server_concurrency",
+    lambda: {
+        name: {
+            "active": limiter.active,
+            "limit": limiter.limit,
+            "waiting": len(limiter._waiters),
+        }
+        for name, limiter in list(_server_limiters.items())
+    },
+)
+register_metrics_provider(
+    "circuit_breakers",
+    lambda: {
+        name: breaker.snapshot() for name, breaker in list(_server_breakers.items())
+    },
+)
+
+
+def get_tool_timeout(server_name: str, tool_name: str) -> float:
+    """
+    ツール呼び出しのタイムアウトを取得する関数。
+    server_optionsのtool_timeouts（ツール単位）、timeout（サーバー単位）、既定値の順に優先する。
+    Args:
+        server_name (str): サーバー名
+        tool_name (str): ツール名
+    Returns:
+        float: タイムアウト（秒）
+    """
+    options = server_options.get(server_name, {})
+    timeout = options.get("tool_timeouts", {}).get(
+        tool_name, options.get("timeout", DEFAULT_TOOL_TIMEOUT)
+    )
+    return float(timeout)
+
+
+_BREAKER_STATE_LABELS = {"closed": "正常", "open": "停止中", "half_open": "試行中"}
+
+
+def format_breaker_state(server_name: str) -> str:
+    breaker = _server_breakers.get(server_name)
+    if breaker is None:
+        return ""
+    state = breaker.snapshot()
+    label = _BREAKER_STATE_LABELS.get(state["state"], state["state"])
+    if state["state"] == "open":
+        label += f"、約{state['retry_after']:.0f}秒後に再試行"
+    return f" （サーキット: {label}）"
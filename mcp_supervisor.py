@@ -0,0 +1,536 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import urllib.parse
+import anyio
+from mcp.shared.exceptions import McpError
+from mcp.types import (
+    CONNECTION_CLOSED,
+    CancelledNotification,
+    CancelledNotificationParams,
+    ClientNotification,
+)
+
+try:
+    import psutil
+except ImportError:  # psutilがない場合は、プロセスのPID・メモリ・CPUを監視しない
+    psutil = None
+
+from app_metrics import register_metrics_provider
+from app_loop import submit_to_app_loop
+from mcp_http import open_mcp_session
+
+logger = logging.getLogger(__name__)
+
+
+class PersistentMCPSession:
+    """
+    1つのMCPサーバーとのセッションを開いたまま保持し、複数のツール呼び出しで共有するクラス。
+    ClientSessionはリクエストIDで応答を対応付けるため、同じセッションで並行して呼び出せる。
+    セッションは専用のタスク内で開閉し、切断された場合は次の呼び出しで開き直す。
+    """
+
+    def __init__(self, name: str, connection: dict) -> None:
+        self.name = name
+        self.connection = connection
+        self.session = None
+        self.opened_count = 0
+        self._task = None
+        self._closing = None
+        self._lock = None
+        self._notifications = set()
+
+    async def _own(self, ready: asyncio.Future) -> None:
+        closing = asyncio.Event()
+        self._closing = closing
+        try:
+            async with open_mcp_session(self.connection) as session:
+                await session.initialize()
+                self.session = session
+                self.opened_count += 1
+                ready.set_result(session)
+                await closing.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning(
+                    "MCPサーバー(%s)とのセッションが終了しました: %s",
+                    self.name,
+                    e,
+                    extra={"server": self.name},
+                )
+        finally:
+            self.session = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.session is not None and not self._task.done()
+
+    async def get_session(self):
+        """
+        開いているセッションを返す（未接続・切断済みの場合は開き直す）
+        Returns:
+            ClientSession: 初期化済みのセッション
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.is_open:
+                return self.session
+            ready = asyncio.get_running_loop().create_future()
+            self._task = asyncio.create_task(
+                self._own(ready), name=f"mcp-session-{self.name}"
+            )
+            return await ready
+
+    async def list_tools(self, cursor: str | None = None):
+        session = await self.get_session()
+        return await session.list_tools(cursor)
+
+    async def call_tool(self, name: str, arguments: dict | None = None):
+        """
+        共有セッションでツールを呼び出す。
+        送信前に切断を検知した場合は開き直して1回だけ再送し、
+        呼び出し中に切断された場合はツールが実行済みの可能性があるため再送しない。
+        Args:
+            name (str): ツール名
+            arguments (dict | None): ツールの引数
+        Returns:
+            CallToolResult: ツールの実行結果
+        """
+        session = await self.get_session()
+        try:
+            return await self._call_tool(session, name, arguments)
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+            await self.reset()
+            session = await self.get_session()
+            return await self._call_tool(session, name, arguments)
+        except McpError as e:
+            if e.error.code == CONNECTION_CLOSED:
+                await self.reset()
+            raise
+
+    async def _call_tool(self, session, name: str, arguments: dict | None):
+        # ClientSessionは次のリクエストIDを送信時に採番するため、呼び出し前に控えておく
+        request_id = session._request_id
+        try:
+            return await session.call_tool(name, arguments)
+        except asyncio.CancelledError:
+            # 共有セッションは閉じないため、サーバー側の処理も止めるようキャンセルを通知する
+            notification = asyncio.create_task(
+                session.send_notification(
+                    ClientNotification(
+                        CancelledNotification(
+                            method="notifications/cancelled",
+                            params=CancelledNotificationParams(
+                                requestId=request_id, reason="cancelled by client"
+                            ),
+                        )
+                    )
+                )
+            )
+            self._notifications.add(notification)
+            notification.add_done_callback(self._notifications.discard)
+            raise
+
+    async def _close_session(self) -> None:
+        if self._closing is not None:
+            self._closing.set()
+        if self._task is not None:
+            with contextlib.suppress(Exception, asyncio.CancelledError):
+                await self._task
+        self.session = None
+
+    async def reset(self) -> None:
+        """
+        切断を検知したときにセッションを破棄する（次の呼び出しで開き直す）
+        """
+        await self._close_session()
+
+    async def close(self) -> None:
+        """
+        セッションを閉じ、サーバープロセスを終了する
+        """
+        await self._close_session()
+
+
+# MCPゲートウェイ上の各サーバーのエンドポイント
+GATEWAY_SERVER_PATH = "/servers/{name}/mcp"
+DEFAULT_GATEWAY_HOST = "127.0.0.1"
+DEFAULT_GATEWAY_PORT = 8020
+
+
+def get_gateway_server_url(gateway_config: dict, server_name: str) -> str:
+    """
+    ゲートウェイ経由でMCPサーバーに接続するURLを返す関数
+    Args:
+        gateway_config (dict): server_params.jsonのgatewayセクション
+        server_name (str): サーバー名
+    Returns:
+        str: streamable_httpのURL
+    """
+    base_url = gateway_config.get(
+        "url",
+        f"http://{gateway_config.get('host', DEFAULT_GATEWAY_HOST)}"
+        f":{gateway_config.get('port', DEFAULT_GATEWAY_PORT)}",
+    )
+    path = GATEWAY_SERVER_PATH.format(name=urllib.parse.quote(server_name, safe=""))
+    return base_url.rstrip("/") + path
+
+
+def resolve_servers(params: dict) -> dict:
+    """
+    アプリが接続するMCPサーバー設定を返す関数。
+    gatewayが有効な場合、stdioのサーバーはゲートウェイ経由（streamable_http）に置き換える。
+    Args:
+        params (dict): server_params.jsonの内容
+    Returns:
+        dict: サーバー名とサーバー設定の辞書
+    """
+    servers = params.get("servers", {})
+    gateway_config = params.get("gateway", {})
+    if gateway_config.get("enabled", "false").lower() != "true":
+        return servers
+    return {
+        name: (
+            {
+                "transport": "streamable_http",
+                "url": get_gateway_server_url(gateway_config, name),
+            }
+            if config.get("transport") == "stdio"
+            else config
+        )
+        for name, config in servers.items()
+    }
+
+
+# stdioサーバーの監視設定の既定値
+DEFAULT_SUPERVISOR_SETTINGS = {
+    "health_interval": 30.0,
+    "health_timeout": 10.0,
+    "restart_initial_delay": 1.0,
+    "restart_max_delay": 60.0,
+    "recycle_after_calls": 0,
+    "max_rss_mb": 0,
+}
+
+
+def _child_pids() -> set:
+    if psutil is None:
+        return set()
+    return {child.pid for child in psutil.Process().children()}
+
+
+class SupervisedServer(PersistentMCPSession):
+    """
+    監視対象のstdioサーバー。共有セッションに加えて、プロセスのPID・メモリ・CPU、
+    呼び出し回数、ヘルスチェックの結果、再起動回数を記録する。
+    """
+
+    def __init__(self, supervisor, name: str, connection: dict, settings: dict):
+        super().__init__(name, connection)
+        self.supervisor = supervisor
+        self.settings = settings
+        self.state = "starting"
+        self.pid = None
+        self.calls = 0
+        self.calls_since_start = 0
+        self.in_flight = 0
+        self.restarts = 0
+        self.recycles = 0
+        self.failures = 0
+        self.next_restart_at = 0.0
+        self.last_error = ""
+        self.rss_mb = None
+        self.cpu_percent = None
+        self._process = None
+
+    def _find_pid(self, new_pids: set):
+        # 同時に起動した他のプロセスと区別するため、コマンド名が一致する子プロセスを優先する
+        command = os.path.splitext(os.path.basename(self.connection.get("command", "")))
+        for pid in sorted(new_pids):
+            with contextlib.suppress(psutil.Error):
+                cmdline = psutil.Process(pid).cmdline()
+                if cmdline and os.path.basename(cmdline[0]).startswith(command[0]):
+                    return pid
+        return min(new_pids) if new_pids else None
+
+    async def get_session(self):
+        if self.is_open:
+            return self.session
+        # 起動直後の子プロセスの差分からPIDを特定するため、起動は1つずつ行う
+        async with self.supervisor.spawn_lock:
+            if self.is_open:
+                return self.session
+            previous = self.state
+            before = _child_pids()
+            try:
+                session = await super().get_session()
+            except Exception as e:
+                self.failures += 1
+                delay = min(
+                    float(self.settings["restart_max_delay"]),
+                    float(self.settings["restart_initial_delay"])
+                    * 2 ** (self.failures - 1),
+                )
+                self.state = "restarting"
+                self.last_error = f"{type(e).__name__}: {e}"
+                self.next_restart_at = time.monotonic() + delay
+                raise
+            self.pid = self._find_pid(_child_pids() - before)
+            self._process = psutil.Process(self.pid) if self.pid else None
+            self.calls_since_start = 0
+            self.failures = 0
+            self.state = "running"
+            if previous == "recycling":
+                self.recycles += 1
+            elif previous == "restarting":
+                self.restarts += 1
+            return session
+
+    async def call_tool(self, name: str, arguments: dict | None = None):
+        self.calls += 1
+        self.calls_since_start += 1
+        self.in_flight += 1
+        try:
+            return await super().call_tool(name, arguments)
+        finally:
+            self.in_flight -= 1
+
+    def _process_alive(self) -> bool:
+        if self._process is None:
+            return True
+        try:
+            return self._process.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    def _sample_resources(self) -> None:
+        if self._process is None:
+            return
+        try:
+            processes = [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        cpu = 0.0
+        for process in processes:
+            with contextlib.suppress(psutil.Error):
+                rss += process.memory_info().rss
+                cpu += process.cpu_percent(None)
+        self.rss_mb = round(rss / (1024 * 1024), 1)
+        self.cpu_percent = round(cpu, 1)
+
+    async def _probe(self) -> None:
+        if not self.is_open:
+            raise ConnectionError("セッションが閉じています")
+        if not self._process_alive():
+            raise ConnectionError(f"プロセス(PID {self.pid})が終了しています")
+        timeout = float(self.settings["health_timeout"])
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout)
+        except McpError:
+            # pingに対応していないサーバーはツール一覧の取得で代用する
+            await asyncio.wait_for(self.session.list_tools(), timeout)
+
+    def _needs_recycle(self) -> bool:
+        recycle_after = int(self.settings["recycle_after_calls"])
+        max_rss_mb = float(self.settings["max_rss_mb"])
+        return bool(
+            (recycle_after and self.calls_since_start >= recycle_after)
+            or (max_rss_mb and self.rss_mb is not None and self.rss_mb > max_rss_mb)
+        )
+
+    async def check(self) -> None:
+        """
+        ヘルスチェックを1回行い、必要に応じて再起動・入れ替えを行う。
+        異常時はバックオフ（失敗のたびに倍にした待ち時間）を空けて再起動し、
+        呼び出し回数・メモリ使用量が上限を超えたプロセスは、実行中の呼び出しがないときに入れ替える。
+        """
+        if self.state == "stopped":
+            return
+        if self.state == "running":
+            try:
+                await self._probe()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.warning(
+                    "MCPサーバー(%s)のヘルスチェックに失敗しました: %s",
+                    self.name,
+                    e,
+                    extra={"server": self.name, "pid": self.pid},
+                )
+                await self.reset()
+            else:
+                self._sample_resources()
+                if not (self._needs_recycle() and self.in_flight == 0):
+                    return
+                detail = f"呼び出し: {self.calls_since_start}回"
+                if self.rss_mb is not None:
+                    detail += f", メモリ: {self.rss_mb}MB"
+                logger.info(
+                    "MCPサーバー(%s)を入れ替えます (%s)",
+                    self.name,
+                    detail,
+                    extra={"server": self.name, "pid": self.pid},
+                )
+                await self._shutdown("recycling")
+        if time.monotonic() >= self.next_restart_at:
+            try:
+                await self.get_session()
+            except Exception as e:
+                logger.warning(
+                    "MCPサーバー(%s)の起動に失敗しました: %s",
+                    self.name,
+                    e,
+                    extra={"server": self.name},
+                )
+
+    async def _shutdown(self, state: str) -> None:
+        self.state = state
+        await self._close_session()
+        self._process = None
+        self.rss_mb = None
+        self.cpu_percent = None
+
+    async def reset(self) -> None:
+        await self._shutdown("restarting")
+        self.next_restart_at = time.monotonic()
+
+    async def close(self) -> None:
+        await self._shutdown("stopped")
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "pid": self.pid,
+            "rss_mb": self.rss_mb,
+            "cpu_percent": self.cpu_percent,
+            "calls": self.calls,
+            "calls_since_start": self.calls_since_start,
+            "restarts": self.restarts,
+            "recycles": self.recycles,
+            "last_error": self.last_error,
+        }
+
+
+class StdioSupervisor:
+    """
+    stdioのMCPサーバーを常駐させて監視するクラス。
+    各サーバーを1プロセスずつ起動してセッションを共有し、定期的なヘルスチェックで
+    クラッシュ・応答なしを検知して自動で再起動する。セッションは監視ループと同じイベントループでのみ使用する。
+    """
+
+    def __init__(self) -> None:
+        self.servers = {}
+        self.spawn_lock = asyncio.Lock()
+        self.interval = DEFAULT_SUPERVISOR_SETTINGS["health_interval"]
+
+    def configure(self, config: dict, servers: dict, options: dict) -> list:
+        """
+        監視対象のサーバーを設定する（設定が変わっていないサーバーはそのまま使い続ける）
+        Args:
+            config (dict): server_params.jsonのsupervisorセクション
+            servers (dict): server_params.jsonのserversセクション
+            options (dict): server_params.jsonのserver_optionsセクション
+        Returns:
+            list: 監視対象から外したサーバー（呼び出し側で閉じる）
+        """
+        enabled = config.get("enabled", "false").lower() == "true"
+        defaults = {
+            key: config.get(key, value)
+            for key, value in DEFAULT_SUPERVISOR_SETTINGS.items()
+        }
+        self.interval = float(defaults["health_interval"])
+        removed = []
+        current = {}
+        for name, connection in servers.items():
+            if not enabled or connection.get("transport") != "stdio":
+                continue
+            settings = {**defaults, **options.get(name, {}).get("supervisor", {})}
+            server = self.servers.get(name)
+            if server is not None and server.connection == connection:
+                server.settings = settings
+            else:
+                if server is not None:
+                    removed.append(server)
+                server = SupervisedServer(self, name, connection, settings)
+            current[name] = server
+        removed += [
+            server for name, server in self.servers.items() if name not in current
+        ]
+        self.servers = current
+        return removed
+
+    def get(self, server_name: str):
+        return self.servers.get(server_name)
+
+    async def check_all(self) -> None:
+        """
+        すべてのサーバーのヘルスチェックを並行して1回行う
+        """
+        await asyncio.gather(
+            *(server.check() for server in list(self.servers.values())),
+            return_exceptions=True,
+        )
+
+    async def monitor(self) -> None:
+        """
+        ヘルスチェックを定期的に実行し続ける（監視対象のセッションと同じイベントループで実行する）
+        """
+        while True:
+            await self.check_all()
+            await asyncio.sleep(self.interval)
+
+    def snapshot(self) -> dict:
+        return {name: server.snapshot() for name, server in self.servers.items()}
+
+
+stdio_supervisor = StdioSupervisor()
+register_metrics_provider("stdio_servers", stdio_supervisor.snapshot)
+_supervisor_monitor = None
+
+
+def configure_stdio_supervisor(config: dict, servers: dict, options: dict) -> None:
+    """
+    アプリ内でstdioサーバーを常駐・監視する設定を反映する関数。
+    監視ループとセッションは常駐イベントループ（get_app_loop）で動かす。
+    Args:
+        config (dict): server_params.jsonのsupervisorセクション
+        servers (dict): アプリが接続するサーバー設定（resolve_serversの戻り値）
+        options (dict): server_params.jsonのserver_optionsセクション
+    """
+    global _supervisor_monitor
+    removed = stdio_supervisor.configure(config, servers, options)
+    for server in removed:
+        submit_to_app_loop(server.close())
+    if stdio_supervisor.servers and _supervisor_monitor is None:
+        _supervisor_monitor = submit_to_app_loop(stdio_supervisor.monitor())
+
+
+_SUPERVISOR_STATE_LABELS = {
+    "starting": "起動中",
+    "running": "稼働中",
+    "restarting": "再起動待ち",
+    "recycling": "入れ替え中",
+    "stopped": "停止",
+}
+
+
+def format_supervisor_state(server_name: str) -> str:
+    server = stdio_supervisor.get(server_name)
+    if server is None:
+        return ""
+    state = server.snapshot()
+    parts = [_SUPERVISOR_STATE_LABELS.get(state["state"], state["state"])]
+    if state["pid"]:
+        parts.append(f"PID {state['pid']}")
+    if state["rss_mb"] is not None:
+        parts.append(f"メモリ {state['rss_mb']}MB")
+    if state["cpu_percent"] is not None:
+        parts.append(f"CPU {state['cpu_percent']}%")
+    parts.append(f"再起動 {state['restarts']}回")
+    return f" （プロセス: {', '.join(parts)}）"
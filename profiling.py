@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from app_metrics import register_metrics_provider
+
+logger = logging.getLogger(__name__)
+
+
+# リクエスト単位のプロファイル設定の既定値
+DEFAULT_PROFILE_SETTINGS = {
+    "enabled": "false",
+    "mode": "sampling",
+    "sample_rate": 0.0,
+    "max_per_minute": 2,
+    "interval_ms": 5,
+    "dir": "profiles",
+    "max_files": 50,
+}
+
+
+class FrameSampler:
+    """
+    指定したスレッドのスタックを一定間隔で採取し、フレームグラフ用のfolded形式に集計するクラス。
+    対象スレッドの実行には介入しないため、cProfileより低いオーバーヘッドで計測できる。
+    """
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._sample, name="frame-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> collections.Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+
+class RequestProfiler:
+    """
+    チャットのリクエスト単位でプロファイルを取得するクラス。
+    sample_rateの割合のリクエスト、または明示的に指定したリクエストを計測し、
+    1分あたりの回数と同時実行（1件まで）を制限して、常時有効にしても負荷が増えないようにする。
+    すべてのリクエストは常駐イベントループの1つのスレッドで動くため、プロファイルはスレッド全体の計測になる。
+    他のリクエストと重ならないときだけ1リクエスト分の計測になるので、sample_rateによる計測は
+    他のリクエストの実行中は行わず、計測中に他のリクエストが重なった場合はファイル名に"-shared"を付ける。
+    """
+
+    def __init__(self) -> None:
+        self.settings = dict(DEFAULT_PROFILE_SETTINGS)
+        self._lock = threading.Lock()
+        self._recent = collections.deque()
+        self._active = False
+        # 実行中のリクエスト数（計測しないものも含む）と、計測中に他のリクエストが重なったか
+        self._in_flight = 0
+        self._overlapped = False
+        self.stats = {
+            "profiled": 0,
+            "rate_limited": 0,
+            "skipped_concurrent": 0,
+            "shared": 0,
+            "last_path": "",
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings["enabled"].lower() == "true"
+
+    def configure(self, config: dict) -> None:
+        self.settings = {**DEFAULT_PROFILE_SETTINGS, **(config or {})}
+
+    def _acquire(self, force: bool) -> bool:
+        if not self.enabled:
+            return False
+        if not force and random.random() >= float(self.settings["sample_rate"]):
+            return False
+        now = time.monotonic()
+        with self._lock:
+            # 他のリクエストのフレームが混ざるため、明示的な指定がない限り他のリクエストの実行中は計測しない
+            if not force and self._in_flight > 1:
+                self.stats["skipped_concurrent"] += 1
+                return False
+            while self._recent and now - self._recent[0] > 60.0:
+                self._recent.popleft()
+            if self._active or len(self._recent) >= int(
+                self.settings["max_per_minute"]
+            ):
+                self.stats["rate_limited"] += 1
+                return False
+            self._active = True
+            self._overlapped = self._in_flight > 1
+            self._recent.append(now)
+        return True
+
+    def _enter(self) -> None:
+        with self._lock:
+            self._in_flight += 1
+            if self._active:
+                self._overlapped = True
+
+    def _exit(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _write(self, label: str, sampler, profiler, shared: bool = False) -> str:
+        directory = self.settings["dir"]
+        os.makedirs(directory, exist_ok=True)
+        if shared:
+            label = f"{label}-shared"
+        stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:8]}"
+        if sampler is not None:
+            path = os.path.join(directory, stem + ".folded")
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in sampler.counts.most_common():
+                    f.write(f"{stack} {count}\n")
+        else:
+            path = os.path.join(directory, stem + ".prof")
+            profiler.dump_stats(path)
+        # 古いプロファイルから削除し、ファイル数をmax_files以下に保つ
+        files = sorted(
+            (
+                os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if name.endswith((".folded", ".prof"))
+            ),
+            key=os.path.getmtime,
+        )
+        for old in files[: max(0, len(files) - int(self.settings["max_files"]))]:
+            with contextlib.suppress(OSError):
+                os.remove(old)
+        return path
+
+    async def run(self, label: str, coro, force: bool = False) -> tuple:
+        """
+        コルーチンを実行し、対象のリクエストであればプロファイルを保存する。
+        samplingモードはイベントループのスレッドのスタックを採取してfolded形式（.folded）で、
+        cprofileモードはcProfileの結果（.prof）で保存する。
+        計測中に他のリクエストが重なった場合は、そのリクエストのフレームも含むため"-shared"を付けて保存する。
+        Args:
+            label (str): ファイル名に付けるラベル
+            coro: 実行するコルーチン
+            force (bool): sample_rateに関係なく計測する（1分あたりの上限は適用する）
+        Returns:
+            tuple: (コルーチンの戻り値, 保存したファイルのパス。計測しなかった場合はNone)
+        """
+        self._enter()
+        try:
+            return await self._run(label, coro, force)
+        finally:
+            self._exit()
+
+    async def _run(self, label: str, coro, force: bool) -> tuple:
+        if not self._acquire(force):
+            return await coro, None
+        sampler = profiler = None
+        if self.settings["mode"] == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = FrameSampler(
+                threading.get_ident(), float(self.settings["interval_ms"]) / 1000
+            )
+            sampler.start()
+        try:
+            result = await coro
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            else:
+                sampler.stop()
+            with self._lock:
+                shared = self._overlapped
+            try:
+                path = await asyncio.to_thread(
+                    self._write, label, sampler, profiler, shared
+                )
+                self.stats["profiled"] += 1
+                self.stats["shared"] += shared
+                self.stats["last_path"] = path
+                logger.info(
+                    "プロファイルを保存しました: %s%s",
+                    path,
+                    "（他のリクエストと重なったため、それらのフレームも含みます）"
+                    if shared
+                    else "",
+                )
+            except OSError as e:
+                path = None
+                logger.warning("プロファイルを保存できませんでした: %s", e)
+            finally:
+                with self._lock:
+                    self._active = False
+        return result, path
+
+    def snapshot(self) -> dict:
+        return {"enabled": self.enabled, **self.stats}
+
+
+request_profiler = RequestProfiler()
+register_metrics_provider("profiler", request_profiler.snapshot)
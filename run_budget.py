@@ -0,0 +1,144 @@
+import asyncio
+import time
+from langchain_core.messages import (
+    AIMessage,
+    SystemMessage,
+    ToolMessage,
+    convert_to_messages,
+)
+
+
+# 予算超過時に最終回答を生成するLLM呼び出しの猶予時間（秒）
+DEFAULT_FINAL_ANSWER_TIMEOUT = 30.0
+BUDGET_FINAL_ANSWER_PROMPT = (
+    "処理の上限（ステップ数・ツール呼び出し数・時間）に達したため、これ以上ツールは使えません。"
+    "ここまでに得られた情報だけを使って、ユーザーの質問にできるだけ回答してください。"
+    "情報が不足している点があれば、その旨を明記してください。"
+)
+# 最終回答の生成も猶予時間内に終わらず、途中の回答もない場合に返すメッセージ
+BUDGET_EXHAUSTED_MESSAGE = "処理の上限に達したため回答を生成できませんでした。質問を絞り込んで再度お試しください。"
+_BUDGET_REASON_LABELS = {
+    "max_steps": "最大ステップ数",
+    "max_tool_calls": "最大ツール呼び出し数",
+    "timeout": "制限時間",
+}
+
+
+def _count_agent_progress(messages: list) -> tuple:
+    steps = sum(1 for msg in messages if isinstance(msg, AIMessage))
+    tool_calls = sum(1 for msg in messages if isinstance(msg, ToolMessage))
+    return steps, tool_calls
+
+
+async def run_agent_with_budget(agent, llm, inputs: dict, budget: dict) -> tuple:
+    """
+    ステップ数・ツール呼び出し数・経過時間の上限を設けてエージェントを実行する関数。
+    上限に達した場合は、それまでに得られた情報からLLMに最終回答を生成させる。
+    Args:
+        agent: create_react_agentで生成したエージェント
+        llm: 最終回答の生成に使うチャットモデル（ツールはバインドしない）
+        inputs (dict): エージェントへの入力（{"messages": [...]})
+        budget (dict): max_steps, max_tool_calls, timeout_seconds（いずれも省略可）
+    Returns:
+        tuple: (エージェントの応答, 予算の結果 dict。上限を設けていない場合はNone)
+    """
+    max_steps = int(budget.get("max_steps") or 0)
+    max_tool_calls = int(budget.get("max_tool_calls") or 0)
+    timeout_seconds = float(budget.get("timeout_seconds") or 0)
+    if not (max_steps or max_tool_calls or timeout_seconds):
+        return await agent.ainvoke(inputs), None
+
+    config = {}
+    if max_steps:
+        # LangGraphの再帰上限に先に達しないよう、ステップ上限より十分大きくする
+        config["recursion_limit"] = max_steps * 2 + 5
+    started = time.perf_counter()
+    input_count = len(inputs.get("messages", []))
+    state = None
+    reason = None
+    try:
+        async with asyncio.timeout(timeout_seconds or None):
+            async for state in agent.astream(inputs, config, stream_mode="values"):
+                new_messages = state["messages"][input_count:]
+                last = new_messages[-1] if new_messages else None
+                pending = getattr(last, "tool_calls", None) if last else None
+                if not pending:
+                    continue
+                steps, tool_calls = _count_agent_progress(new_messages)
+                # 次のツール実行・LLM呼び出しで上限を超える場合は、実行前に打ち切る
+                if max_tool_calls and tool_calls + len(pending) > max_tool_calls:
+                    reason = "max_tool_calls"
+                    break
+                if max_steps and steps >= max_steps:
+                    reason = "max_steps"
+                    break
+    except TimeoutError:
+        reason = "timeout"
+
+    messages = list(state["messages"]) if state else []
+    new_messages = messages[input_count:]
+    steps, tool_calls = _count_agent_progress(new_messages)
+    outcome = {
+        "reason": reason,
+        "steps": steps,
+        "tool_calls": tool_calls,
+        "elapsed": time.perf_counter() - started,
+    }
+    if reason is None:
+        return state, outcome
+
+    if not messages:
+        messages = convert_to_messages(inputs.get("messages", []))
+    # 結果のないツール呼び出しはLLMに渡せないため取り除く
+    resolved = {msg.tool_call_id for msg in messages if isinstance(msg, ToolMessage)}
+    messages = [
+        msg
+        for msg in messages
+        if not (
+            isinstance(msg, AIMessage)
+            and msg.tool_calls
+            and any(call["id"] not in resolved for call in msg.tool_calls)
+        )
+    ]
+    try:
+        final = await asyncio.wait_for(
+            llm.ainvoke(messages + [SystemMessage(content=BUDGET_FINAL_ANSWER_PROMPT)]),
+            timeout=float(
+                budget.get("final_answer_timeout", DEFAULT_FINAL_ANSWER_TIMEOUT)
+            ),
+        )
+    except TimeoutError:
+        # 最終回答も間に合わない場合は、途中までのLLMの回答（なければ定型文）を返す
+        outcome["final_answer"] = "timeout"
+        partial = [
+            msg.content
+            for msg in messages[input_count:]
+            if isinstance(msg, AIMessage)
+            and isinstance(msg.content, str)
+            and msg.content.strip()
+        ]
+        final = AIMessage(content=partial[-1] if partial else BUDGET_EXHAUSTED_MESSAGE)
+    outcome["elapsed"] = time.perf_counter() - started
+    return {"messages": messages + [final]}, outcome
+
+
+def format_budget_outcome(outcome: dict | None) -> str:
+    """
+    予算の結果をツール履歴に表示する文字列に変換する関数
+    Args:
+        outcome (dict | None): run_agent_with_budgetが返した予算の結果
+    Returns:
+        str: 表示用の文字列（上限に達していない場合は空文字）
+    """
+    if not outcome or not outcome.get("reason"):
+        return ""
+    label = _BUDGET_REASON_LABELS.get(outcome["reason"], outcome["reason"])
+    if outcome.get("final_answer") == "timeout":
+        action = "最終回答の生成も時間内に終わりませんでした"
+    else:
+        action = "得られた情報から回答しました"
+    return (
+        f"予算: {label}に達したため打ち切り、{action}"
+        f" (ステップ数: {outcome['steps']}, ツール呼び出し数: {outcome['tool_calls']},"
+        f" 経過時間: {outcome['elapsed']:.1f}秒)"
+    )
@@ -0,0 +1,422 @@
+import threading
+
+from app_metrics import register_metrics_provider
+from run_budget import format_budget_outcome
+
+
+class ToolCallRecord:
+    """
+    1回のツール呼び出しの記録。
+    """
+
+    __slots__ = (
+        "call_id",
+        "name",
+        "args",
+        "server",
+        "llm_backend",
+        "result_chars",
+        "is_error",
+        "started_at",
+        "ended_at",
+    )
+
+    def __init__(self, call_id, name: str, args):
+        self.call_id = call_id
+        self.name = name
+        self.args = args
+        self.server = ""
+        self.llm_backend = ""
+        self.result_chars = None
+        self.is_error = False
+        self.started_at = None
+        self.ended_at = None
+
+    @property
+    def duration(self) -> float | None:
+        if self.started_at is None or self.ended_at is None:
+            return None
+        return self.ended_at - self.started_at
+
+
+class StepRecord:
+    """
+    エージェントの1ステップ（1回のLLM呼び出し）の記録。
+    """
+
+    __slots__ = (
+        "llm_backend",
+        "model",
+        "input_tokens",
+        "cached_tokens",
+        "output_tokens",
+        "latency",
+        "tool_calls",
+    )
+
+    def __init__(
+        self,
+        llm_backend: str,
+        model: str,
+        usage: dict | None,
+        latency: float | None = None,
+    ):
+        usage = usage or {}
+        self.llm_backend = llm_backend
+        self.model = model
+        self.input_tokens = usage.get("input_tokens", 0)
+        # プロンプトキャッシュに当たった入力トークン数（input_tokensの内数）
+        self.cached_tokens = (usage.get("input_token_details") or {}).get(
+            "cache_read", 0
+        ) or 0
+        self.output_tokens = usage.get("output_tokens", 0)
+        self.latency = latency
+        self.tool_calls = 0
+
+
+class RunRecord:
+    """
+    1リクエスト分のエージェント実行の記録。最終回答・ツール呼び出し・ステップごとのトークン使用量を持つ。
+    """
+
+    __slots__ = ("answer", "tool_calls", "steps", "budget")
+
+    def __init__(self):
+        self.answer = ""
+        self.tool_calls = []
+        self.steps = []
+        self.budget = None
+
+    @property
+    def input_tokens(self) -> int:
+        return sum(step.input_tokens for step in self.steps)
+
+    @property
+    def output_tokens(self) -> int:
+        return sum(step.output_tokens for step in self.steps)
+
+    @property
+    def cached_tokens(self) -> int:
+        return sum(step.cached_tokens for step in self.steps)
+
+    @property
+    def llm_seconds(self) -> float:
+        return sum(step.latency or 0.0 for step in self.steps)
+
+    @property
+    def tool_seconds(self) -> float:
+        return _merged_duration(self.tool_calls)
+
+    def usage_by_backend(self, pricing: dict | None = None) -> dict:
+        """
+        トークン数・LLM/ツールの所要時間・推定コストを、応答したバックエンドごとに集計して返す。
+        Args:
+            pricing (dict | None): 価格表（省略時はconfigure_pricingで設定したもの）
+        Returns:
+            dict: バックエンド名をキーとした集計（価格が未設定のバックエンドはcostがNone）
+        """
+        pricing = llm_pricing if pricing is None else pricing
+        usage = {}
+        for step in self.steps:
+            entry = usage.setdefault(
+                step.llm_backend or step.model or "unknown", _empty_usage()
+            )
+            entry["llm_calls"] += 1
+            entry["input_tokens"] += step.input_tokens
+            entry["cached_tokens"] += step.cached_tokens
+            entry["cache_hits"] += step.cached_tokens > 0
+            entry["output_tokens"] += step.output_tokens
+            entry["llm_seconds"] += step.latency or 0.0
+            cost = estimate_step_cost(step, pricing)
+            entry["cost"] = (
+                None if cost is None or entry["cost"] is None else entry["cost"] + cost
+            )
+        calls_by_backend = {}
+        for call in self.tool_calls:
+            calls_by_backend.setdefault(call.llm_backend, []).append(call)
+        for backend, calls in calls_by_backend.items():
+            entry = usage.setdefault(backend or "unknown", _empty_usage())
+            entry["tool_calls"] += len(calls)
+            # 並行実行されたツールは重なった時間を二重に数えない
+            entry["tool_seconds"] += _merged_duration(calls)
+        return usage
+
+    def tool_history(self) -> list:
+        """
+        ツール履歴の表示用文字列のリストを返す。
+        Returns:
+            list: ツール履歴のリスト（予算で打ち切った場合はその旨を末尾に含む）
+        """
+        base_time = min(
+            (
+                call.started_at
+                for call in self.tool_calls
+                if call.started_at is not None
+            ),
+            default=0.0,
+        )
+        history = []
+        for call in self.tool_calls:
+            entry = f"ツール名: {call.name}, 引数: {call.args}"
+            if call.started_at is not None:
+                # 最初のツール開始からの相対時刻で表示し、並行実行を見えるようにする
+                entry += (
+                    f", 開始: +{call.started_at - base_time:.3f}秒"
+                    f", 終了: +{call.ended_at - base_time:.3f}秒"
+                )
+            if call.result_chars is not None:
+                entry += f", 結果: {call.result_chars}文字"
+            if call.is_error:
+                entry += ", エラー"
+            history.append(entry)
+        budget_note = format_budget_outcome(self.budget)
+        if budget_note:
+            history.append(budget_note)
+        return history
+
+    def render(self, history_title: str = "呼び出されたツール履歴") -> str:
+        """
+        チャット欄に表示する回答テキスト（ツール履歴付き）を返す。
+        Args:
+            history_title (str): ツール履歴の見出し
+        Returns:
+            str: 表示用テキスト
+        """
+        history = self.tool_history()
+        if not history:
+            return self.answer
+        return f"{self.answer}\n\n[{history_title}]\n" + "\n".join(history)
+
+    def to_dict(self) -> dict:
+        """
+        保存用に、回答以外の記録（ツール呼び出し・ステップ・予算の結果）を辞書にして返す
+        Returns:
+            dict: 実行記録の辞書
+        """
+        return {
+            "tool_calls": [
+                {slot: getattr(call, slot) for slot in ToolCallRecord.__slots__}
+                for call in self.tool_calls
+            ],
+            "steps": [
+                {slot: getattr(step, slot) for slot in StepRecord.__slots__}
+                for step in self.steps
+            ],
+            "budget": self.budget,
+        }
+
+
+def _merged_duration(calls) -> float:
+    # 時間帯が重なる呼び出しは1つにまとめて、実際に待った時間を求める
+    intervals = sorted(
+        (call.started_at, call.ended_at)
+        for call in calls
+        if call.started_at is not None and call.ended_at is not None
+    )
+    total = 0.0
+    current_start = current_end = None
+    for start, end in intervals:
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+# LLMごとの価格表（100万トークンあたりの米ドル）
+llm_pricing = {}
+
+
+def configure_pricing(pricing: dict) -> None:
+    """
+    server_params.jsonのpricingセクションを反映する関数
+    Args:
+        pricing (dict): llm_optionsのキー（またはモデル名）をキーとした価格
+            input: 入力, cached_input: キャッシュに当たった入力（省略時はinputと同じ）, output: 出力
+    """
+    global llm_pricing
+    llm_pricing = dict(pricing or {})
+
+
+def estimate_step_cost(step: StepRecord, pricing: dict) -> float | None:
+    """
+    1回のLLM呼び出しの推定コスト（米ドル）を計算する関数
+    Args:
+        step (StepRecord): LLM呼び出しの記録
+        pricing (dict): 価格表
+    Returns:
+        float | None: 推定コスト（価格が未設定の場合はNone）
+    """
+    price = pricing.get(step.llm_backend) or pricing.get(step.model)
+    if not price:
+        return None
+    input_price = float(price.get("input", 0))
+    cached_price = float(price.get("cached_input", input_price))
+    uncached_tokens = max(step.input_tokens - step.cached_tokens, 0)
+    return (
+        uncached_tokens * input_price
+        + step.cached_tokens * cached_price
+        + step.output_tokens * float(price.get("output", 0))
+    ) / 1_000_000
+
+
+def _empty_usage() -> dict:
+    return {
+        "turns": 0,
+        "llm_calls": 0,
+        "input_tokens": 0,
+        "cached_tokens": 0,
+        # プロンプトキャッシュが使われた（cached_tokensが1以上の）LLM呼び出しの数
+        "cache_hits": 0,
+        "output_tokens": 0,
+        "llm_seconds": 0.0,
+        "tool_calls": 0,
+        "tool_seconds": 0.0,
+        "cost": 0.0,
+    }
+
+
+def cache_hit_rate(entry: dict) -> float:
+    """
+    入力トークンのうち、プロンプトキャッシュから読み込まれた割合を返す関数
+    Args:
+        entry (dict): usage_by_backendの1バックエンド分の集計
+    Returns:
+        float: キャッシュヒット率（0〜1、入力がない場合は0）
+    """
+    if not entry["input_tokens"]:
+        return 0.0
+    return entry["cached_tokens"] / entry["input_tokens"]
+
+
+def format_usage(usage: dict) -> str:
+    """
+    usage_by_backendの集計を、バックエンドごとに1行の表示用文字列にする関数
+    Args:
+        usage (dict): バックエンド名をキーとした集計
+    Returns:
+        str: 表示用文字列
+    """
+    lines = []
+    for backend, entry in usage.items():
+        line = (
+            f"{backend}: 入力 {entry['input_tokens']:,}"
+            f" (キャッシュ {entry['cached_tokens']:,}) / 出力 {entry['output_tokens']:,} トークン"
+            f", LLM {entry['llm_seconds']:.2f}秒 ({entry['llm_calls']}回)"
+            f", ツール {entry['tool_seconds']:.2f}秒 ({entry['tool_calls']}回)"
+        )
+        if entry["input_tokens"]:
+            line += f", キャッシュヒット率 {cache_hit_rate(entry):.0%}"
+        if entry["cost"] is not None:
+            line += f", 推定 ${entry['cost']:.4f}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class UsageTotals:
+    """
+    ターンごとの使用量をバックエンド別に累計する。セッションごと（gr.State）とプロセス全体で使う。
+    """
+
+    __slots__ = ("turns", "by_backend", "last")
+
+    def __init__(self):
+        self.turns = 0
+        self.by_backend = {}
+        self.last = {}
+
+    def add(self, usage: dict) -> None:
+        """
+        1ターン分の集計（RunRecord.usage_by_backendの戻り値）を加算する
+        Args:
+            usage (dict): バックエンド名をキーとした集計
+        """
+        self.turns += 1
+        self.last = usage
+        for backend, entry in usage.items():
+            total = self.by_backend.setdefault(backend, _empty_usage())
+            total["turns"] += 1
+            for key, value in entry.items():
+                if key == "turns":
+                    continue
+                if key == "cost":
+                    total["cost"] = (
+                        None
+                        if value is None or total["cost"] is None
+                        else total["cost"] + value
+                    )
+                else:
+                    total[key] += value
+
+    def render(self) -> str:
+        """
+        直近のターンとセッション累計を表示用のMarkdownにして返す
+        Returns:
+            str: 表示用Markdown
+        """
+        if not self.turns:
+            return ""
+        return (
+            f"**直近のターン**\n\n{format_usage(self.last)}\n\n"
+            f"**累計 ({self.turns}ターン)**\n\n{format_usage(self.by_backend)}"
+        ).replace("\n", "  \n")
+
+    def snapshot(self) -> dict:
+        return {
+            "turns": self.turns,
+            "by_backend": {
+                backend: dict(entry) for backend, entry in self.by_backend.items()
+            },
+        }
+
+
+# プロセス全体の使用量（メトリクスの"usage"に表示）
+usage_ledger = UsageTotals()
+_usage_ledger_lock = threading.Lock()
+
+
+def _usage_ledger_snapshot() -> dict:
+    with _usage_ledger_lock:
+        return usage_ledger.snapshot()
+
+
+register_metrics_provider("usage", _usage_ledger_snapshot)
+
+
+def _prompt_cache_snapshot() -> dict:
+    with _usage_ledger_lock:
+        by_backend = usage_ledger.snapshot()["by_backend"]
+    return {
+        backend: {
+            "llm_calls": entry["llm_calls"],
+            "cache_hits": entry["cache_hits"],
+            "input_tokens": entry["input_tokens"],
+            "cached_tokens": entry["cached_tokens"],
+            "hit_rate": round(cache_hit_rate(entry), 4),
+        }
+        for backend, entry in by_backend.items()
+    }
+
+
+register_metrics_provider("prompt_cache", _prompt_cache_snapshot)
+
+
+def record_usage(run_record: RunRecord, session: UsageTotals | None = None) -> dict:
+    """
+    1ターンの使用量をプロセス全体とセッションの累計に加算する関数
+    Args:
+        run_record (RunRecord): 実行記録
+        session (UsageTotals | None): セッションの累計
+    Returns:
+        dict: このターンのバックエンドごとの集計
+    """
+    usage = run_record.usage_by_backend()
+    with _usage_ledger_lock:
+        usage_ledger.add(usage)
+    if session is not None:
+        session.add(usage)
+    return usage
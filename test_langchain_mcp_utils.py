@@ -1,5 +1,24 @@
 import asyncio
+import time
 import langchain_mcp_utils
+import app_metrics
+import app_loop
+import app_logging
+import mcp_http
+import mcp_resilience
+import mcp_supervisor
+import llm_inprocess
+import llm_cassette
+import llm_prompt
+import llm_resilience
+import llm_routing
+import doc_store
+import tool_results
+import run_budget
+import run_records
+import history_store
+import profiling
+import tool_catalog
 import pytest
 
 
@@ -196,7 +215,7 @@ async def test_gradio_chat(monkeypatch):
     """
     import main as mainmod
 
-    # ChatOpenAI, create_react_agent, extract_answer, global_tools, llm_optionsをモック
+    # create_react_agent, global_tools, llm_optionsをモック
     class DummyAgent:
         async def ainvoke(self, _):
             return {"output": "dummy answer", "messages": []}
@@ -205,7 +224,6 @@ async def test_gradio_chat(monkeypatch):
         return DummyAgent()
 
     monkeypatch.setattr(mainmod, "create_react_agent", dummy_create_react_agent)
-    monkeypatch.setattr(mainmod, "extract_answer", lambda resp: resp["output"])
     monkeypatch.setattr(mainmod, "global_tools", [object()])
     monkeypatch.setattr(mainmod, "llm_options", {"TestLLM": {"model": "gpt-4o"}})
     # user_input, history, function_calling, selected_llm
@@ -242,7 +260,6 @@ async def test_gradio_chat_exception(monkeypatch):
         return DummyAgent()
 
     monkeypatch.setattr(mainmod, "create_react_agent", dummy_create_react_agent)
-    monkeypatch.setattr(mainmod, "extract_answer", lambda resp: "should not reach")
     monkeypatch.setattr(mainmod, "global_tools", [object()])
     monkeypatch.setattr(mainmod, "llm_options", {"TestLLM": {"model": "gpt-4o"}})
     with pytest.raises(RuntimeError):
@@ -314,3 +331,2166 @@ def test_extract_tool_history_mixed():
     assert any('ツール名: search, 引数: {"q": "test"}' in s for s in result)
     assert any("ツール名: search, 入力: {'q': 'test2'}" in s for s in result)
     assert len(result) == 2
+
+
+def test_compute_server_config_hash_ignores_key_order():
+    """
+    compute_server_config_hashがキー順序に依存せず、設定変更で値が変わるかをテスト。
+    """
+    a = {"transport": "stdio", "command": "uvx", "args": ["x"]}
+    b = {"args": ["x"], "command": "uvx", "transport": "stdio"}
+    c = {"transport": "stdio", "command": "uvx", "args": ["y"]}
+    assert tool_catalog.compute_server_config_hash(
+        a
+    ) == tool_catalog.compute_server_config_hash(b)
+    assert tool_catalog.compute_server_config_hash(
+        a
+    ) != tool_catalog.compute_server_config_hash(c)
+
+
+def test_load_tool_catalog_uses_cache(tmp_path, monkeypatch):
+    """
+    load_tool_catalogが、設定ハッシュが一致するサーバーをキャッシュから登録し、
+    設定が変わったサーバーのみ実サーバーから取得するかをテスト。
+    """
+    servers = {
+        "cached": {"transport": "stdio", "command": "uvx", "args": ["a"]},
+        "changed": {"transport": "stdio", "command": "uvx", "args": ["b"]},
+    }
+    cache_path = str(tmp_path / "tool_cache.json")
+    tool_catalog.save_tool_cache(
+        cache_path,
+        {
+            "cached": {
+                "config_hash": tool_catalog.compute_server_config_hash(
+                    servers["cached"]
+                ),
+                "tools": [{"name": "cached_tool", "inputSchema": {"type": "object"}}],
+            },
+            "changed": {
+                "config_hash": "old-hash",
+                "tools": [{"name": "stale_tool", "inputSchema": {"type": "object"}}],
+            },
+        },
+    )
+    fetched = []
+
+    async def dummy_fetch(connection):
+        fetched.append(connection["args"][0])
+        return [{"name": "live_tool", "inputSchema": {"type": "object"}}]
+
+    monkeypatch.setattr(tool_catalog, "fetch_tool_definitions", dummy_fetch)
+    catalog, cached_servers = asyncio.run(
+        tool_catalog.load_tool_catalog(servers, cache_path)
+    )
+    assert cached_servers == ["cached"]
+    assert fetched == ["b"]
+    assert sorted(tool.name for tool in catalog.tools) == ["cached_tool", "live_tool"]
+    # 取得し直したサーバーはキャッシュに書き戻される
+    saved = tool_catalog.load_tool_cache(cache_path)
+    assert saved["changed"]["tools"][0]["name"] == "live_tool"
+    assert saved["changed"]["config_hash"] == (
+        tool_catalog.compute_server_config_hash(servers["changed"])
+    )
+
+
+def test_refresh_tool_catalog_updates_changed_servers(tmp_path, monkeypatch):
+    """
+    refresh_tool_catalogが実サーバーとの差分のみを反映し、失敗時はキャッシュを維持するかをテスト。
+    """
+    servers = {
+        "same": {"transport": "stdio", "command": "uvx", "args": ["same"]},
+        "diff": {"transport": "stdio", "command": "uvx", "args": ["diff"]},
+        "down": {"transport": "stdio", "command": "uvx", "args": ["down"]},
+    }
+    catalog = tool_catalog.ToolCatalog()
+    for name in servers:
+        definitions = [{"name": f"{name}_tool", "inputSchema": {"type": "object"}}]
+        catalog.set_server(
+            name,
+            definitions,
+            tool_catalog.build_tools_from_definitions(definitions, servers[name]),
+        )
+    version = catalog.version
+
+    async def dummy_fetch(connection):
+        name = connection["args"][0]
+        if name == "down":
+            raise RuntimeError("server down")
+        if name == "diff":
+            return [{"name": "diff_tool_v2", "inputSchema": {"type": "object"}}]
+        return [{"name": "same_tool", "inputSchema": {"type": "object"}}]
+
+    monkeypatch.setattr(tool_catalog, "fetch_tool_definitions", dummy_fetch)
+    changed = asyncio.run(
+        tool_catalog.refresh_tool_catalog(
+            catalog, servers, list(servers), str(tmp_path / "cache.json")
+        )
+    )
+    assert changed == ["diff"]
+    assert catalog.version == version + 1
+    assert sorted(tool.name for tool in catalog.tools) == [
+        "diff_tool_v2",
+        "down_tool",
+        "same_tool",
+    ]
+
+
+def _make_catalog(tools_by_server: dict) -> "tool_catalog.ToolCatalog":
+    catalog = tool_catalog.ToolCatalog()
+    for server_name, names in tools_by_server.items():
+        definitions = [
+            {
+                "name": name,
+                "description": f"{name}の説明",
+                "inputSchema": {"type": "object"},
+            }
+            for name in names
+        ]
+        catalog.set_server(
+            server_name,
+            definitions,
+            tool_catalog.build_tools_from_definitions(
+                definitions, {"transport": "stdio"}, server_name
+            ),
+        )
+    return catalog
+
+
+def test_render_tool_catalog_page_filters_and_paginates():
+    """
+    render_tool_catalog_pageがサーバー絞り込み・検索・ページ分割を行うかをテスト。
+    """
+    catalog = _make_catalog(
+        {"docs": [f"docs_tool_{i}" for i in range(5)], "db": ["query_db"]}
+    )
+    result, page = tool_catalog.render_tool_catalog_page(catalog, page=2, page_size=4)
+    assert page == 2
+    assert "**ページ**: 2 / 2" in result
+    assert "docs_tool_4" in result and "query_db" in result
+    assert "docs_tool_0" not in result
+
+    result, _ = tool_catalog.render_tool_catalog_page(catalog, server_name="db")
+    assert "## db" in result and "## docs" not in result
+
+    result, page = tool_catalog.render_tool_catalog_page(
+        catalog, query="TOOL_3", page=5
+    )
+    assert page == 1
+    assert "docs_tool_3" in result and "docs_tool_2" not in result
+
+
+def test_rendered_tool_entries_cached_per_version():
+    """
+    get_rendered_tool_entriesがカタログのバージョンが変わるまで描画結果を再利用するかをテスト。
+    """
+    catalog = _make_catalog({"docs": ["search"]})
+    first = tool_catalog.get_rendered_tool_entries(catalog)
+    assert tool_catalog.get_rendered_tool_entries(catalog) is first
+    catalog.remove_server("docs")
+    assert tool_catalog.get_rendered_tool_entries(catalog) == []
+
+
+def test_instrumented_tool_records_stats(monkeypatch):
+    """
+    instrument_toolでラップしたツールの呼び出しが統計に記録され、一覧に表示されるかをテスト。
+    """
+    monkeypatch.setattr(app_metrics, "tool_call_stats", app_metrics.ToolCallStats())
+    from langchain_core.tools import StructuredTool
+
+    async def call_tool(**arguments):
+        return f"結果: {arguments['q']}", None
+
+    tool = StructuredTool(
+        name="search",
+        description="検索",
+        args_schema={"type": "object", "properties": {"q": {"type": "string"}}},
+        coroutine=call_tool,
+        response_format="content_and_artifact",
+    )
+    wrapped = tool_catalog.instrument_tool(tool, "docs")
+    assert wrapped.metadata["mcp_server"] == "docs"
+    assert asyncio.run(wrapped.ainvoke({"q": "x"})) == "結果: x"
+    stats = app_metrics.tool_call_stats.snapshot()
+    assert stats["search"]["calls"] == 1 and stats["search"]["errors"] == 0
+
+
+def test_concurrency_limiter_across_event_loops():
+    """
+    ConcurrencyLimiterが別スレッドのイベントループ間でも同時実行数を制限するかをテスト。
+    """
+    import threading
+    import time
+
+    limiter = mcp_resilience.ConcurrencyLimiter(1)
+    lock = threading.Lock()
+    state = {"active": 0, "max_active": 0}
+
+    async def worker():
+        async with limiter:
+            with lock:
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+            await asyncio.sleep(0.02)
+            with lock:
+                state["active"] -= 1
+
+    threads = [threading.Thread(target=lambda: asyncio.run(worker())) for _ in range(4)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state["max_active"] == 1
+    assert time.perf_counter() - started >= 0.08
+    assert limiter.active == 0
+
+
+def test_tool_calls_parallel_across_servers(monkeypatch):
+    """
+    異なるサーバーのツールは並行実行され、同一サーバーのツールはmax_concurrencyで制限されるかをテスト。
+    """
+    import time
+    from langchain_core.tools import StructuredTool
+
+    monkeypatch.setattr(mcp_resilience, "_server_limiters", {})
+    mcp_resilience.configure_server_options({"slow": {"max_concurrency": 1}})
+
+    def make_tool(name, server_name):
+        async def call_tool(**arguments):
+            await asyncio.sleep(0.1)
+            return name, None
+
+        tool = StructuredTool(
+            name=name,
+            description=name,
+            args_schema={"type": "object", "properties": {}},
+            coroutine=call_tool,
+            response_format="content_and_artifact",
+        )
+        return tool_catalog.instrument_tool(tool, server_name)
+
+    async def run(tools):
+        started = time.perf_counter()
+        await asyncio.gather(*(tool.ainvoke({}) for tool in tools))
+        return time.perf_counter() - started
+
+    parallel = asyncio.run(run([make_tool("a", "docs"), make_tool("b", "db")]))
+    serial = asyncio.run(run([make_tool("c", "slow"), make_tool("d", "slow")]))
+    mcp_resilience.configure_server_options({})
+    assert parallel < 0.18
+    assert serial >= 0.2
+
+
+def test_extract_tool_history_with_timings():
+    """
+    ToolMessageのartifactに記録された開始・終了時刻がツール履歴に表示されるかをテスト。
+    """
+    from langchain_core.messages import AIMessage, ToolMessage
+
+    agent_response = {
+        "messages": [
+            AIMessage(
+                content="",
+                tool_calls=[
+                    {"name": "search", "args": {"q": "a"}, "id": "call_1"},
+                    {"name": "price", "args": {"sku": "b"}, "id": "call_2"},
+                ],
+            ),
+            ToolMessage(
+                content="r1",
+                tool_call_id="call_1",
+                artifact={"server": "docs", "started_at": 100.0, "ended_at": 101.5},
+            ),
+            ToolMessage(
+                content="r2",
+                tool_call_id="call_2",
+                artifact={"server": "pricing", "started_at": 100.25, "ended_at": 101.0},
+            ),
+        ]
+    }
+    result = langchain_mcp_utils.extract_tool_history(agent_response)
+    assert result == [
+        "ツール名: search, 引数: {'q': 'a'}, 開始: +0.000秒, 終了: +1.500秒",
+        "ツール名: price, 引数: {'sku': 'b'}, 開始: +0.250秒, 終了: +1.000秒",
+    ]
+
+
+def test_apply_tool_result_policy_truncates_and_spills(tmp_path, monkeypatch):
+    """
+    apply_tool_result_policyが上限を超えた結果を切り詰め、全文をread_tool_resultで読めるかをテスト。
+    """
+    import re
+
+    tool_results.configure_tool_results(
+        {
+            "max_chars": 10,
+            "spill_dir": str(tmp_path),
+            "tools": {"big_doc": {"max_chars": 20, "mode": "summarize"}},
+        }
+    )
+    try:
+        assert tool_results.apply_tool_result_policy("small", "短い結果") == (
+            "短い結果"
+        )
+        full = "あいうえお" * 10
+        shown = tool_results.apply_tool_result_policy("any", full)
+        assert shown.startswith("あいうえおあいうえお\n\n[結果が大きいため")
+        handle, offset = re.search(r"handle='(\w+)', offset=(\d+)", shown).groups()
+
+        # 続きを読み出すと、表示されなかった残りの部分が文字化けせずに得られる
+        rest = asyncio.run(tool_results.read_tool_result(handle, int(offset), 10_000))
+        assert rest.startswith(full[10:])
+        assert "終端に達しました" in rest
+
+        summarized = tool_results.apply_tool_result_policy("big_doc", full)
+        assert "中略" in summarized
+    finally:
+        tool_results.configure_tool_results({})
+
+
+def test_result_spill_store_evicts_oldest(tmp_path):
+    """
+    ResultSpillStoreが合計サイズの上限を超えた場合に古い結果から削除するかをテスト。
+    """
+    store = tool_results.ResultSpillStore(str(tmp_path), max_bytes=10)
+    first = store.put("a" * 8)
+    second = store.put("b" * 8)
+    assert store.read(second, 0, 4) == ("bbbb", 4, 8)
+    with pytest.raises(KeyError):
+        store.read(first)
+    assert store.total_bytes == 8
+    assert "見つかりません" in asyncio.run(tool_results.read_tool_result("missing"))
+
+
+def test_result_spill_store_pages_through_multibyte_text(tmp_path):
+    """
+    ResultSpillStoreのreadが1文字より短いlengthや文字の途中のoffsetでも必ず1文字以上進むかをテスト。
+    """
+    store = tool_results.ResultSpillStore(str(tmp_path))
+    text = "aあい🙂b"
+    handle = store.put(text)
+    pieces, offset = [], 0
+    while True:
+        piece, offset, total = store.read(handle, offset, 1)
+        if not piece:
+            break
+        pieces.append(piece)
+    assert pieces == list(text) and offset == total
+    # 文字の途中から読み出した場合は次の文字の先頭から返す
+    assert store.read(handle, 2, 1) == ("い", 7, total)
+
+
+def test_configure_tool_results_keeps_handles_when_limits_change(tmp_path):
+    """
+    configure_tool_resultsで上限だけを変えた場合に退避ストアを作り直さず、発行済みのハンドルが使えるかをテスト。
+    """
+    tool_results.configure_tool_results({"spill_dir": str(tmp_path)})
+    try:
+        store = tool_results.get_spill_store()
+        handle = store.put("保存した結果")
+        tool_results.configure_tool_results(
+            {"spill_dir": str(tmp_path), "max_spill_bytes": 1024}
+        )
+        assert tool_results.get_spill_store() is store
+        assert store.max_bytes == 1024
+        assert store.read(handle)[0] == "保存した結果"
+        # 退避先が変わった場合は新しいストアを使う
+        tool_results.configure_tool_results({"spill_dir": str(tmp_path / "other")})
+        assert tool_results.get_spill_store() is not store
+    finally:
+        tool_results.configure_tool_results({})
+
+
+def test_diff_server_params():
+    """
+    diff_server_paramsがサーバー・LLM・その他の設定の差分を正しく返すかをテスト。
+    """
+    old = {
+        "servers": {
+            "keep": {"transport": "stdio", "command": "a", "args": []},
+            "edit": {"transport": "stdio", "command": "b", "args": []},
+            "drop": {"transport": "stdio", "command": "c", "args": []},
+        },
+        "llm": {"OpenAI": {"model": "gpt-4o"}},
+        "debug": "true",
+    }
+    new = {
+        "servers": {
+            "keep": {"args": [], "command": "a", "transport": "stdio"},
+            "edit": {"transport": "stdio", "command": "b2", "args": []},
+            "add": {"transport": "streamable_http", "url": "http://x"},
+        },
+        "llm": {"OpenAI": {"model": "gpt-4.1"}, "Gemini": {"model": "g"}},
+        "debug": "false",
+    }
+    diff = langchain_mcp_utils.diff_server_params(old, new)
+    assert diff == {
+        "servers_added": ["add"],
+        "servers_removed": ["drop"],
+        "servers_changed": ["edit"],
+        "llm_added": ["Gemini"],
+        "llm_removed": [],
+        "llm_changed": ["OpenAI"],
+        "settings_changed": ["debug"],
+    }
+    assert not langchain_mcp_utils.has_server_params_changes(
+        langchain_mcp_utils.diff_server_params(old, old)
+    )
+
+
+def test_server_params_watcher_applies_only_changed_servers(tmp_path, monkeypatch):
+    """
+    ServerParamsWatcherが設定ファイルの変更を検知し、変更されたサーバーのみ取得し直すかをテスト。
+    """
+    import json
+    import os
+
+    path = tmp_path / "server_params.json"
+    params = {
+        "servers": {
+            "keep": {"transport": "stdio", "command": "uvx", "args": ["keep"]},
+            "edit": {"transport": "stdio", "command": "uvx", "args": ["edit"]},
+        },
+        "llm": {"OpenAI": {"model": "gpt-4o"}},
+    }
+    path.write_text(json.dumps(params), encoding="utf-8")
+    catalog = _make_catalog({"keep": ["keep_tool"], "edit": ["edit_tool"]})
+    fetched = []
+
+    async def dummy_fetch(connection):
+        fetched.append(connection["args"][0])
+        return [{"name": "edit_tool_v2", "inputSchema": {"type": "object"}}]
+
+    monkeypatch.setattr(tool_catalog, "fetch_tool_definitions", dummy_fetch)
+    reloaded = []
+    watcher = langchain_mcp_utils.ServerParamsWatcher(
+        str(path),
+        params,
+        catalog,
+        on_reload=lambda new_params, diff: reloaded.append(diff),
+    )
+    assert watcher.check() is None
+
+    new_params = json.loads(json.dumps(params))
+    new_params["servers"]["edit"]["args"] = ["edit", "--v2"]
+    new_params["llm"]["Gemini"] = {"model": "gemini"}
+    path.write_text(json.dumps(new_params), encoding="utf-8")
+    os.utime(path, ns=(0, 10**18))
+    diff = watcher.check()
+    assert diff["servers_changed"] == ["edit"] and diff["llm_added"] == ["Gemini"]
+    assert fetched == ["edit"]
+    assert sorted(tool.name for tool in catalog.tools) == ["edit_tool_v2", "keep_tool"]
+    assert reloaded == [diff]
+
+    # 壊れたJSONに書き換えられた場合は現在の設定を維持する
+    path.write_text("{ broken", encoding="utf-8")
+    os.utime(path, ns=(0, 2 * 10**18))
+    assert watcher.check() is None
+    assert watcher.params["llm"]["Gemini"] == {"model": "gemini"}
+
+
+def test_server_params_watcher_toggles_doc_store_tool(tmp_path, monkeypatch):
+    """
+    doc_store.enabledを再読み込みで切り替えると、search_local_docsがカタログに追加・削除されるかをテスト。
+    """
+    import json
+    import os
+
+    monkeypatch.setattr(doc_store, "local_doc_store", doc_store.LocalDocStore())
+    path = tmp_path / "server_params.json"
+    params = {"servers": {}, "doc_store": {"enabled": "false"}}
+    path.write_text(json.dumps(params), encoding="utf-8")
+    catalog = tool_catalog.ToolCatalog()
+    tool_catalog.register_builtin_tools(catalog)
+    watcher = langchain_mcp_utils.ServerParamsWatcher(str(path), params, catalog)
+
+    def tool_names():
+        return {tool.name for tool in catalog.tools}
+
+    assert "search_local_docs" not in tool_names()
+    for mtime, enabled in ((10**18, "true"), (2 * 10**18, "false")):
+        path.write_text(
+            json.dumps({"servers": {}, "doc_store": {"enabled": enabled}}),
+            encoding="utf-8",
+        )
+        os.utime(path, ns=(0, mtime))
+        assert watcher.check()["settings_changed"] == ["doc_store"]
+        assert ("search_local_docs" in tool_names()) == (enabled == "true")
+    assert "read_tool_result" in tool_names()
+
+
+def test_server_params_watcher_reconfigures_litellm_and_mcp_http(tmp_path, monkeypatch):
+    """
+    litellm・mcp_httpの設定を再読み込みで変更すると、LLMの呼び出し方法とMCPのHTTPプールが切り替わり、
+    in_processモードにできない場合は例外となって現在の設定を使い続けるかをテスト。
+    """
+    import json
+    import os
+
+    class FakeLiteLLM:
+        class Router:
+            def __init__(self, model_list):
+                self.model_list = model_list
+
+    monkeypatch.setattr(llm_inprocess, "in_process_llm", None)
+    monkeypatch.setattr(mcp_http, "mcp_http_pool", mcp_http.MCPHttpPool())
+    config = tmp_path / "config.yaml"
+    config.write_text(
+        "model_list:\n  - model_name: gpt-4o\n    litellm_params: {model: gpt-4o}\n",
+        encoding="utf-8",
+    )
+    path = tmp_path / "server_params.json"
+    params = {"servers": {}, "litellm": {"mode": "proxy"}, "mcp_http": {}}
+    path.write_text(json.dumps(params), encoding="utf-8")
+    watcher = langchain_mcp_utils.ServerParamsWatcher(
+        str(path), params, tool_catalog.ToolCatalog()
+    )
+
+    def reload(mtime, litellm, mcp_http):
+        path.write_text(
+            json.dumps({"servers": {}, "litellm": litellm, "mcp_http": mcp_http}),
+            encoding="utf-8",
+        )
+        os.utime(path, ns=(0, mtime))
+        return watcher.check()
+
+    in_process = {"mode": "in_process", "config": str(config)}
+    # litellmがインストールされていない場合は反映できず、proxyモードのまま
+    monkeypatch.setattr(llm_inprocess, "litellm", None)
+    with pytest.raises(RuntimeError):
+        reload(10**18, in_process, {})
+    assert llm_inprocess.in_process_llm is None
+    assert watcher.params == params
+
+    monkeypatch.setattr(llm_inprocess, "litellm", FakeLiteLLM)
+    diff = reload(2 * 10**18, in_process, {"enabled": "true"})
+    assert sorted(diff["settings_changed"]) == ["litellm", "mcp_http"]
+    assert llm_inprocess.in_process_llm.model_names == ["gpt-4o"]
+    assert mcp_http.mcp_http_pool.enabled
+
+    diff = reload(3 * 10**18, {"mode": "proxy"}, {"enabled": "false"})
+    assert sorted(diff["settings_changed"]) == ["litellm", "mcp_http"]
+    assert llm_inprocess.in_process_llm is None
+    assert not mcp_http.mcp_http_pool.enabled
+
+
+def test_circuit_breaker_opens_and_recovers(monkeypatch):
+    """
+    CircuitBreakerが連続失敗でopenになり、reset_seconds経過後の試行成功でclosedに戻るかをテスト。
+    """
+    now = [1000.0]
+    monkeypatch.setattr(mcp_resilience.time, "monotonic", lambda: now[0])
+    breaker = mcp_resilience.CircuitBreaker(
+        {"failure_threshold": 2, "slow_call_seconds": 5.0, "reset_seconds": 10.0}
+    )
+    breaker.record_failure()
+    assert breaker.allow()
+    # 低速な呼び出しは失敗として数える
+    breaker.record_success(6.0)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now[0] += 11.0
+    assert breaker.allow()
+    # half_open中は同時に1件のみ試行する
+    assert not breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["open_count"] == 1
+
+
+def test_circuit_breaker_reopens_when_half_open_trial_fails(monkeypatch):
+    """
+    half_openの試行が失敗した場合は閾値に関係なくすぐにopenに戻り、
+    キャンセルされた試行は成否を記録せずに試行枠を返すかをテスト。
+    """
+    now = [1000.0]
+    monkeypatch.setattr(mcp_resilience.time, "monotonic", lambda: now[0])
+    breaker = mcp_resilience.CircuitBreaker(
+        {"failure_threshold": 3, "slow_call_seconds": 5.0, "reset_seconds": 10.0}
+    )
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == "open"
+
+    now[0] += 11.0
+    assert breaker.allow() and breaker.state == "half_open"
+    breaker.release_trial()
+    # キャンセルされた試行の後は、次の呼び出しが試行できる
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    assert breaker.snapshot()["open_count"] == 2
+    # openに戻った時点からreset_secondsを数え直す
+    now[0] += 5.0
+    assert not breaker.allow()
+    now[0] += 6.0
+    assert breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == "closed" and breaker.consecutive_failures == 0
+
+
+def test_tool_timeout_trips_breaker_and_fails_fast(monkeypatch):
+    """
+    タイムアウトしたツール呼び出しがブレーカーをopenにし、以降は接続せずにエラーを返すかをテスト。
+    """
+    from langchain_core.tools import StructuredTool, ToolException
+
+    monkeypatch.setattr(mcp_resilience, "_server_breakers", {})
+    monkeypatch.setattr(mcp_resilience, "_server_limiters", {})
+    mcp_resilience.configure_server_options(
+        {
+            "hung": {
+                "timeout": 5,
+                "tool_timeouts": {"hang": 0.05},
+                "breaker": {"failure_threshold": 1, "reset_seconds": 60},
+            }
+        }
+    )
+    calls = []
+
+    async def call_tool(**arguments):
+        calls.append(arguments)
+        await asyncio.sleep(1)
+        return "never", None
+
+    tool = tool_catalog.instrument_tool(
+        StructuredTool(
+            name="hang",
+            description="応答しないツール",
+            args_schema={"type": "object", "properties": {}},
+            coroutine=call_tool,
+            response_format="content_and_artifact",
+        ),
+        "hung",
+    )
+    try:
+        assert mcp_resilience.get_tool_timeout("hung", "hang") == 0.05
+        assert mcp_resilience.get_tool_timeout("hung", "other") == 5.0
+        with pytest.raises(ToolException, match="タイムアウト"):
+            asyncio.run(tool.ainvoke({}))
+        with pytest.raises(ToolException, match="一時的に停止中"):
+            asyncio.run(tool.ainvoke({}))
+        assert len(calls) == 1
+        metrics = app_metrics.get_metrics_snapshot()
+        assert metrics["circuit_breakers"]["hung"]["state"] == "open"
+    finally:
+        mcp_resilience.configure_server_options({})
+
+
+class _FakeBackend:
+    """
+    ResilientChatModelのテスト用バックエンド。指定した例外を順に送出した後、応答を返す。
+    """
+
+    def __init__(self, name, errors=()):
+        self.name = name
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def _agenerate(self, messages, stop=None, **kwargs):
+        from langchain_core.messages import AIMessage
+        from langchain_core.outputs import ChatGeneration, ChatResult
+
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=self.name))]
+        )
+
+
+def _timeout_error():
+    import httpx
+    import openai
+
+    return openai.APITimeoutError(request=httpx.Request("POST", "http://llm"))
+
+
+def test_resilient_chat_model_retries_then_fails_over(monkeypatch):
+    """
+    ResilientChatModelが一時的な失敗をリトライし、失敗が続くとフォールバック先に切り替えるかをテスト。
+    """
+    monkeypatch.setattr(llm_resilience, "llm_health", llm_resilience.BackendHealth())
+    primary = _FakeBackend("primary", [_timeout_error(), _timeout_error()])
+    fallback = _FakeBackend("fallback")
+    model = llm_resilience.ResilientChatModel(
+        backends=[("primary", primary), ("fallback", fallback)],
+        retry={"max_attempts": 2, "initial_delay": 0, "max_delay": 0, "jitter": 0},
+    )
+    result = asyncio.run(model.ainvoke("こんにちは"))
+    assert result.content == "fallback"
+    assert primary.calls == 2 and fallback.calls == 1
+
+    # リトライしても解決しない失敗は、同じバックエンドでリトライせずに切り替える
+    primary = _FakeBackend("primary", [ValueError("bad request")])
+    model.backends = [("primary", primary), ("fallback", fallback)]
+    assert asyncio.run(model.ainvoke("こんにちは")).content == "fallback"
+    assert primary.calls == 1
+
+
+def test_resilient_chat_model_skips_degraded_backend(monkeypatch):
+    """
+    連続して失敗したバックエンドが劣化中とみなされ、次のリクエストでは後回しにされるかをテスト。
+    """
+    health = llm_resilience.BackendHealth(degrade_after=2, cooldown_seconds=60)
+    monkeypatch.setattr(llm_resilience, "llm_health", health)
+    health.record_failure("primary")
+    health.record_failure("primary")
+    assert health.is_degraded("primary")
+
+    primary = _FakeBackend("primary")
+    fallback = _FakeBackend("fallback")
+    model = llm_resilience.ResilientChatModel(
+        backends=[("primary", primary), ("fallback", fallback)]
+    )
+    assert asyncio.run(model.ainvoke("こんにちは")).content == "fallback"
+    assert primary.calls == 0
+    assert health.snapshot()["fallback"]["successes"] == 1
+
+
+def test_resilient_chat_model_rate_limits_in_priority_order(monkeypatch):
+    """
+    rate_limitを設定したバックエンドへのLLM呼び出しが、トークンの空きができるまで待たされ、
+    対話的なリクエストがバッチのリクエストより先に送られるかをテスト。
+    """
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    limits = llm_resilience.LLMRateLimits()
+    monkeypatch.setattr(llm_resilience, "llm_rate_limits", limits)
+    monkeypatch.setattr(llm_resilience, "llm_health", llm_resilience.BackendHealth())
+    order = []
+
+    class Backend:
+        async def _agenerate(self, messages, stop=None, **kwargs):
+            order.append(messages[-1].content)
+            message = AIMessage(
+                content="ok",
+                usage_metadata={
+                    "input_tokens": 40,
+                    "output_tokens": 10,
+                    "total_tokens": 50,
+                },
+            )
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    rate_limit = {"tokens_per_minute": 1200, "estimated_output_tokens": 0}
+    model = llm_resilience.ResilientChatModel(
+        backends=[("primary", Backend())], rate_limits={"primary": rate_limit}
+    )
+    limiter = limits.get("primary", rate_limit)
+    # 空きがない状態にしておく（1秒あたり20トークン回復する）
+    limiter.tokens.consume(1200)
+
+    async def batch():
+        with llm_resilience.llm_priority("batch"):
+            return await model.ainvoke("バッチ")
+
+    async def run():
+        batch_task = asyncio.create_task(batch())
+        await asyncio.sleep(0.02)
+        await model.ainvoke("対話")
+        await batch_task
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    assert order == ["対話", "バッチ"]
+    assert time.perf_counter() - started >= 0.3
+    snapshot = limits.snapshot()["primary"]
+    assert snapshot["acquired"] == 2 and snapshot["throttled"] == 2
+    assert snapshot["waiting"] == 0
+    # 実際の使用量（50トークン）が見積もりより多い分は精算され、空きが減る
+    assert snapshot["tokens_headroom"] < 0
+    assert snapshot["requests_headroom"] is None
+
+    built = langchain_mcp_utils.build_chat_model(
+        "OpenAI",
+        {"OpenAI": {"model": "gpt-4o", "base_url": "", "rate_limit": rate_limit}},
+    )
+    assert built.rate_limits == {"OpenAI": rate_limit}
+
+
+def test_resilient_chat_model_ignores_client_errors(monkeypatch):
+    """
+    リクエスト自体の誤り（400など）はバックエンドの失敗に数えず、タイムアウトは数えるかをテスト。
+    """
+    import httpx
+    import openai
+
+    health = llm_resilience.BackendHealth(degrade_after=1)
+    monkeypatch.setattr(llm_resilience, "llm_health", health)
+    bad_request = openai.BadRequestError(
+        "context_length_exceeded",
+        response=httpx.Response(400, request=httpx.Request("POST", "http://llm")),
+        body=None,
+    )
+    primary = _FakeBackend("primary", [bad_request, _timeout_error()])
+    fallback = _FakeBackend("fallback")
+    model = llm_resilience.ResilientChatModel(
+        backends=[("primary", primary), ("fallback", fallback)],
+        retry={"max_attempts": 1, "initial_delay": 0, "max_delay": 0, "jitter": 0},
+    )
+
+    assert asyncio.run(model.ainvoke("こんにちは")).content == "fallback"
+    assert not health.is_degraded("primary")
+
+    # タイムアウトはバックエンドの不調として数える
+    assert asyncio.run(model.ainvoke("こんにちは")).content == "fallback"
+    assert health.is_degraded("primary")
+
+
+def test_resilient_chat_model_refunds_tokens_of_failed_attempts(monkeypatch):
+    """
+    失敗した試行で見積もったトークンがレート制限に返却されるかをテスト。
+    """
+    limits = llm_resilience.LLMRateLimits()
+    monkeypatch.setattr(llm_resilience, "llm_rate_limits", limits)
+    primary = _FakeBackend("primary", [_timeout_error()])
+    fallback = _FakeBackend("fallback")
+    rate_limit = {"tokens_per_minute": 60_000, "estimated_output_tokens": 500}
+    model = llm_resilience.ResilientChatModel(
+        backends=[("primary", primary), ("fallback", fallback)],
+        retry={"max_attempts": 1, "initial_delay": 0, "max_delay": 0, "jitter": 0},
+        rate_limits={"primary": rate_limit},
+    )
+    limiter = limits.get("primary", rate_limit)
+
+    assert asyncio.run(model.ainvoke("こんにちは")).content == "fallback"
+    # 失敗した試行の見積もり分は返却されている（回復分を除いてほぼ満杯）
+    assert limiter.tokens.headroom() >= 60_000 - 1
+
+
+def test_prompt_layout_is_canonical_and_cache_hits_are_reported():
+    """
+    システムプロンプトの正規化・ツールの並び順・スキーマのキー順によってプロンプトの先頭が毎回同じになり、
+    キャッシュから読み込まれたトークンの割合がバックエンドごとに集計されるかをテスト。
+    """
+    import json
+
+    from langchain_core.messages import AIMessage
+    from langchain_core.tools import StructuredTool
+
+    indented = """
+            あなたはアシスタントです。
+            1. 日本語で回答してください。   
+            """
+    first = llm_prompt.build_prompt_messages(indented, [], "質問1")
+    second = llm_prompt.build_prompt_messages(
+        llm_prompt.DEFAULT_SYSTEM_PROMPT.replace("\n", "\r\n"),
+        [
+            {"role": "user", "content": "質問1"},
+            {"role": "assistant", "content": "回答1"},
+        ],
+        "質問2",
+    )
+    assert (
+        first[0]["content"]
+        == "あなたはアシスタントです。\n1. 日本語で回答してください。"
+    )
+    assert second[0]["content"] == llm_prompt.DEFAULT_SYSTEM_PROMPT
+    assert [m["type"] for m in second] == ["system", "human", "ai", "human"]
+
+    def make_tool(name, schema):
+        return StructuredTool(
+            name=name,
+            description=name,
+            args_schema=schema,
+            coroutine=lambda **kwargs: None,
+        )
+
+    alpha = {
+        "type": "object",
+        "properties": {"b": {"type": "string"}, "a": {"type": "integer"}},
+    }
+    alpha_reordered = {
+        "properties": {"a": {"type": "integer"}, "b": {"type": "string"}},
+        "type": "object",
+    }
+    beta = {"type": "object", "properties": {}}
+    backend = langchain_mcp_utils.ChatOpenAI(model="gpt-4o", api_key="x")
+    model = llm_resilience.ResilientChatModel(backends=[("OpenAI", backend)])
+    one = model.bind_tools([make_tool("beta", beta), make_tool("alpha", alpha)])
+    two = model.bind_tools(
+        [make_tool("alpha", alpha_reordered), make_tool("beta", beta)]
+    )
+    assert json.dumps(one.kwargs["tools"]) == json.dumps(two.kwargs["tools"])
+    assert [t["function"]["name"] for t in one.kwargs["tools"]] == ["alpha", "beta"]
+
+    def step(cached):
+        return AIMessage(
+            content="",
+            usage_metadata={
+                "input_tokens": 1000,
+                "output_tokens": 10,
+                "total_tokens": 1010,
+                "input_token_details": {"cache_read": cached},
+            },
+            response_metadata={"llm_backend": "OpenAI"},
+        )
+
+    record = langchain_mcp_utils.build_run_record(
+        {"messages": [step(0), step(900), AIMessage(content="回答")]}
+    )
+    usage = record.usage_by_backend({})
+    assert usage["OpenAI"]["cache_hits"] == 1
+    assert run_records.cache_hit_rate(usage["OpenAI"]) == pytest.approx(0.45)
+    assert "キャッシュヒット率 45%" in run_records.format_usage(usage)
+
+    before = app_metrics.get_metrics_snapshot()["prompt_cache"].get("OpenAI")
+    run_records.record_usage(record)
+    after = app_metrics.get_metrics_snapshot()["prompt_cache"]["OpenAI"]
+    assert after["cache_hits"] - (before or {}).get("cache_hits", 0) == 1
+    assert 0 < after["hit_rate"] <= 1
+
+
+def test_build_chat_model_fallback_chain():
+    """
+    build_chat_modelがfallbacksの順にバックエンドを構成し、未定義の名前を無視するかをテスト。
+    """
+    llm_options = {
+        "OpenAI": {
+            "model": "gpt-4o",
+            "base_url": "http://127.0.0.1:4000",
+            "fallbacks": ["Gemini", "Unknown", "OpenAI"],
+            "retry": {"max_attempts": 3},
+        },
+        "Gemini": {"model": "gemini-pro", "base_url": "http://127.0.0.1:4000"},
+    }
+    model = langchain_mcp_utils.build_chat_model("OpenAI", llm_options)
+    assert [name for name, _ in model.backends] == ["OpenAI", "Gemini"]
+    assert model.backends[1][1].model_name == "gemini-pro"
+    assert model.retry["max_attempts"] == 3
+    assert model.backends[0][1].max_retries == 0
+    delay = llm_resilience.compute_retry_delay(10, model.retry)
+    assert 0 < delay <= model.retry["max_delay"]
+
+
+def _make_looping_chat_model(delay=0.0):
+    """
+    run_agent_with_budgetのテスト用チャットモデルを作成する。ツールをバインドすると毎回ツール呼び出しを返す。
+    """
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    class LoopingChatModel(BaseChatModel):
+        bound: bool = False
+        calls: list = []
+
+        @property
+        def _llm_type(self) -> str:
+            return "looping"
+
+        def bind_tools(self, tools, **kwargs):
+            return self.model_copy(update={"bound": True})
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            raise NotImplementedError
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(delay)
+            self.calls.append(self.bound)
+            if self.bound:
+                message = AIMessage(
+                    content="",
+                    tool_calls=[
+                        {"name": "echo", "args": {"text": "a"}, "id": f"c{i}"}
+                        for i in range(len(self.calls) * 2, len(self.calls) * 2 + 2)
+                    ],
+                )
+            else:
+                message = AIMessage(content="最終回答")
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    return LoopingChatModel(calls=[])
+
+
+def test_run_agent_with_budget_stops_and_answers():
+    """
+    run_agent_with_budgetが上限に達したときにツール実行を打ち切り、最終回答を生成するかをテスト。
+    """
+    from langchain_core.tools import tool
+    from langgraph.prebuilt import create_react_agent
+
+    @tool
+    def echo(text: str) -> str:
+        """入力をそのまま返す"""
+        return text
+
+    inputs = {"messages": [{"type": "human", "content": "質問"}]}
+    llm = _make_looping_chat_model()
+    agent = create_react_agent(llm, [echo])
+    response, outcome = asyncio.run(
+        run_budget.run_agent_with_budget(agent, llm, inputs, {"max_tool_calls": 5})
+    )
+    # 2件ずつのツール呼び出しを2回実行した後、3回目は上限を超えるため実行しない
+    assert outcome["reason"] == "max_tool_calls"
+    assert outcome["tool_calls"] == 4
+    assert langchain_mcp_utils.extract_answer(response) == "最終回答"
+    assert all(
+        call["id"]
+        in {m.tool_call_id for m in response["messages"][1:-1] if m.type == "tool"}
+        for m in response["messages"]
+        if m.type == "ai"
+        for call in m.tool_calls
+    )
+    note = run_budget.format_budget_outcome(outcome)
+    assert "最大ツール呼び出し数" in note and "ツール呼び出し数: 4" in note
+
+    llm = _make_looping_chat_model()
+    agent = create_react_agent(llm, [echo])
+    _, outcome = asyncio.run(
+        run_budget.run_agent_with_budget(agent, llm, inputs, {"max_steps": 1})
+    )
+    assert outcome["reason"] == "max_steps" and outcome["tool_calls"] == 0
+
+    # 制限時間を超えた場合も、得られた情報から回答する
+    llm = _make_looping_chat_model(delay=0.05)
+    agent = create_react_agent(llm, [echo])
+    response, outcome = asyncio.run(
+        run_budget.run_agent_with_budget(agent, llm, inputs, {"timeout_seconds": 0.12})
+    )
+    assert outcome["reason"] == "timeout"
+    assert langchain_mcp_utils.extract_answer(response) == "最終回答"
+
+
+def test_run_agent_with_budget_timeout_during_tool_call():
+    """
+    ツールの実行中に制限時間を超えた場合、結果のないツール呼び出しを除いて最終回答を生成し、
+    最終回答の生成もfinal_answer_timeoutを超えた場合は例外にせず、定型文を回答とするかをテスト。
+    """
+    from langchain_core.tools import tool
+    from langgraph.prebuilt import create_react_agent
+
+    @tool
+    async def echo(text: str) -> str:
+        """入力をそのまま返す"""
+        await asyncio.sleep(1)
+        return text
+
+    inputs = {"messages": [{"type": "human", "content": "質問"}]}
+    llm = _make_looping_chat_model()
+    agent = create_react_agent(llm, [echo])
+    started = time.perf_counter()
+    response, outcome = asyncio.run(
+        run_budget.run_agent_with_budget(agent, llm, inputs, {"timeout_seconds": 0.1})
+    )
+    assert time.perf_counter() - started < 1
+    assert outcome["reason"] == "timeout" and outcome["tool_calls"] == 0
+    assert not any(getattr(m, "tool_calls", None) for m in response["messages"])
+    assert langchain_mcp_utils.extract_answer(response) == "最終回答"
+
+    llm = _make_looping_chat_model(delay=0.2)
+    agent = create_react_agent(llm, [echo])
+    response, outcome = asyncio.run(
+        run_budget.run_agent_with_budget(
+            agent,
+            llm,
+            inputs,
+            {"timeout_seconds": 0.1, "final_answer_timeout": 0.05},
+        )
+    )
+    assert outcome["reason"] == "timeout" and outcome["final_answer"] == "timeout"
+    assert (
+        langchain_mcp_utils.extract_answer(response)
+        == run_budget.BUDGET_EXHAUSTED_MESSAGE
+    )
+    assert "最終回答の生成も時間内に終わりませんでした" in (
+        run_budget.format_budget_outcome(outcome)
+    )
+
+
+def test_run_agent_with_budget_without_limits_uses_ainvoke():
+    """
+    上限を設定しない場合、run_agent_with_budgetがそのままainvokeを呼び出すかをテスト。
+    """
+
+    class DummyAgent:
+        async def ainvoke(self, inputs):
+            return {"output": "回答"}
+
+    response, outcome = asyncio.run(
+        run_budget.run_agent_with_budget(DummyAgent(), None, {"messages": []}, {})
+    )
+    assert response == {"output": "回答"} and outcome is None
+    assert run_budget.format_budget_outcome(outcome) == ""
+
+
+def test_build_run_record_single_pass():
+    """
+    build_run_recordが回答・ツール呼び出し・結果サイズ・所要時間・トークン使用量を記録するかをテスト。
+    """
+    from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+    messages = [
+        HumanMessage(content="質問"),
+        AIMessage(
+            content="",
+            tool_calls=[
+                {"name": "search", "args": {"q": "a"}, "id": "c1"},
+                {"name": "fetch", "args": {"url": "u"}, "id": "c2"},
+            ],
+            usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15},
+            response_metadata={"llm_backend": "OpenAI", "model_name": "gpt-4o"},
+        ),
+        ToolMessage(
+            content="結果です",
+            tool_call_id="c1",
+            artifact={
+                "server": "s1",
+                "started_at": 1.0,
+                "ended_at": 1.5,
+                "artifact": None,
+            },
+        ),
+        ToolMessage(content="失敗", tool_call_id="c2", status="error"),
+        AIMessage(
+            content="回答",
+            usage_metadata={"input_tokens": 30, "output_tokens": 7, "total_tokens": 37},
+        ),
+    ]
+    record = langchain_mcp_utils.build_run_record({"messages": messages})
+    assert record.answer == "回答"
+    assert [call.name for call in record.tool_calls] == ["search", "fetch"]
+    search, fetch = record.tool_calls
+    assert search.server == "s1" and search.duration == 0.5
+    assert search.result_chars == len("結果です") and not search.is_error
+    assert fetch.is_error and fetch.duration is None
+    assert [step.tool_calls for step in record.steps] == [2, 0]
+    assert record.steps[0].llm_backend == "OpenAI"
+    assert (record.input_tokens, record.output_tokens) == (40, 12)
+    assert not hasattr(record, "__dict__")
+
+    history = record.tool_history()
+    assert history[0].startswith("ツール名: search, 引数: {'q': 'a'}, 開始: +0.000秒")
+    assert history[1].endswith("結果: 2文字, エラー")
+    rendered = record.render()
+    assert rendered.startswith("回答\n\n[呼び出されたツール履歴]\n")
+
+    # messagesを含まない応答は回答のみ
+    record = langchain_mcp_utils.build_run_record({"output": "テスト回答"})
+    assert record.render() == "テスト回答"
+
+
+def test_build_run_record_ignores_earlier_turns():
+    """
+    build_run_recordが会話履歴に含まれる以前のターンの回答を、今回の実行のステップとして数えないかをテスト。
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    messages = [
+        HumanMessage(content="前の質問"),
+        AIMessage(content="前の回答"),
+        HumanMessage(content="質問"),
+        AIMessage(
+            content="回答",
+            usage_metadata={"input_tokens": 30, "output_tokens": 7, "total_tokens": 37},
+            response_metadata={"llm_backend": "OpenAI", "model_name": "gpt-4o"},
+        ),
+    ]
+    record = langchain_mcp_utils.build_run_record({"messages": messages})
+    assert record.answer == "回答"
+    assert [step.llm_backend for step in record.steps] == ["OpenAI"]
+    usage = run_records.format_usage(record.usage_by_backend({}))
+    assert usage.startswith("OpenAI: 入力 30") and "unknown" not in usage
+
+
+def test_run_record_usage_by_backend_with_pricing():
+    """
+    usage_by_backendがキャッシュ・所要時間（並行ツールの重なりは1回分）・推定コストを
+    バックエンドごとに集計し、UsageTotalsが累計するかをテスト。
+    """
+    from langchain_core.messages import AIMessage, ToolMessage
+
+    def tool_message(call_id, started_at, ended_at):
+        return ToolMessage(
+            content="ok",
+            tool_call_id=call_id,
+            artifact={"server": "s", "started_at": started_at, "ended_at": ended_at},
+        )
+
+    messages = [
+        AIMessage(
+            content="",
+            tool_calls=[
+                {"name": "a", "args": {}, "id": "c1"},
+                {"name": "b", "args": {}, "id": "c2"},
+            ],
+            usage_metadata={
+                "input_tokens": 1000,
+                "output_tokens": 100,
+                "total_tokens": 1100,
+                "input_token_details": {"cache_read": 800},
+            },
+            response_metadata={"llm_backend": "OpenAI", "llm_latency": 1.5},
+        ),
+        tool_message("c1", 10.0, 11.0),
+        tool_message("c2", 10.5, 12.0),
+        AIMessage(
+            content="回答",
+            usage_metadata={
+                "input_tokens": 50,
+                "output_tokens": 10,
+                "total_tokens": 60,
+            },
+            response_metadata={"llm_backend": "Gemini", "llm_latency": 0.5},
+        ),
+    ]
+    record = langchain_mcp_utils.build_run_record({"messages": messages})
+    assert record.cached_tokens == 800
+    assert (record.llm_seconds, record.tool_seconds) == (2.0, 2.0)
+
+    usage = record.usage_by_backend(
+        {"OpenAI": {"input": 2.0, "cached_input": 1.0, "output": 10.0}}
+    )
+    openai = usage["OpenAI"]
+    assert (openai["tool_calls"], openai["tool_seconds"]) == (2, 2.0)
+    # (200 * 2.0 + 800 * 1.0 + 100 * 10.0) / 1,000,000
+    assert openai["cost"] == pytest.approx(0.0022)
+    assert usage["Gemini"]["cost"] is None
+
+    totals = run_records.UsageTotals()
+    totals.add(usage)
+    totals.add(usage)
+    assert totals.turns == 2
+    assert totals.by_backend["OpenAI"]["input_tokens"] == 2000
+    assert totals.by_backend["OpenAI"]["cost"] == pytest.approx(0.0044)
+    rendered = totals.render()
+    assert "累計 (2ターン)" in rendered
+    assert "OpenAI: 入力 1,000 (キャッシュ 800) / 出力 100 トークン" in rendered
+    assert "推定 $0.0044" in rendered
+
+
+def test_warm_up_pings_llms_and_sessions_on_app_loop(monkeypatch):
+    """
+    warm_upがLLM・MCPサーバー・プロンプトを温め、失敗を記録して継続するか、
+    また常駐イベントループで実行されるかをテスト。
+    """
+    loops = []
+
+    async def fake_ping(llm_name, llm_options):
+        loops.append(asyncio.get_running_loop())
+        if llm_name == "Broken":
+            raise ConnectionError("refused")
+
+    async def fake_warm(server_name, connection):
+        loops.append(asyncio.get_running_loop())
+
+    async def runner(prompt):
+        loops.append(asyncio.get_running_loop())
+
+    monkeypatch.setattr(langchain_mcp_utils, "_ping_llm", fake_ping)
+    monkeypatch.setattr(langchain_mcp_utils, "_warm_mcp_server", fake_warm)
+    monkeypatch.setattr(mcp_http.mcp_http_pool, "enabled", True)
+    report = app_loop.run_on_app_loop(
+        langchain_mcp_utils.warm_up(
+            {"OpenAI": {}, "Broken": {}},
+            {
+                "s1": {"transport": "streamable_http", "url": "http://mcp"},
+                "per_call": {"transport": "stdio"},
+            },
+            {"prompts": ["こんにちは"]},
+            prompt_runner=runner,
+        )
+    )
+    assert report["llm"]["OpenAI"]["ok"] and not report["llm"]["Broken"]["ok"]
+    assert "refused" in report["llm"]["Broken"]["error"]
+    assert report["mcp"]["s1"]["ok"] and report["prompts"][0]["ok"]
+    # 呼び出しごとに起動するstdioサーバーは、温めても再利用されないため対象外
+    assert "per_call" not in report["mcp"]
+    assert app_metrics.get_metrics_snapshot()["warmup"] == report
+    # すべて同じ常駐ループで実行され、以降のリクエストも同じループを使う
+    assert set(loops) == {app_loop.get_app_loop()}
+    assert "LLM Broken: 失敗" in langchain_mcp_utils.summarize_warmup(report)
+
+
+_STDIO_TEST_SERVER = """
+import asyncio
+import os
+from mcp.server.fastmcp import FastMCP
+
+mcp = FastMCP("test")
+
+
+@mcp.tool()
+def whoami() -> str:
+    return str(os.getpid())
+
+
+@mcp.tool()
+def fail() -> str:
+    raise ValueError("broken")
+
+
+@mcp.tool()
+async def slow(path: str, seconds: float) -> str:
+    await asyncio.sleep(seconds)
+    with open(path, "w") as f:
+        f.write("done")
+    return "done"
+
+
+mcp.run()
+"""
+
+
+def test_mcp_gateway_shares_one_stdio_process(tmp_path):
+    """
+    MCPゲートウェイ経由のツール呼び出しが、1つのstdioサーバープロセスを共有するかをテスト。
+    """
+    import sys
+    import httpx
+    import mcp_gateway
+
+    script = tmp_path / "server.py"
+    script.write_text(_STDIO_TEST_SERVER, encoding="utf-8")
+    backend = mcp_supervisor.PersistentMCPSession(
+        "test", {"transport": "stdio", "command": sys.executable, "args": [str(script)]}
+    )
+    app = mcp_gateway.build_gateway_app({"test": backend})
+
+    def client_factory(headers=None, timeout=None, auth=None):
+        return httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            headers=headers,
+            timeout=timeout,
+            auth=auth,
+        )
+
+    servers = mcp_supervisor.resolve_servers(
+        {
+            "servers": {"test": {"transport": "stdio", "command": "unused"}},
+            "gateway": {"enabled": "true", "url": "http://gateway"},
+        }
+    )
+    assert servers["test"] == {
+        "transport": "streamable_http",
+        "url": "http://gateway/servers/test/mcp",
+    }
+    connection = {**servers["test"], "httpx_client_factory": client_factory}
+
+    async def run():
+        async with app.router.lifespan_context(app):
+            definitions = await tool_catalog.fetch_tool_definitions(connection)
+            tools = {
+                tool.name: tool
+                for tool in tool_catalog.build_tools_from_definitions(
+                    definitions, connection, "test"
+                )
+            }
+            pids = await asyncio.gather(
+                *(tools["whoami"].ainvoke({}) for _ in range(5))
+            )
+            with pytest.raises(Exception, match="broken"):
+                await tools["fail"].ainvoke({})
+            return pids
+
+    pids = asyncio.run(run())
+    # 5回の呼び出し（それぞれ別のHTTPセッション）が、同じ1つのサーバープロセスで処理される
+    assert len(set(pids)) == 1
+    assert backend.opened_count == 1 and not backend.is_open
+
+
+def test_stdio_supervisor_restarts_and_recycles(tmp_path, monkeypatch):
+    """
+    StdioSupervisorがクラッシュしたプロセスを再起動し、呼び出し回数の上限で入れ替えるかをテスト。
+    """
+    import sys
+
+    psutil = pytest.importorskip("psutil")
+    script = tmp_path / "server.py"
+    script.write_text(_STDIO_TEST_SERVER, encoding="utf-8")
+    supervisor = mcp_supervisor.StdioSupervisor()
+    supervisor.configure(
+        {"enabled": "true", "recycle_after_calls": 3, "restart_initial_delay": 0},
+        {
+            "test": {
+                "transport": "stdio",
+                "command": sys.executable,
+                "args": [str(script)],
+            },
+            "remote": {"transport": "streamable_http", "url": "http://remote/mcp"},
+        },
+        {},
+    )
+    # stdioのサーバーのみ監視対象になる
+    assert list(supervisor.servers) == ["test"]
+    server = supervisor.get("test")
+    monkeypatch.setattr(mcp_supervisor, "stdio_supervisor", supervisor)
+
+    async def whoami():
+        result = await tool_catalog._ServerRoute("test", {}).call_tool("whoami", {})
+        return int(result.content[0].text)
+
+    async def run():
+        await supervisor.check_all()
+        first_pid = server.pid
+        assert server.state == "running" and await whoami() == first_pid
+
+        # プロセスが落ちたことをヘルスチェックで検知して再起動する
+        psutil.Process(first_pid).kill()
+        await asyncio.sleep(0.2)
+        await supervisor.check_all()
+        assert server.restarts == 1 and server.state == "running"
+        assert server.pid != first_pid and await whoami() == server.pid
+
+        # 呼び出し回数が上限に達したプロセスは、実行中の呼び出しがないときに入れ替える
+        second_pid = server.pid
+        await whoami()
+        await whoami()
+        await supervisor.check_all()
+        assert server.recycles == 1 and server.pid != second_pid
+        assert server.calls_since_start == 0 and server.rss_mb is None
+        await supervisor.check_all()
+        assert server.rss_mb > 0
+        heading = mcp_supervisor.format_supervisor_state("test")
+        await server.close()
+        return heading
+
+    heading = app_loop.run_on_app_loop(run())
+    assert "稼働中" in heading and "再起動 1回" in heading
+    assert server.state == "stopped"
+
+
+def test_request_profiler_writes_folded_stacks_with_rate_limit(tmp_path):
+    """
+    RequestProfilerが指定したリクエストのスタックをfolded形式で保存し、1分あたりの上限を守るかをテスト。
+    """
+    profiler = profiling.RequestProfiler()
+
+    async def busy():
+        started = time.perf_counter()
+        while time.perf_counter() - started < 0.1:
+            sum(range(1000))
+        await asyncio.sleep(0)
+        return "ok"
+
+    # 無効な場合は計測しない
+    assert asyncio.run(profiler.run("chat", busy(), force=True)) == ("ok", None)
+
+    profiler.configure(
+        {
+            "enabled": "true",
+            "sample_rate": 0,
+            "max_per_minute": 1,
+            "interval_ms": 1,
+            "dir": str(tmp_path),
+        }
+    )
+    assert asyncio.run(profiler.run("chat", busy())) == ("ok", None)
+    result, path = asyncio.run(profiler.run("chat", busy(), force=True))
+    assert result == "ok" and path.endswith(".folded")
+    lines = open(path, encoding="utf-8").read().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0 and "busy (test_langchain_mcp_utils.py:" in stack
+    # 1分あたりの上限を超えた分は計測しない
+    assert asyncio.run(profiler.run("chat", busy(), force=True)) == ("ok", None)
+    assert profiler.snapshot()["rate_limited"] == 1
+
+    profiler.configure(
+        {
+            "enabled": "true",
+            "mode": "cprofile",
+            "max_per_minute": 5,
+            "dir": str(tmp_path),
+        }
+    )
+    _, path = asyncio.run(profiler.run("chat", busy(), force=True))
+    assert path.endswith(".prof")
+
+
+def test_request_profiler_skips_or_labels_overlapping_requests(tmp_path):
+    """
+    他のリクエストの実行中はサンプリングによる計測を行わず、指定して計測した場合は"-shared"を付けて保存するかをテスト。
+    """
+    profiler = profiling.RequestProfiler()
+    profiler.configure(
+        {
+            "enabled": "true",
+            "sample_rate": 1,
+            "max_per_minute": 10,
+            "interval_ms": 1,
+            "dir": str(tmp_path),
+        }
+    )
+
+    async def busy(seconds):
+        await asyncio.sleep(seconds)
+        return "ok"
+
+    async def scenario():
+        # 先に始まったリクエストと重なるため、どちらも"-shared"付きか計測なしになる
+        first = asyncio.create_task(profiler.run("first", busy(0.1)))
+        await asyncio.sleep(0.01)
+        second = await profiler.run("second", busy(0.01))
+        forced = await profiler.run("forced", busy(0.01), force=True)
+        return await first, second, forced
+
+    (_, first_path), (_, second_path), (_, forced_path) = asyncio.run(scenario())
+    assert first_path.endswith(".folded") and "-first-shared-" in first_path
+    assert second_path is None
+    # 計測中の別リクエストがあるため、指定しても同時計測はしない
+    assert forced_path is None
+    stats = profiler.snapshot()
+    assert stats["skipped_concurrent"] == 1 and stats["shared"] == 1
+
+    # 重ならなければ通常のファイル名で保存する
+    _, path = asyncio.run(profiler.run("alone", busy(0.01)))
+    assert "-alone-" in path and "-shared" not in path
+
+
+def test_configure_logging_writes_json_in_background_and_samples(tmp_path):
+    import json
+    import logging
+
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    log_file = tmp_path / "app.log"
+    try:
+        app_logging.configure_logging(
+            {
+                "level": "DEBUG",
+                "format": "json",
+                "file": str(log_file),
+                "sample_rates": {"DEBUG": 0},
+            }
+        )
+        logger = logging.getLogger("test_logging")
+        logger.info("ツール %s を呼び出し", "add", extra={"server": "math"})
+        logger.debug("間引かれる")
+        logger.warning("警告は間引かない")
+        app_logging._stop_log_listener()
+        records = [
+            json.loads(line)
+            for line in log_file.read_text(encoding="utf-8").splitlines()
+        ]
+        assert [r["message"] for r in records] == [
+            "ツール add を呼び出し",
+            "警告は間引かない",
+        ]
+        assert records[0]["server"] == "math" and records[0]["level"] == "INFO"
+
+        # キューが一杯の場合は待たずに捨てて件数を数える
+        handler = app_logging.NonBlockingQueueHandler(app_logging.queue.Queue(1))
+        for _ in range(3):
+            handler.handle(logger.makeRecord("t", logging.INFO, "", 0, "x", None, None))
+        assert handler.dropped == 2
+    finally:
+        app_logging._stop_log_listener()
+        for handler in list(root.handlers):
+            if handler not in saved_handlers:
+                root.removeHandler(handler)
+                handler.close()
+        root.setLevel(saved_level)
+
+
+def test_run_registry_cancels_runs_and_mcp_calls(tmp_path):
+    """
+    RunRegistryの停止・再送信による置き換えで常駐イベントループ上の実行がキャンセルされ、
+    共有セッションで実行中のMCPツール呼び出しもサーバー側で中断されるかをテスト。
+    """
+    import sys
+    import threading
+
+    script = tmp_path / "server.py"
+    script.write_text(_STDIO_TEST_SERVER, encoding="utf-8")
+    marker = tmp_path / "marker.txt"
+    registry = app_loop.RunRegistry()
+    session = mcp_supervisor.PersistentMCPSession(
+        "test",
+        {"transport": "stdio", "command": sys.executable, "args": [str(script)]},
+    )
+
+    async def tool_run():
+        await session.get_session()
+        started.set()
+        return await session.call_tool("slow", {"path": str(marker), "seconds": 1.0})
+
+    async def scenario():
+        # 停止ボタン（別スレッドからのキャンセル）で、実行中のツール呼び出しごと止まる
+        run = asyncio.ensure_future(
+            app_loop.await_on_app_loop(registry.run(("s1", "llm1"), tool_run()))
+        )
+        await asyncio.to_thread(started.wait, 30)
+        await asyncio.sleep(0.2)
+        assert registry.snapshot()["running"] == 1
+        await asyncio.to_thread(registry.cancel, "s1", "other")
+        await asyncio.to_thread(registry.cancel, "s1")
+        with pytest.raises(asyncio.CancelledError):
+            await run
+        # 同じセッションは引き続き使える
+        result = await app_loop.await_on_app_loop(session.call_tool("whoami", {}))
+        assert not result.isError
+
+        # 同じキーで再送信すると、前の実行はキャンセルされる
+        first = asyncio.ensure_future(
+            app_loop.await_on_app_loop(registry.run(("s1", "llm1"), asyncio.sleep(10)))
+        )
+        await asyncio.sleep(0.1)
+        second = await app_loop.await_on_app_loop(
+            registry.run(("s1", "llm1"), asyncio.sleep(0, result="ok"))
+        )
+        assert second == "ok"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    started = threading.Event()
+    try:
+        asyncio.run(scenario())
+        # キャンセル通知を受けたサーバーはツールの処理を中断している
+        time.sleep(1.5)
+        assert not marker.exists()
+        assert registry.snapshot() == {
+            "running": 0,
+            "started": 3,
+            "cancelled": 1,
+            "superseded": 1,
+        }
+    finally:
+        app_loop.run_on_app_loop(session.close())
+
+
+def test_llm_router_routes_by_heuristics_and_latency(monkeypatch):
+    """
+    LLMRouterが入力の長さ・会話の深さ・ツールとの関連度で軽量/通常を判定し、
+    候補の中から劣化中を避けて応答時間の短いLLMを選ぶかをテスト。
+    """
+    from langchain_core.tools import StructuredTool
+
+    def get_pricing(service: str) -> str:
+        """AWSサービスの料金を取得する"""
+        return service
+
+    def read_docs(url: str) -> str:
+        """ドキュメントのページを読む"""
+        return url
+
+    tools = [
+        StructuredTool.from_function(get_pricing),
+        StructuredTool.from_function(read_docs),
+    ]
+    health = llm_resilience.BackendHealth(degrade_after=1)
+    monkeypatch.setattr(llm_resilience, "llm_health", health)
+    options = {"big": {}, "small": {}, "tiny": {}}
+    router = llm_routing.LLMRouter()
+    router.configure({"enabled": "true", "light": ["small", "tiny"], "heavy": ["big"]})
+    assert router.enabled
+
+    name, reason = router.route("こんにちは", [], tools, options)
+    assert reason["tier"] == "light" and name == "small"
+    # 軽量LLMのうち、直近の応答時間が短い方を選ぶ
+    health.record_success("small", 2.0)
+    health.record_success("tiny", 0.5)
+    assert router.route("ありがとう", [], tools, options)[0] == "tiny"
+    # 劣化中のLLMは避ける
+    health.record_failure("tiny")
+    assert router.route("ありがとう", [], tools, options)[0] == "small"
+
+    # ツールが必要そうな入力・長い入力・深い会話は通常のLLM
+    name, reason = router.route("AWSの料金を調べて", [], tools, options)
+    assert name == "big" and reason["tool_score"] >= 0.35
+    assert router.route("あ" * 300, [], tools, options)[0] == "big"
+    history = [{"role": "user", "content": "q"}, {"role": "assistant", "content": "a"}]
+    assert router.route("はい", history * 5, tools, options)[0] == "big"
+    # ツールが無効な場合は関連度を計算しない
+    assert router.route("AWSの料金を調べて", [], [], options)[1]["tier"] == "light"
+    assert router.snapshot()["by_llm"] == {"small": 3, "tiny": 1, "big": 3}
+
+    # llmセクションが空の場合は既定のLLMを使う
+    assert router.route("こんにちは", [], tools, {})[0] == "Default"
+    assert router.route("こんにちは", [], tools, {}, "OpenAI")[0] == "OpenAI"
+
+
+def test_conversation_store_batches_resumes_and_compacts(tmp_path):
+    """
+    ConversationStoreがバックグラウンドでまとめて書き込み、直近のメッセージだけを読み込み、
+    件数の上限を超えた古い履歴を削除するかをテスト。
+    """
+    import sqlite3
+
+    from langchain_core.messages import AIMessage
+
+    path = str(tmp_path / "history.sqlite3")
+    store = history_store.ConversationStore(
+        path, {"resume_messages": 4, "max_messages_per_session": 6, "retention_days": 0}
+    )
+    record = langchain_mcp_utils.build_run_record(
+        {"messages": [AIMessage(content="回答")]}
+    )
+    try:
+        for i in range(5):
+            store.append(
+                "c1",
+                "llm1",
+                [
+                    {"role": "user", "content": f"質問{i}"},
+                    {"role": "assistant", "content": f"回答{i}" + "長い" * 300},
+                ],
+                record,
+            )
+        store.append("c1", "llm2", [{"role": "user", "content": "別ペイン"}])
+        store.flush()
+        assert store.snapshot()["messages"] == 11
+
+        recent = store.load_recent("c1", "llm1")
+        assert [m["content"][:3] for m in recent] == [
+            "質問3",
+            "回答3",
+            "質問4",
+            "回答4",
+        ]
+        # ユーザーの発言から始まるよう、途中のアシスタントの回答は読み込まない
+        assert store.load_recent("c1", "llm1", 3)[0]["content"] == "質問4"
+        assert store.load_recent("c1", "llm2") == [
+            {"role": "user", "content": "別ペイン"}
+        ]
+        assert store.load_recent("other", "llm1") == []
+
+        assert store.compact() == 4
+        assert len(store.load_recent("c1", "llm1", 100)) == 6
+    finally:
+        store.close()
+
+    with sqlite3.connect(path) as conn:
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(messages)")}
+        assert "messages_session" in indexes and "messages_created_at" in indexes
+        compressed, run_record = conn.execute(
+            "SELECT compressed, run_record FROM messages WHERE pane = 'llm1'"
+            " ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+    assert compressed == 1 and run_record is not None
+
+
+def test_conversation_store_releases_space_after_compaction(tmp_path):
+    """
+    新しく作成した履歴ファイルがauto_vacuum=INCREMENTALになり、
+    上限を超えた履歴を削除したときに空き領域を解放するかをテスト。
+    """
+    import os
+    import sqlite3
+
+    path = str(tmp_path / "history.sqlite3")
+    store = history_store.ConversationStore(
+        path, {"max_messages_per_session": 1, "retention_days": 0}
+    )
+    try:
+        for i in range(50):
+            # 圧縮で小さくならないよう、ランダムな内容にする
+            content = f"質問{i}" + os.urandom(4000).hex()
+            store.append("c1", "llm1", [{"role": "user", "content": content}])
+        store.flush()
+        assert store.compact() == 49
+    finally:
+        store.close()
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+
+def test_cassette_records_and_replays_llm_stream_and_tool_calls(tmp_path, monkeypatch):
+    """
+    Cassetteが、LLMのストリーミング応答（チャンクとその時刻）とMCPツールの結果を記録し、
+    サーバーなしで同じ結果を再生できるか、latency="none"で待たずに再生できるかをテスト。
+    """
+    import json
+
+    import httpx
+    from mcp.types import CallToolResult, TextContent
+
+    def sse(text):
+        chunk = {
+            "id": "c1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4o",
+            "choices": [
+                {"index": 0, "delta": {"content": text}, "finish_reason": None}
+            ],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    async def stream_body():
+        for text in ["こん", "にちは"]:
+            await asyncio.sleep(0.05)
+            yield sse(text)
+        yield b"data: [DONE]\n\n"
+
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(
+            200, headers={"content-type": "text/event-stream"}, content=stream_body()
+        )
+
+    path = str(tmp_path / "session.jsonl.gz")
+    tool_calls = []
+
+    async def call(name, arguments):
+        tool_calls.append(name)
+        await asyncio.sleep(0.05)
+        return CallToolResult(content=[TextContent(type="text", text="晴れ")])
+
+    async def exercise(cassette):
+        monkeypatch.setattr(llm_cassette, "active_cassette", cassette)
+        llm = langchain_mcp_utils.initialize_llm(
+            "gpt-4o", "http://llm.invalid/v1", api_key="x", max_retries=0
+        )
+        started = time.perf_counter()
+        text = "".join([chunk.content async for chunk in llm.astream("挨拶して")])
+        result = await cassette.call_tool("weather", "forecast", {"city": "東京"}, call)
+        return text, result.content[0].text, time.perf_counter() - started
+
+    recorder = llm_cassette.Cassette(
+        path, "record", transport=httpx.MockTransport(handler)
+    )
+    recorder.add_tools({"weather": [{"name": "forecast", "inputSchema": {}}]})
+    assert asyncio.run(exercise(recorder))[:2] == ("こんにちは", "晴れ")
+    recorder.save()
+    assert recorder.snapshot()["recorded"] == 2
+
+    # 再生時は記録時のLLM・ツールには一切アクセスしない
+    replayer = llm_cassette.Cassette(path, "replay")
+    assert replayer.tools == {"weather": [{"name": "forecast", "inputSchema": {}}]}
+    text, tool_text, elapsed = asyncio.run(exercise(replayer))
+    assert (text, tool_text) == ("こんにちは", "晴れ")
+    assert elapsed >= 0.15
+    assert len(requests) == 1 and tool_calls == ["forecast"]
+
+    fast = llm_cassette.Cassette(path, "replay", speed=0.0)
+    text, tool_text, elapsed = asyncio.run(exercise(fast))
+    assert (text, tool_text) == ("こんにちは", "晴れ")
+    assert elapsed < 0.15
+    assert fast.snapshot()["replayed"] == 2
+
+    with pytest.raises(llm_cassette.CassetteMiss):
+        asyncio.run(fast.call_tool("weather", "forecast", {"city": "大阪"}, call))
+
+
+def test_cassette_replay_miss_fails_llm_call_without_network(tmp_path, monkeypatch):
+    """
+    再生時にカセットに記録のないLLMリクエストを送った場合、実際には送信せずにCassetteMissで失敗し、
+    ミスの件数が記録されるかをテスト。
+    """
+    import openai
+
+    path = str(tmp_path / "empty.jsonl")
+    llm_cassette.Cassette(path, "record").save()
+    replayer = llm_cassette.Cassette(path, "replay", speed=0.0)
+    monkeypatch.setattr(llm_cassette, "active_cassette", replayer)
+    llm = langchain_mcp_utils.initialize_llm(
+        "gpt-4o", "http://llm.invalid/v1", api_key="x", max_retries=0
+    )
+    with pytest.raises(openai.APIConnectionError) as excinfo:
+        asyncio.run(llm.ainvoke("記録されていない質問"))
+    assert isinstance(excinfo.value.__cause__, llm_cassette.CassetteMiss)
+    assert replayer.snapshot()["misses"] == 1
+
+
+def test_cassette_replays_requests_with_truncated_tool_results(tmp_path, monkeypatch):
+    """
+    切り詰めたツール結果（退避先のハンドルを含む）をLLMに送る場合も、別の退避先を使う再生時に
+    同じリクエストとなり、カセットから再生できるかをテスト。
+    """
+    import httpx
+    from mcp.types import CallToolResult, TextContent
+
+    def handler(request):
+        return httpx.Response(
+            200,
+            json={
+                "id": "c1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-4o",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "要約しました"},
+                        "finish_reason": "stop",
+                    }
+                ],
+            },
+        )
+
+    async def call(name, arguments):
+        return CallToolResult(content=[TextContent(type="text", text="長い文書" * 50)])
+
+    async def exercise(cassette, spill_dir):
+        monkeypatch.setattr(llm_cassette, "active_cassette", cassette)
+        tool_results.configure_tool_results(
+            {"max_chars": 10, "spill_dir": str(spill_dir)}
+        )
+        result = await cassette.call_tool("docs", "read", {}, call)
+        shown = tool_results.apply_tool_result_policy("read", result.content[0].text)
+        assert "ハンドル" in shown
+        llm = langchain_mcp_utils.initialize_llm(
+            "gpt-4o", "http://llm.invalid/v1", api_key="x", max_retries=0
+        )
+        return (await llm.ainvoke(f"要約して: {shown}")).content
+
+    path = str(tmp_path / "session.jsonl")
+    try:
+        recorder = llm_cassette.Cassette(
+            path, "record", transport=httpx.MockTransport(handler)
+        )
+        assert asyncio.run(exercise(recorder, tmp_path / "record")) == "要約しました"
+        recorder.save()
+
+        replayer = llm_cassette.Cassette(path, "replay", speed=0.0)
+        assert asyncio.run(exercise(replayer, tmp_path / "replay")) == "要約しました"
+        assert replayer.snapshot()["misses"] == 0
+    finally:
+        tool_results.configure_tool_results({})
+
+
+def test_local_doc_store_indexes_tool_results_and_evicts(monkeypatch):
+    """
+    ドキュメント取得ツールの結果がローカル文書ストアに段落単位で登録され、
+    search_local_docsでBM25検索でき、上限を超えると古い文書から削除されるかをテスト。
+    """
+    store = doc_store.LocalDocStore(
+        {
+            "enabled": "true",
+            "servers": ["docs"],
+            "chunk_chars": 80,
+            "min_chars": 10,
+            "max_chars": 400,
+        }
+    )
+    monkeypatch.setattr(doc_store, "local_doc_store", store)
+    s3_page = (
+        "Amazon S3 stores objects in buckets.\n\n"
+        "S3 versioning keeps multiple variants of an object in the same bucket.\n\n"
+        "Lifecycle rules transition objects to Glacier storage classes."
+    )
+    doc_store.store_tool_document(
+        "docs", "read_documentation", {"url": "https://docs/s3"}, s3_page
+    )
+    # 対象外のサーバー・短すぎる結果は登録しない
+    doc_store.store_tool_document("other", "t", {}, s3_page)
+    doc_store.store_tool_document("docs", "t", {}, "短い")
+    assert store.snapshot()["documents"] == 1
+    assert store.snapshot()["passages"] == 3
+
+    results = store.search("s3 versioning bucket")
+    assert "versioning" in results[0][2]
+    assert results[0][1].startswith(
+        'docs/read_documentation {"url": "https://docs/s3"}'
+    )
+    text = asyncio.run(doc_store.search_local_docs("ライフサイクル glacier"))
+    assert "[1]" in text and "Glacier" in text
+    assert "ローカルに該当する文書はありません" in asyncio.run(
+        doc_store.search_local_docs("kubernetes")
+    )
+    assert "search_local_docs" in [
+        tool.name for tool in tool_catalog.create_builtin_tools()
+    ]
+
+    # 同じ出典は置き換え、上限を超えると最後に使われた時刻が古い文書から削除する
+    doc_store.store_tool_document(
+        "docs", "read_documentation", {"url": "https://docs/s3"}, s3_page
+    )
+    for i in range(3):
+        store.add(f"page{i}", f"Azure Functions page {i} " * 8)
+    snapshot = store.snapshot()
+    assert snapshot["chars"] <= 400 and snapshot["evicted"] >= 1
+    assert 'docs/read_documentation {"url": "https://docs/s3"}' not in store.documents
+    assert store.search("versioning") == []
+    assert store._total_terms == sum(
+        length for _, _, length in store._passages.values()
+    )
+
+
+def test_in_process_llm_routes_chat_completions_without_proxy(monkeypatch, tmp_path):
+    """
+    in_processモードで、ChatOpenAIのリクエストがHTTP通信なしにLiteLLM Routerへ渡され、
+    通常・ストリーミングの応答とエラーがOpenAI互換の形式で返るかをテスト。
+    """
+    import json
+
+    import openai
+
+    class Dumped(dict):
+        def model_dump_json(self):
+            return json.dumps(self)
+
+    def completion(text):
+        return Dumped(
+            id="c1",
+            object="chat.completion",
+            created=0,
+            model="gpt-4.1",
+            choices=[
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }
+            ],
+        )
+
+    def chunk(text):
+        return Dumped(
+            id="c1",
+            object="chat.completion.chunk",
+            created=0,
+            model="gpt-4.1",
+            choices=[{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+        )
+
+    class FakeRouter:
+        def __init__(self):
+            self.calls = []
+
+        async def acompletion(self, **body):
+            self.calls.append(body)
+            if body["messages"][-1]["content"] == "失敗":
+                error = RuntimeError("rate limited")
+                error.status_code = 429
+                raise error
+            if body.get("stream"):
+
+                async def stream():
+                    for text in ["こん", "にちは"]:
+                        yield chunk(text)
+
+                return stream()
+            return completion("こんにちは")
+
+        def completion(self, **body):
+            self.calls.append(body)
+            return completion("同期")
+
+    config = tmp_path / "config.yaml"
+    config.write_text(
+        "model_list:\n  - model_name: gpt-4o\n    litellm_params:\n      model: gpt-4.1\n",
+        encoding="utf-8",
+    )
+    router = FakeRouter()
+    gateway = llm_inprocess.InProcessLLM(
+        llm_inprocess.load_litellm_model_list(str(config)), router=router
+    )
+    monkeypatch.setattr(llm_inprocess, "in_process_llm", gateway)
+    monkeypatch.setattr(llm_cassette, "active_cassette", None)
+    # 接続先が起動していなくても、リクエストはプロセス内で処理される
+    llm = langchain_mcp_utils.initialize_llm(
+        "gpt-4o", "http://127.0.0.1:9/v1", max_retries=0
+    )
+
+    assert asyncio.run(llm.ainvoke("挨拶して")).content == "こんにちは"
+    assert router.calls[0]["model"] == "gpt-4o"
+
+    async def stream():
+        return "".join([chunk.content async for chunk in llm.astream("挨拶して")])
+
+    assert asyncio.run(stream()) == "こんにちは"
+    assert router.calls[1]["stream"] is True
+    assert llm.invoke("挨拶して").content == "同期"
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(llm.ainvoke("失敗"))
+    assert gateway.snapshot() == {"mode": "in_process", "models": ["gpt-4o"]}
+
+
+def test_mcp_http_pool_reuses_connections_across_sessions(monkeypatch):
+    """
+    HTTPのMCPサーバーへのセッションが、共有のコネクションプールで接続を再利用し、
+    その統計がメトリクスに表示されるかを、ローカルのstreamable_httpサーバーでテスト。
+    """
+    import socket
+    import threading
+
+    import uvicorn
+    from mcp.server.fastmcp import FastMCP
+
+    server_mcp = FastMCP("local", stateless_http=True, json_response=True)
+
+    @server_mcp.tool()
+    def echo(text: str) -> str:
+        return text
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(
+            server_mcp.streamable_http_app(),
+            host="127.0.0.1",
+            port=port,
+            log_level="warning",
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    pool = mcp_http.MCPHttpPool(
+        {"enabled": "true", "max_keepalive_connections": 4, "read_timeout": 20}
+    )
+    monkeypatch.setattr(mcp_http, "mcp_http_pool", pool)
+    connection = {"transport": "streamable_http", "url": f"http://127.0.0.1:{port}/mcp"}
+
+    async def run():
+        definitions = await tool_catalog.fetch_tool_definitions(connection)
+        (tool,) = tool_catalog.build_tools_from_definitions(
+            definitions, connection, "local"
+        )
+        return [await tool.ainvoke({"text": f"t{i}"}) for i in range(5)]
+
+    try:
+        while not server.started:
+            time.sleep(0.01)
+        assert asyncio.run(run()) == [f"t{i}" for i in range(5)]
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    snapshot = pool.snapshot()
+    # 6つのセッション（ツール一覧の取得と5回の呼び出し）は、それぞれ初期化の通知とリクエストを並行して送るため、
+    # セッションごとのクライアントでは12以上の接続が必要になる。共有のプールではセッションをまたいで再利用する
+    assert snapshot["requests"] >= 18
+    assert snapshot["connections_opened"] <= 7
+    assert snapshot["reused"] >= 2 * snapshot["connections_opened"]
+    assert snapshot["errors"] == 0 and snapshot["pools"] == 1
+    timeout = pool.timeout(mcp_http.httpx.Timeout(5.0, read=300.0))
+    assert (timeout.connect, timeout.read) == (10.0, 20.0)
+
+
+def test_mcp_http_pool_closes_retired_transports_on_their_loop(monkeypatch):
+    """
+    mcp_httpの再読み込みでプールを入れ替えたとき、入れ替え前のプールの接続を、
+    作成したイベントループ上で閉じるかをテスト。
+    """
+    import threading
+
+    monkeypatch.setattr(mcp_http, "_RETIRED_POOL_GRACE_SECONDS", 0)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    pool = mcp_http.MCPHttpPool({"enabled": "true"})
+    try:
+
+        async def create():
+            return pool._transport()
+
+        old = asyncio.run_coroutine_threadsafe(create(), loop).result(5)
+        closed = []
+        original_aclose = old.aclose
+
+        async def aclose():
+            closed.append(threading.current_thread())
+            await original_aclose()
+
+        old.aclose = aclose
+        pool.configure({"enabled": "true", "max_connections": 10})
+        deadline = time.time() + 5
+        while not closed and time.time() < deadline:
+            time.sleep(0.01)
+        assert closed == [thread]
+        assert asyncio.run_coroutine_threadsafe(create(), loop).result(5) is not old
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        loop.close()
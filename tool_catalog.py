@@ -0,0 +1,658 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from langchain_core.tools import (
+    StructuredTool,
+    ToolException,
+)
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp.types import Tool as MCPTool
+
+import app_metrics
+from mcp_http import open_mcp_session
+from mcp_resilience import (
+    get_server_limiter,
+    get_server_breaker,
+    get_tool_timeout,
+    format_breaker_state,
+)
+import mcp_supervisor
+from mcp_supervisor import format_supervisor_state
+import llm_cassette
+import doc_store
+from doc_store import (
+    store_tool_document,
+    search_local_docs,
+)
+from tool_results import (
+    apply_tool_result_policy,
+    read_tool_result,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# ツールカタログキャッシュのデフォルト保存先
+DEFAULT_TOOL_CACHE_PATH = "tool_cache.json"
+TOOL_CACHE_FORMAT_VERSION = 1
+
+
+def compute_server_config_hash(server_config: dict) -> str:
+    """
+    MCPサーバー設定のハッシュ値を計算する関数。
+    キー順序に依存しないよう、ソート済みJSONからSHA-256を求める。
+    Args:
+        server_config (dict): server_params.jsonのサーバー設定（1サーバー分）
+    Returns:
+        str: ハッシュ値（16進文字列）
+    """
+    serialized = json.dumps(server_config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def load_tool_cache(path: str) -> dict:
+    """
+    ツールカタログキャッシュファイルを読み込む関数
+    Args:
+        path (str): キャッシュファイルのパス
+    Returns:
+        dict: サーバー名をキーとしたキャッシュエントリ（読み込めない場合は空の辞書）
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    # フォーマットが異なる古いキャッシュは使わない
+    if not isinstance(cache, dict) or cache.get("version") != TOOL_CACHE_FORMAT_VERSION:
+        return {}
+    servers = cache.get("servers", {})
+    return servers if isinstance(servers, dict) else {}
+
+
+def save_tool_cache(path: str, servers_cache: dict) -> None:
+    """
+    ツールカタログキャッシュファイルを書き込む関数。
+    書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える。
+    Args:
+        path (str): キャッシュファイルのパス
+        servers_cache (dict): サーバー名をキーとしたキャッシュエントリ
+    """
+    data = {"version": TOOL_CACHE_FORMAT_VERSION, "servers": servers_cache}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+async def fetch_tool_definitions(connection: dict) -> list:
+    """
+    MCPサーバーに接続し、ツール定義（名前・説明・スキーマ）を取得する関数
+    Args:
+        connection (dict): サーバー接続設定
+    Returns:
+        list: JSONシリアライズ可能なツール定義のリスト
+    """
+    definitions = []
+    async with open_mcp_session(connection) as session:
+        await session.initialize()
+        cursor = None
+        while True:
+            page = await session.list_tools(cursor=cursor)
+            for tool in page.tools or []:
+                definitions.append(
+                    tool.model_dump(mode="json", by_alias=True, exclude_none=True)
+                )
+            if not page.nextCursor:
+                break
+            cursor = page.nextCursor
+    return definitions
+
+
+class _ServerRoute:
+    # ツール呼び出しのたびに接続先を決める。監視中の常駐プロセスがあれば共有セッションを使い、
+    # なければ呼び出しごとにセッションを開く（設定の再読み込みで監視の有無が変わっても追従する）
+    def __init__(self, server_name: str, connection: dict) -> None:
+        self.server_name = server_name
+        self.connection = connection
+
+    async def call_tool(self, name: str, arguments: dict | None = None):
+        # カセットの記録・再生中は、ツール呼び出しの結果をカセットに記録する（またはカセットから返す）
+        if llm_cassette.active_cassette is not None:
+            return await llm_cassette.active_cassette.call_tool(
+                self.server_name, name, arguments, self._call_tool
+            )
+        return await self._call_tool(name, arguments)
+
+    async def _call_tool(self, name: str, arguments: dict | None = None):
+        server = mcp_supervisor.stdio_supervisor.get(self.server_name)
+        if server is not None:
+            return await server.call_tool(name, arguments)
+        async with open_mcp_session(self.connection) as session:
+            await session.initialize()
+            return await session.call_tool(name, arguments)
+
+
+def build_tools_from_definitions(
+    definitions: list, connection: dict, server_name: str = ""
+) -> list:
+    """
+    ツール定義からLangChainツールを生成する関数。
+    ツール呼び出し時に初めてサーバーへ接続するため、生成時に通信は発生しない。
+    stdio_supervisorで監視しているサーバーのツールは、常駐プロセスの共有セッションで呼び出す。
+    Args:
+        definitions (list): ツール定義のリスト
+        connection (dict): サーバー接続設定
+        server_name (str): ツールを提供するサーバー名
+    Returns:
+        list: LangChainツールのリスト
+    """
+    session = _ServerRoute(server_name, connection)
+    return [
+        instrument_tool(
+            convert_mcp_tool_to_langchain_tool(
+                session, MCPTool.model_validate(definition), connection=connection
+            ),
+            server_name,
+        )
+        for definition in definitions
+    ]
+
+
+def instrument_tool(tool, server_name: str):
+    """
+    MCPツールの呼び出しを計測するラッパーツールを生成する関数
+    Args:
+        tool: convert_mcp_tool_to_langchain_toolで生成したツール
+        server_name (str): ツールを提供するサーバー名
+    Returns:
+        StructuredTool: 呼び出し回数と所要時間を記録するツール
+    """
+    call_original = tool.coroutine
+    tool_name = tool.name
+
+    async def call_tool(**arguments):
+        # サーキットブレーカーがopenのサーバーへは接続せず、すぐにエラーを返す
+        breaker = get_server_breaker(server_name)
+        if not breaker.allow():
+            raise ToolException(
+                f"サーバー '{server_name}' は失敗が続いているため一時的に停止中です"
+                f"（約{breaker.retry_after():.0f}秒後に再試行されます）。"
+                "このツールを使わずに回答してください。"
+            )
+        timeout = get_tool_timeout(server_name, tool_name)
+        try:
+            # 同一サーバーへの同時呼び出し数を制限する（異なるサーバーへの呼び出しは並行実行される）
+            async with get_server_limiter(server_name):
+                started_at = time.time()
+                started = time.perf_counter()
+                failed = True
+                try:
+                    content, artifact = await asyncio.wait_for(
+                        call_original(**arguments), timeout=timeout
+                    )
+                    # ドキュメントは切り詰める前の全文をローカルの文書ストアに登録する
+                    store_tool_document(server_name, tool_name, arguments, content)
+                    # 大きな結果は上限内に収め、全文は退避ストアに保存する
+                    content = apply_tool_result_policy(tool_name, content)
+                    failed = False
+                except asyncio.TimeoutError:
+                    breaker.record_failure()
+                    raise ToolException(
+                        f"ツール '{tool_name}' がタイムアウトしました（{timeout:.0f}秒）。"
+                    ) from None
+                except ToolException:
+                    # ツール自体が返したエラー（引数誤りなど）はサーバー障害として扱わない
+                    breaker.record_success(0.0)
+                    raise
+                except Exception:
+                    breaker.record_failure()
+                    raise
+                finally:
+                    duration = time.perf_counter() - started
+                    app_metrics.tool_call_stats.record(tool_name, duration, failed)
+        except asyncio.CancelledError:
+            breaker.release_trial()
+            raise
+        breaker.record_success(duration)
+        # 実際の開始・終了時刻をToolMessageのartifactに載せ、ツール履歴に表示する
+        return content, {
+            "server": server_name,
+            "started_at": started_at,
+            "ended_at": started_at + duration,
+            "artifact": artifact,
+        }
+
+    return StructuredTool(
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        coroutine=call_tool,
+        response_format=tool.response_format,
+        metadata={**(tool.metadata or {}), "mcp_server": server_name},
+    )
+
+
+class ToolCatalog:
+    """
+    MCPサーバーごとのツール定義とLangChainツールを保持するカタログ。
+    更新時は辞書・リストを作り直して差し替えるため、参照側はロックなしで読める。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.definitions_by_server = {}
+        self.tools_by_server = {}
+        self.tools = []
+        self.version = 0
+
+    def set_server(self, server_name: str, definitions: list, tools: list) -> None:
+        """
+        サーバーのツール定義とツールを登録（または置き換え）する
+        Args:
+            server_name (str): サーバー名
+            definitions (list): ツール定義のリスト
+            tools (list): LangChainツールのリスト
+        """
+        with self._lock:
+            definitions_by_server = dict(self.definitions_by_server)
+            tools_by_server = dict(self.tools_by_server)
+            definitions_by_server[server_name] = definitions
+            tools_by_server[server_name] = tools
+            self._publish(definitions_by_server, tools_by_server)
+
+    def remove_server(self, server_name: str) -> None:
+        """
+        サーバーのツールをカタログから取り除く
+        Args:
+            server_name (str): サーバー名
+        """
+        with self._lock:
+            definitions_by_server = dict(self.definitions_by_server)
+            tools_by_server = dict(self.tools_by_server)
+            definitions_by_server.pop(server_name, None)
+            tools_by_server.pop(server_name, None)
+            self._publish(definitions_by_server, tools_by_server)
+
+    def _publish(self, definitions_by_server: dict, tools_by_server: dict) -> None:
+        self.definitions_by_server = definitions_by_server
+        self.tools_by_server = tools_by_server
+        self.tools = [tool for tools in tools_by_server.values() for tool in tools]
+        self.version += 1
+
+
+async def load_tool_catalog(servers: dict, cache_path: str | None = None) -> tuple:
+    """
+    ツールカタログを構築する関数。
+    キャッシュ済みでサーバー設定のハッシュが一致するサーバーはキャッシュから即座に登録し、
+    それ以外のサーバーのみ起動してツール一覧を取得する。
+    Args:
+        servers (dict): server_params.jsonのserversセクション
+        cache_path (str | None): キャッシュファイルのパス（Noneの場合はキャッシュを使わない）
+    Returns:
+        tuple: (ToolCatalog, キャッシュから登録したサーバー名のリスト)
+    """
+    catalog = ToolCatalog()
+    # カセットの再生中は、記録したツール定義を使いMCPサーバーを起動しない
+    if (
+        llm_cassette.active_cassette is not None
+        and llm_cassette.active_cassette.mode == "replay"
+    ):
+        for server_name, connection in servers.items():
+            definitions = llm_cassette.active_cassette.tools.get(server_name, [])
+            catalog.set_server(
+                server_name,
+                definitions,
+                build_tools_from_definitions(definitions, connection, server_name),
+            )
+        return catalog, []
+    servers_cache = load_tool_cache(cache_path) if cache_path else {}
+    cached_servers = []
+    live_servers = []
+    for server_name, connection in servers.items():
+        entry = servers_cache.get(server_name)
+        if entry and entry.get("config_hash") == compute_server_config_hash(connection):
+            definitions = entry.get("tools", [])
+            catalog.set_server(
+                server_name,
+                definitions,
+                build_tools_from_definitions(definitions, connection, server_name),
+            )
+            cached_servers.append(server_name)
+        else:
+            live_servers.append(server_name)
+
+    # キャッシュにないサーバーは並行して起動・取得する
+    results = await asyncio.gather(
+        *(fetch_tool_definitions(servers[name]) for name in live_servers)
+    )
+    for server_name, definitions in zip(live_servers, results):
+        catalog.set_server(
+            server_name,
+            definitions,
+            build_tools_from_definitions(
+                definitions, servers[server_name], server_name
+            ),
+        )
+
+    if cache_path and live_servers:
+        _write_catalog_cache(cache_path, catalog, servers)
+    if llm_cassette.active_cassette is not None:
+        llm_cassette.active_cassette.add_tools(catalog.definitions_by_server)
+    return catalog, cached_servers
+
+
+def _write_catalog_cache(cache_path: str, catalog: ToolCatalog, servers: dict) -> None:
+    servers_cache = {
+        server_name: {
+            "config_hash": compute_server_config_hash(servers[server_name]),
+            "updated_at": time.time(),
+            "tools": definitions,
+        }
+        for server_name, definitions in catalog.definitions_by_server.items()
+        if server_name in servers
+    }
+    try:
+        save_tool_cache(cache_path, servers_cache)
+    except OSError as e:
+        logger.warning("ツールキャッシュの保存に失敗しました: %s", e)
+
+
+async def refresh_tool_catalog(
+    catalog: ToolCatalog, servers: dict, server_names: list, cache_path: str | None
+) -> list:
+    """
+    キャッシュから登録したサーバーのツール定義を実サーバーと照合し、差分があれば更新する関数
+    Args:
+        catalog (ToolCatalog): ツールカタログ
+        servers (dict): server_params.jsonのserversセクション
+        server_names (list): 照合するサーバー名のリスト
+        cache_path (str | None): キャッシュファイルのパス
+    Returns:
+        list: ツール定義が更新されたサーバー名のリスト
+    """
+    results = await asyncio.gather(
+        *(fetch_tool_definitions(servers[name]) for name in server_names),
+        return_exceptions=True,
+    )
+    changed = []
+    for server_name, definitions in zip(server_names, results):
+        if isinstance(definitions, Exception):
+            # 照合に失敗した場合はキャッシュの定義をそのまま使い続ける
+            logger.warning(
+                "ツール一覧の照合に失敗しました (%s): %s",
+                server_name,
+                definitions,
+                extra={"server": server_name},
+            )
+            continue
+        if definitions != catalog.definitions_by_server.get(server_name):
+            catalog.set_server(
+                server_name,
+                definitions,
+                build_tools_from_definitions(
+                    definitions, servers[server_name], server_name
+                ),
+            )
+            changed.append(server_name)
+    if cache_path and changed:
+        _write_catalog_cache(cache_path, catalog, servers)
+    return changed
+
+
+def start_background_tool_refresh(
+    catalog: ToolCatalog,
+    servers: dict,
+    server_names: list,
+    cache_path: str | None,
+    on_update=None,
+) -> threading.Thread:
+    """
+    キャッシュから登録したツールの照合をバックグラウンドスレッドで開始する関数
+    Args:
+        catalog (ToolCatalog): ツールカタログ
+        servers (dict): server_params.jsonのserversセクション
+        server_names (list): 照合するサーバー名のリスト
+        cache_path (str | None): キャッシュファイルのパス
+        on_update (callable | None): 更新があった場合に、更新サーバー名のリストを引数に呼ばれる関数
+    Returns:
+        threading.Thread: 起動したスレッド
+    """
+
+    def run() -> None:
+        changed = asyncio.run(
+            refresh_tool_catalog(catalog, servers, server_names, cache_path)
+        )
+        if changed:
+            logger.info("ツール定義を更新しました: %s", ", ".join(changed))
+            if on_update is not None:
+                on_update(changed)
+
+    thread = threading.Thread(target=run, name="tool-catalog-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+# ツール一覧タブで「全サーバー」を表す選択肢
+TOOL_CATALOG_ALL_SERVERS = "すべて"
+DEFAULT_TOOL_PAGE_SIZE = 20
+
+# カタログのバージョンごとに描画済みのツールエントリを保持するキャッシュ
+_tool_entries_cache = {"key": None, "entries": []}
+
+
+def _render_tool_entry(server_name: str, tool) -> str:
+    tool_name = getattr(tool, "name", "Unknown")
+    tool_desc = getattr(tool, "description", "") or "説明なし"
+    tool_args = getattr(tool, "args_schema", {})
+    if isinstance(tool_args, dict):
+        schema_text = json.dumps(tool_args, ensure_ascii=False, indent=2)
+    elif hasattr(tool_args, "model_json_schema"):
+        schema_text = json.dumps(
+            tool_args.model_json_schema(), ensure_ascii=False, indent=2
+        )
+    else:
+        schema_text = str(tool_args) if tool_args else ""
+
+    text = f"#### {tool_name}\n- サーバー: `{server_name}`\n- 説明: {tool_desc}\n"
+    if schema_text:
+        text += (
+            "<details><summary>引数スキーマ</summary>\n\n"
+            f"```json\n{schema_text}\n```\n</details>\n"
+        )
+    return text
+
+
+def get_rendered_tool_entries(catalog: ToolCatalog) -> list:
+    """
+    カタログ内の全ツールを描画したエントリを返す関数。
+    描画結果はカタログのバージョンごとにキャッシュし、カタログ更新時のみ再描画する。
+    Args:
+        catalog (ToolCatalog): ツールカタログ
+    Returns:
+        list: (サーバー名, ツール名, 検索用テキスト, Markdown) のタプルのリスト
+    """
+    key = (id(catalog), catalog.version)
+    if _tool_entries_cache["key"] == key:
+        return _tool_entries_cache["entries"]
+
+    entries = []
+    for server_name, tools in catalog.tools_by_server.items():
+        for tool in tools:
+            tool_name = getattr(tool, "name", "Unknown")
+            search_text = " ".join(
+                [server_name, tool_name, getattr(tool, "description", "") or ""]
+            ).lower()
+            entries.append(
+                (
+                    server_name,
+                    tool_name,
+                    search_text,
+                    _render_tool_entry(server_name, tool),
+                )
+            )
+    _tool_entries_cache["key"] = key
+    _tool_entries_cache["entries"] = entries
+    return entries
+
+
+def _format_tool_stats(stats: dict | None) -> str:
+    if not stats:
+        return "- 呼び出し: 0回\n"
+    average = stats["total_seconds"] / stats["calls"]
+    return (
+        f"- 呼び出し: {stats['calls']}回 (エラー {stats['errors']}回), "
+        f"平均 {average:.2f}秒 / 最大 {stats['max_seconds']:.2f}秒\n"
+    )
+
+
+def render_tool_catalog_page(
+    catalog: ToolCatalog,
+    query: str = "",
+    server_name: str = TOOL_CATALOG_ALL_SERVERS,
+    page: int = 1,
+    page_size: int = DEFAULT_TOOL_PAGE_SIZE,
+) -> tuple:
+    """
+    ツール一覧タブの1ページ分をMarkdownで描画する関数。
+    サーバーでの絞り込み、テキスト検索、ページ分割を行い、ツールごとの呼び出し統計を付加する。
+    Args:
+        catalog (ToolCatalog): ツールカタログ
+        query (str): 検索文字列（空白区切りのすべての語を含むツールを表示）
+        server_name (str): 表示するサーバー名
+        page (int): ページ番号（1始まり）
+        page_size (int): 1ページあたりのツール数
+    Returns:
+        tuple: (Markdown文字列, 実際に表示したページ番号)
+    """
+    entries = get_rendered_tool_entries(catalog)
+    terms = (query or "").lower().split()
+    matched = [
+        entry
+        for entry in entries
+        if (
+            server_name in (None, "", TOOL_CATALOG_ALL_SERVERS)
+            or entry[0] == server_name
+        )
+        and all(term in entry[2] for term in terms)
+    ]
+
+    page_size = max(1, int(page_size))
+    total_pages = max(1, (len(matched) + page_size - 1) // page_size)
+    page = min(max(1, int(page or 1)), total_pages)
+    visible = matched[(page - 1) * page_size : page * page_size]
+
+    result = "# 利用可能なツール一覧\n\n"
+    result += (
+        f"**合計ツール数**: {len(entries)} / **該当**: {len(matched)} / "
+        f"**ページ**: {page} / {total_pages}\n\n"
+    )
+    if not visible:
+        result += "利用可能なツールが見つかりませんでした。\n"
+        return result, page
+
+    stats = app_metrics.tool_call_stats.snapshot()
+    current_server = None
+    for entry_server, tool_name, _, text in visible:
+        # サーバーごとに見出しを付けてグループ化する
+        if entry_server != current_server:
+            result += (
+                f"## {entry_server}{format_breaker_state(entry_server)}"
+                f"{format_supervisor_state(entry_server)}\n\n"
+            )
+            current_server = entry_server
+        result += text + _format_tool_stats(stats.get(tool_name)) + "\n"
+    return result, page
+
+
+# 組み込みツールをまとめてカタログに登録する際のサーバー名
+BUILTIN_SERVER_NAME = "builtin"
+
+
+def create_builtin_tools() -> list:
+    """
+    MCPサーバーに依存しない組み込みツールを生成する関数
+    Returns:
+        list: 組み込みツールのリスト
+    """
+    tools = [
+        StructuredTool.from_function(
+            coroutine=read_tool_result,
+            name="read_tool_result",
+            description=(
+                "サイズが大きく省略されたツール結果の全文を、ハンドルとバイト位置(offset)を"
+                "指定して少しずつ読み出します。省略された結果の末尾に表示された値を指定してください。"
+            ),
+        )
+    ]
+    if doc_store.local_doc_store.enabled:
+        tools.append(
+            StructuredTool.from_function(
+                coroutine=search_local_docs,
+                name="search_local_docs",
+                description=(
+                    "以前に取得したドキュメント（AWS・Microsoft Learnなど）の段落をローカルで検索します。"
+                    "ドキュメントを取得するツールを呼ぶ前にまずこのツールで検索し、"
+                    "該当する段落がない場合のみ取得してください。"
+                ),
+            )
+        )
+    return tools
+
+
+def register_builtin_tools(catalog: ToolCatalog) -> None:
+    """
+    組み込みツールをツールカタログに登録する関数
+    Args:
+        catalog (ToolCatalog): ツールカタログ
+    """
+    catalog.set_server(BUILTIN_SERVER_NAME, [], create_builtin_tools())
+
+
+async def apply_server_changes(
+    catalog: ToolCatalog, servers: dict, diff: dict, cache_path: str | None
+) -> list:
+    """
+    サーバー設定の差分をツールカタログに反映する関数。
+    削除されたサーバーのツールを取り除き、追加・変更されたサーバーのみツール一覧を取得し直す。
+    Args:
+        catalog (ToolCatalog): ツールカタログ
+        servers (dict): 変更後のserversセクション
+        diff (dict): diff_server_paramsの結果
+        cache_path (str | None): キャッシュファイルのパス
+    Returns:
+        list: 反映に失敗したサーバー名のリスト（変更前のツールを使い続ける）
+    """
+    for server_name in diff["servers_removed"]:
+        catalog.remove_server(server_name)
+
+    targets = diff["servers_added"] + diff["servers_changed"]
+    results = await asyncio.gather(
+        *(fetch_tool_definitions(servers[name]) for name in targets),
+        return_exceptions=True,
+    )
+    failed = []
+    for server_name, definitions in zip(targets, results):
+        if isinstance(definitions, Exception):
+            logger.warning(
+                "サーバーの再読み込みに失敗しました (%s): %s",
+                server_name,
+                definitions,
+                extra={"server": server_name},
+            )
+            failed.append(server_name)
+            continue
+        catalog.set_server(
+            server_name,
+            definitions,
+            build_tools_from_definitions(
+                definitions, servers[server_name], server_name
+            ),
+        )
+    if cache_path and (targets or diff["servers_removed"]):
+        _write_catalog_cache(cache_path, catalog, servers)
+    return failed
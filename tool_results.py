@@ -0,0 +1,211 @@
+import atexit
+import collections
+import contextlib
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+
+
+# ツール結果のサイズ上限（文字数）と超過時の扱いの既定値
+DEFAULT_TOOL_RESULT_MAX_CHARS = 20000
+DEFAULT_TOOL_RESULT_MODE = "truncate"
+DEFAULT_SPILL_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_READ_RESULT_LENGTH = 8000
+
+# server_params.jsonのtool_resultsセクション
+tool_result_policy = {}
+_spill_store = None
+
+
+class ResultSpillStore:
+    """
+    大きなツール結果の全文をローカルファイルに退避し、ハンドルで参照するストア。
+    合計サイズが上限を超えた場合は古い結果から削除する。
+    """
+
+    def __init__(self, directory: str | None = None, max_bytes: int = 0) -> None:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        else:
+            directory = tempfile.mkdtemp(prefix="langchain_mcp_results_")
+            atexit.register(shutil.rmtree, directory, True)
+        self.directory = directory
+        self.max_bytes = max_bytes or DEFAULT_SPILL_MAX_BYTES
+        self._lock = threading.Lock()
+        self._sizes = collections.OrderedDict()
+        self.total_bytes = 0
+
+    def put(self, content: str) -> str:
+        """
+        結果の全文を保存してハンドルを返す
+        Args:
+            content (str): 保存する全文
+        Returns:
+            str: ハンドル
+        """
+        data = content.encode("utf-8")
+        # 同じ内容には同じハンドルを返し、記録・再生でLLMへのリクエストが変わらないようにする
+        handle = hashlib.sha256(data).hexdigest()[:16]
+        with self._lock:
+            if handle in self._sizes:
+                self._sizes.move_to_end(handle)
+                return handle
+        with open(self._path(handle), "wb") as f:
+            f.write(data)
+        with self._lock:
+            # 同じ内容を同時に保存した場合も、サイズは1回分だけ数える
+            if handle not in self._sizes:
+                self.total_bytes += len(data)
+            self._sizes[handle] = len(data)
+            self._sizes.move_to_end(handle)
+            # 上限を超えた分は古いものから削除する（保存したばかりの結果は残す）
+            while self.total_bytes > self.max_bytes and len(self._sizes) > 1:
+                old_handle, size = self._sizes.popitem(last=False)
+                self.total_bytes -= size
+                with contextlib.suppress(OSError):
+                    os.remove(self._path(old_handle))
+        return handle
+
+    def read(self, handle: str, offset: int = 0, length: int = 0) -> tuple:
+        """
+        保存済みの結果の一部を読み出す。
+        offsetとlengthはUTF-8のバイト単位で、文字の途中で切れないよう境界を調整する。
+        Args:
+            handle (str): ハンドル
+            offset (int): 読み出し開始位置（バイト）
+            length (int): 読み出す最大バイト数
+        Returns:
+            tuple: (読み出したテキスト, 次の読み出し位置, 全体のバイト数)
+        Raises:
+            KeyError: ハンドルが存在しない（または削除済み）場合
+        """
+        with self._lock:
+            if handle not in self._sizes:
+                raise KeyError(handle)
+            self._sizes.move_to_end(handle)
+            total = self._sizes[handle]
+        length = length or DEFAULT_READ_RESULT_LENGTH
+        offset = min(max(0, int(offset)), total)
+        if total == 0:
+            return "", 0, 0
+        with (
+            open(self._path(handle), "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as blob,
+        ):
+            # 継続バイト（0b10xxxxxx）から始まらないよう開始位置を進める
+            while offset < total and blob[offset] & 0xC0 == 0x80:
+                offset += 1
+            end = min(total, offset + int(length))
+            while end < total and blob[end] & 0xC0 == 0x80:
+                end -= 1
+            # lengthが1文字より短い場合も、1文字分は進めて読み出しが止まらないようにする
+            if end <= offset < total:
+                end = offset + 1
+                while end < total and blob[end] & 0xC0 == 0x80:
+                    end += 1
+            text = blob[offset:end].decode("utf-8", errors="ignore")
+        return text, end, total
+
+    def _path(self, handle: str) -> str:
+        return os.path.join(self.directory, f"{handle}.txt")
+
+
+def configure_tool_results(config: dict) -> None:
+    """
+    server_params.jsonのtool_resultsセクションを反映する関数。
+    退避先が変わらない場合は既存の退避ストアを使い続け、発行済みのハンドルを無効にしない。
+    Args:
+        config (dict): ツール結果のサイズ上限設定
+    """
+    global tool_result_policy, _spill_store
+    previous_dir = tool_result_policy.get("spill_dir") or None
+    tool_result_policy = dict(config or {})
+    if _spill_store is None:
+        return
+    if (tool_result_policy.get("spill_dir") or None) != previous_dir:
+        _spill_store = None
+        return
+    _spill_store.max_bytes = (
+        int(tool_result_policy.get("max_spill_bytes", DEFAULT_SPILL_MAX_BYTES))
+        or DEFAULT_SPILL_MAX_BYTES
+    )
+
+
+def get_spill_store() -> ResultSpillStore:
+    """
+    ツール結果の退避ストアを取得する関数（初回呼び出し時に作成する）
+    Returns:
+        ResultSpillStore: 退避ストア
+    """
+    global _spill_store
+    if _spill_store is None:
+        _spill_store = ResultSpillStore(
+            tool_result_policy.get("spill_dir") or None,
+            int(tool_result_policy.get("max_spill_bytes", DEFAULT_SPILL_MAX_BYTES)),
+        )
+    return _spill_store
+
+
+def apply_tool_result_policy(tool_name: str, content):
+    """
+    ツール結果がサイズ上限を超える場合、全文を退避ストアに保存し、
+    切り詰め（truncate）または要約（summarize: 先頭と末尾の抜粋）した結果に置き換える関数
+    Args:
+        tool_name (str): ツール名
+        content (str | list): ツール結果
+    Returns:
+        str | list: 上限内に収めたツール結果
+    """
+    policy = {
+        **tool_result_policy,
+        **tool_result_policy.get("tools", {}).get(tool_name, {}),
+    }
+    max_chars = int(policy.get("max_chars", DEFAULT_TOOL_RESULT_MAX_CHARS))
+    text = content if isinstance(content, str) else "\n".join(map(str, content))
+    if max_chars <= 0 or len(text) <= max_chars:
+        return content
+
+    handle = get_spill_store().put(text)
+    total_bytes = len(text.encode("utf-8"))
+    if policy.get("mode", DEFAULT_TOOL_RESULT_MODE) == "summarize":
+        head = text[: max_chars * 3 // 4]
+        tail = text[len(text) - max_chars // 4 :]
+        line_count = text.count("\n") + 1
+        shown = (
+            f"{head}\n\n...（中略: 全{len(text)}文字 / {line_count}行）...\n\n{tail}"
+        )
+        next_offset = len(head.encode("utf-8"))
+    else:
+        shown = text[:max_chars]
+        next_offset = len(shown.encode("utf-8"))
+    return (
+        f"{shown}\n\n[結果が大きいため、全{len(text)}文字のうち{max_chars}文字程度のみ表示しています。"
+        f"全文({total_bytes}バイト)はハンドル '{handle}' に保存されています。"
+        f"続きは read_tool_result ツールで handle='{handle}', offset={next_offset} を指定して読めます]"
+    )
+
+
+async def read_tool_result(
+    handle: str, offset: int = 0, length: int = DEFAULT_READ_RESULT_LENGTH
+) -> str:
+    """
+    大きなツール結果の全文の一部をハンドルを指定して読み出す組み込みツール
+    Args:
+        handle (str): ツール結果に表示されたハンドル
+        offset (int): 読み出し開始位置（バイト）
+        length (int): 読み出す最大バイト数
+    Returns:
+        str: 読み出したテキストと次の読み出し位置
+    """
+    try:
+        text, next_offset, total = get_spill_store().read(handle, offset, length)
+    except KeyError:
+        return f"ハンドル '{handle}' の結果は見つかりません（期限切れの可能性があります）。"
+    if next_offset >= total:
+        return f"{text}\n\n[終端に達しました（全{total}バイト）]"
+    return (
+        f"{text}\n\n[続きは offset={next_offset} を指定して読めます（全{total}バイト）]"
+    )